@@ -3,12 +3,22 @@ import itertools
 import copy
 import re
 import os, sys, getopt
-from multiprocessing import Process, Pipe, Queue
+from multiprocessing import Process, Pipe, Queue, Pool
 from operator import itemgetter
 import json
 import timeit
-import threading
+import collections
+import gzip
+import cPickle as pickle
 from openprot import *
+import openprot
+from corpus import PackedCorpus
+from deadlines import Expired, CancelToken
+from alignments import AlignmentMatrix
+from hypotheses import HypothesisSpace
+from resultstore import ResultSink, load_results
+from catalog import Catalog
+from aggregates import CurveStats
 
 __location__ = os.path.realpath(
     os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -21,33 +31,111 @@ def softmax(x):
     return np.exp(x) / np.sum(np.exp(x), axis=0)
 
 
-def runAg(agent, connection, protocol, pattern):
-	result = agent.interact(protocol, connection, pattern)
-	if verbose:
-		print "outcome {}".format(result)
-	return
+# what a talking agent yields when it waits for a message
+LISTEN = None
 
 def start_interaction(agent1, agent2, prot1, prot2, pattern):
-	""" Starts interaction between two agents"""
-	first_conn, second_conn = Pipe()
-	# queue = Queue()
-	result_1 = []
-	result_2 = []
-
-	a1 = threading.Thread(target=runAg, args=(agent1, first_conn, prot1, pattern))
-	a2 = threading.Thread(target=runAg, args=(agent2, second_conn, prot2, pattern))
+	""" Runs an interaction between two agents in this thread.
+		Each agent talks through a generator (talk) that yields the messages it sends and LISTEN when it needs one.
+		An agent runs until it waits for a message that has not been sent yet, and then the other one continues
+	"""
+	agents = [agent1, agent2]
+	talks = [agent1.talk(prot1, pattern), agent2.talk(prot2, pattern)]
+	inboxes = [collections.deque(), collections.deque()]
+	running = [True, True]
+	waiting = [False, False]
+
+	i = 0
+	while running[0] or running[1]:
+		if not running[i] or (waiting[i] and not inboxes[i]):
+			if not running[1-i] or (waiting[1-i] and not inboxes[1-i]):
+				# nobody can go on
+				break
+			i = 1-i
+			continue
+
+		heard = None
+		if waiting[i]:
+			heard = inboxes[i].popleft()
+			waiting[i] = False
+		try:
+			said = talks[i].send(heard)
+		except StopIteration:
+			running[i] = False
+			if verbose:
+				print "outcome {}".format(agents[i].outcome)
+			continue
+		except Expired:
+			# the other agent may be waiting for this one
+			inboxes[1-i].append('failed')
+			running[i] = False
+			if verbose:
+				print "outcome expired"
+			continue
 
-	a1.start()
-	a2.start()
-	a1.join()
-	a2.join()
+		if said is LISTEN:
+			waiting[i] = True
+		else:
+			inboxes[1-i].append(said)
+
+	for t in talks:
+		t.close()
+
+expiry_policies = ['unsat', 'retry', 'skip']
+
+def save_agents(*agents):
+	""" What restore_agents needs to put the agents back as they are now. Their vocabularies are the lists
+		the caller gave them (and may share), so they are kept as they are and only their order is saved
+	"""
+	shared = {id(a.vocabulary) : a.vocabulary for a in agents}
+	return [(a, list(a.vocabulary), copy.deepcopy(a.__dict__, dict(shared))) for a in agents], shared
+
+def restore_agents(saved):
+	"""Puts the agents saved by save_agents back as they were, in place"""
+	agents, shared = saved
+	for a, vocabulary, fields in agents:
+		a.__dict__.clear()
+		a.__dict__.update(copy.deepcopy(fields, dict(shared)))
+		a.vocabulary[:] = vocabulary
+
+def budgeted_interaction(agent1, agent2, prot1, prot2, pattern, budget, parent, policy, expirations):
+	""" Runs an interaction in which the checks can spend budget seconds, and no more than the parent token allows.
+		If the time runs out the checks answer unsat, or the agents go back (in place) to how they were before it and
+		the interaction is run again once (retry) or dropped (skip). Returns the agents
+	"""
+	attempts = 1
+	if policy == 'retry':
+		attempts = 2
+	saved = None
+	if policy != 'unsat':
+		saved = save_agents(agent1, agent2)
+
+	for attempt in range(attempts):
+		token = CancelToken(budget, parent)
+		openprot.cancel_token = token
+		try:
+			start_interaction(agent1, agent2, prot1, prot2, pattern)
+		finally:
+			openprot.cancel_token = None
+		if not token.expirations:
+			return agent1, agent2
+		if policy == 'unsat':
+			expirations['unsat'] += 1
+			return agent1, agent2
+		restore_agents(saved)
+		if attempt + 1 < attempts and not parent.expired():
+			expirations['retry'] += 1
+		else:
+			expirations['skip'] += 1
+			return agent1, agent2
+	return agent1, agent2
 
 class Agent(object):
 	""" A basic agent, with an id and a vocabulary"""
 	def __init__(self, id, vocabulary, dist={}):
 		self.id = id
 		self.vocabulary = vocabulary
-		self.alignment = {}
+		self.alignment = AlignmentMatrix(vocabulary)
 		self.res = {}
 		self.success = []
 		self.known = []
@@ -75,21 +163,16 @@ class Agent(object):
 		return
 
 	def best_map(self, foreign):
-		maxVal = max(self.alignment[foreign].values())
-		if self.alignment[foreign].values().count(maxVal)>1:
-			return None
-		best = [v for v in self.vocabulary if self.alignment[foreign][v]==maxVal][0]
-		return best
+		return self.alignment.best(foreign)
 
 	def certainty(self, v):
 		"""Measures the difference between possible interpretations for v"""
-		values = [self.alignment[k][v] for k in self.alignment.keys()]
-		if values:
-			maxVal = max(values)
-			if values.count(maxVal)>1:
+		values = self.alignment.column(v)
+		if len(values):
+			maxVal = values.max()
+			if (values == maxVal).sum()>1:
 				return 0
-			differences = sum([maxVal-val for val in values])/float(len(values))
-			return differences
+			return (maxVal - values).sum()/float(len(values))
 		else:
 			return 0
 
@@ -100,14 +183,15 @@ class Agent(object):
 	def choose_utterance(self, protocol, interaction, bound):
 		"""Choose a message to utter between the possible ones"""
 		random.shuffle(self.choices)
+		possible = possible_candidatesNM(protocol, interaction, self.choices, self.id)
 		for utterance in self.choices:
-			if is_possibleNM(protocol, interaction, utterance, bound, self.id):
+			if utterance in possible:
 				return utterance
 		return None
 
 
-	def interact(self, protocol, connection, pattern):
-		"""Start an interaction with an agent"""
+	def talk(self, protocol, pattern):
+		"""The agent's side of an interaction: yields what it says, and LISTEN to get what it hears (see start_interaction)"""
 		interaction = []
 		interactionHist = []
 		bound = len(pattern)
@@ -117,41 +201,46 @@ class Agent(object):
 				utterance = self.choose_utterance(protocol, interaction, bound)
 				if not utterance:
 					# print interaction
-					connection.send('failed')
+					yield 'failed'
 					if verbose:
 						print "failed by sender"
-					return 0
+					self.outcome = 0
+					return
 
-				connection.send(utterance)
+				yield utterance
 				if verbose:
 					print "Agent {} says {}".format(self.id, utterance)
 				interaction.append((self.id, utterance))
-				conf = connection.recv()
+				conf = yield LISTEN
 				if conf == 'failed':
-					return 0
+					self.outcome = 0
+					return
 			else:
-				received = connection.recv()
+				received = yield LISTEN
 				if received == 'failed':
-					return 0		
+					self.outcome = 0
+					return
 				
  				interpretation = self.choose_interpretation(protocol, interaction, received, bound, mappings_made)	
 				if verbose:
 					print "Agent {} interprets {}".format(self.id, interpretation)
 				if interpretation == 0 or interpretation==None:
 					# print interaction
-					connection.send('failed')
+					yield 'failed'
 					if verbose:
 						print "failed by receiver"
-					return 0
+					self.outcome = 0
+					return
 
 				self.manage_mon(protocol, interaction, mappings_made, bound,interpretation, received, self.id)
 				interaction.append((self.interloc, interpretation))
 				if verbose:
 					print "interaction: {}".format(interaction)
-				connection.send('ok')
+				yield 'ok'
 
 		self.manage_monF(protocol, interaction, bound, self.id, mappings_made)
-		return 2
+		self.outcome = 2
+		return
 
 	def manage_mon(self, protocol, interaction, mappings_made, bound, interpretation, received, id):
 		"""Manage monotonic broken rules"""
@@ -215,7 +304,8 @@ class Logical(Agent):
 		self.success = []
 		self.assumptionsStr = []
 		self.known = []
-		self.possible_alignments = [alg for alg in itertools.permutations(list(range(len(vocabulary))),len(vocabulary))]
+		# the alignments alg in which local word j means foreign word alg[j] (the index in known)
+		self.possible_alignments = HypothesisSpace(len(vocabulary))
 		self.interloc = 1-self.id
 		self.choices = self.vocabulary
 		self.mons = 0	
@@ -231,13 +321,19 @@ class Logical(Agent):
 		self.alignment[word] = {v : (1.0/(len(self.vocabulary))) for v in self.vocabulary}
 		return
 	
+	def set_alg(self, choice):
+		if choice == None:
+			self.alignment = {}
+		else:
+			self.alignment = {k : {self.vocabulary[choice.index(self.known.index(k))] : 1.0} for k in self.known}
+
 	def build_alg(self):
-		choice = random.choice(self.possible_alignments)
-		self.alignment = {k : {self.vocabulary[choice.index(self.known.index(k))] : 1.0} for k in self.known}
+		self.set_alg(self.possible_alignments.sample())
 		return
 
 
-	def interact(self, protocol, connection, pattern):
+	def talk(self, protocol, pattern):
+		"""The agent's side of an interaction: yields what it says, and LISTEN to get what it hears (see start_interaction)"""
 		interaction = []
 		bound = len(pattern)
 		mappings_made = {}
@@ -246,45 +342,51 @@ class Logical(Agent):
 			if t==self.id:
 				utterance = self.choose_utterance(protocol, interaction, bound)
 				if not utterance:
-					connection.send('failed')
-					self.alignment = {k : {self.vocabulary[self.possible_alignments[0].index(self.known.index(k))] : 1.0} for k in self.known}
-					return 0
+					yield 'failed'
+					self.set_alg(self.possible_alignments.first())
+					self.outcome = 0
+					return
 
-				connection.send(utterance)
+				yield utterance
 				if verbose:
 					print "Agent {} says {}".format(self.id, utterance)
 				interaction.append((self.id, utterance))
-				conf = connection.recv()
+				conf = yield LISTEN
 				if conf == 'failed':
 					self.build_alg()
-					return 0
+					self.outcome = 0
+					return
 			else:
-				received = connection.recv()
+				received = yield LISTEN
 				if received == 'failed':
 					if verbose:
 						print "failed by sender"
 					self.build_alg()
-					return 0		
+					self.outcome = 0
+					return
 				if not received in self.known:
 					self.known.append(received)
 
  				interpretation = self.choose_interpretation(protocol, interaction, received, bound, mappings_made)	
 				# print "Agent {} interprets {}".format(self.id, interpretation)
 				if interpretation == 0:
-					connection.send('failed')
+					yield 'failed'
 					if verbose:
 						print "failed by receiver"
 					self.build_alg()
-					return 0
+					self.outcome = 0
+					return
 
 				interaction.append((self.interloc, interpretation))
-				connection.send('ok')
+				yield 'ok'
 
 		self.build_alg()
 		if check_sat(protocol.rules, protocol.vocabulary, bound, interaction=interaction, name=str(self.id)):
-			return 1
+			self.outcome = 1
+			return
 		else:
-			return 0
+			self.outcome = 0
+			return
 	
 
 	def choose_interpretation(self, protocol, interaction, received, bound, mappings_made):
@@ -322,35 +424,23 @@ class Logical(Agent):
 			if verbose:
 				print "Prev: {}".format(prev)
 			if isinstance(r, Existential) and r.pos == 0:
-				for alg in self.possible_alignments:
-					if verbose:
-						print alg
-					if self.vocabulary[alg.index(self.known.index(received))]==interpretation:
-						if verbose:
-							print "here existential {} {}".format(received, interpretation)
-						self.possible_alignments.remove(alg)
+				if verbose:
+					print "here existential {} {}".format(received, interpretation)
+				self.possible_alignments.exclude(self.vocabulary.index(interpretation), self.known.index(received))
 				break
 
 			elif isinstance(r, Relation) and r.pos == 1 and r.type == 'before':
 				if (not [x for x in interaction if str(x[0])==str(r.ag)]):
-					for alg in self.possible_alignments:
-						if verbose:
-							print alg
-						if self.vocabulary[alg.index(self.known.index(received))]==interpretation:
-							if verbose:
-								print "here before/premise {} {}".format(received, interpretation)
-							self.possible_alignments.remove(alg)
+					if verbose:
+						print "here before/premise {} {}".format(received, interpretation)
+					self.possible_alignments.exclude(self.vocabulary.index(interpretation), self.known.index(received))
 					break
 			
 			elif isinstance(r, Relation) and r.pos == 1 and (r.type == 'premise' or r.type== 'immAfter'):
 				if (interaction==[] or (interaction[-1][0]!=r.ag)):
-					for alg in self.possible_alignments:
-						if verbose:
-							print alg
-						if self.vocabulary[alg.index(self.known.index(received))]==interpretation:
-							if verbose:
-								print "here before/premise {} {}".format(received, interpretation)
-							self.possible_alignments.remove(alg)
+					if verbose:
+						print "here before/premise {} {}".format(received, interpretation)
+					self.possible_alignments.exclude(self.vocabulary.index(interpretation), self.known.index(received))
 					break
 				else:
 					if str(r.agr)==str(self.interloc) and str(r.b)==received and str(interaction[-1][0])==str(self.interloc):
@@ -377,13 +467,9 @@ class Logical(Agent):
 		brokens_by_int = list(set(brokens_by_int))
 
 		for pair in brokens_by_int:
-			for alg in self.possible_alignments:
-				if verbose:
-						print alg
-				if self.vocabulary[alg.index(self.known.index(pair[0]))]==pair[1] and self.vocabulary[alg.index(self.known.index(received))]==interpretation:
-					self.possible_alignments.remove(alg)
-					if verbose:
-						print "here quad {} {} {} {}".format(pair[0], pair[1],received, interpretation)
+			self.possible_alignments.exclude_pair(self.vocabulary.index(pair[1]), self.known.index(pair[0]), self.vocabulary.index(interpretation), self.known.index(received))
+			if verbose:
+				print "here quad {} {} {} {}".format(pair[0], pair[1],received, interpretation)
 	
 		return
 
@@ -400,33 +486,38 @@ class Simple(Agent):
 	def compute_possibilities(self, received):
 		keys = self.alignment[received].keys()
 		random.shuffle(keys)
-		possibilities = [k for k in sorted(keys, key=lambda x : self.alignment[received][x])]
-		possibilities.reverse()
-		return possibilities
+		return self.alignment.ranking(received, keys)
 
 	def choose_utterance(self, protocol, interaction, bound):
 		"""Choose a message to utter between the possible ones"""
 		random.shuffle(self.choices)
+		possible = possible_candidatesNM(protocol, interaction, self.choices, self.id)
 		for utterance in self.choices:
-			if is_possibleNM(protocol, interaction, utterance, bound, self.id):
+			if utterance in possible:
 				return utterance
 		return None
 
-	def is_possible_interp(self, protocol, interaction, interpretation, bound):
-		broken = brokenNonM(protocol, interaction, bound, interpretation,self.interloc)
+	def is_possible_interp(self, protocol, interaction, interpretation, bound, broken=None):
+		if broken == None:
+			broken = brokenNonM(protocol, interaction, bound, interpretation,self.interloc)
 		return not broken
 
+	def candidate_brokens(self, protocol, interaction, possibilities):
+		"""The non-monotonic rules each possible interpretation breaks, for is_possible_interp and manage_brokens"""
+		return broken_candidatesNM(protocol, interaction, possibilities, self.interloc)
+
 	def choose_interpretation(self, protocol, interaction, received, bound, mappings_made):
 		perc = 0.3
 		if not received in self.alignment.keys():
-			random.shuffle(protocol.vocabulary)
+			# protocols are shared between interactions: shuffle a copy, which keeps the random sequence
+			random.shuffle(list(protocol.vocabulary))
 			self.initialize(received)
 			# self.res[received] = { v : [] for v in self.vocabulary}
 
 		random.shuffle(self.vocabulary)
 
-		possibilities = [k for k in sorted(self.vocabulary, key=self.alignment[received].get)]
-		possibilities.reverse()
+		possibilities = self.alignment.ranking(received, self.vocabulary)
+		brokens = self.candidate_brokens(protocol, interaction, possibilities)
 
 
 		interpretationF = 0
@@ -453,14 +544,14 @@ class Simple(Agent):
 			if verbose:
 				print "Received {} Interpretation {}".format(received,interpretation)
 			
-			if self.is_possible_interp(protocol, interaction, interpretation, bound):
+			if self.is_possible_interp(protocol, interaction, interpretation, bound, brokens.get(interpretation)):
 				if not found:
 					found = True
 					interpretationF = interpretation
 
 			else:
 				self.punish(received, interpretation, interaction, prev)
-				broken = brokenNonM(protocol, interaction, bound, interpretation,self.interloc)
+				broken = brokens.get(interpretation)
 
 				self.manage_brokens(protocol, mappings_made, received, interpretation, interaction, bound, self.interloc, broken)
 
@@ -475,14 +566,10 @@ class Simple(Agent):
 	def punish(self, received, interpretation, interaction, prev):
 		if verbose:
 			print "punished"
-		self.alignment[received][interpretation] -= self.parameter * prev 
+		self.alignment.punish(received, interpretation, self.parameter)
 
 	def normalize(self, received):
-		for rec in self.alignment.keys():
-			sumV = sum(self.alignment[rec].values())
-			if not sumV==0:
-				for k in self.alignment[rec].keys():
-					self.alignment[rec][k] = self.alignment[rec][k] / sumV
+		self.alignment.normalize()
 
 
 class Reasoner(Simple):
@@ -509,21 +596,21 @@ class Reasoner(Simple):
 			if isinstance(r, Existential) and r.pos == 0:
 				if verbose:
 					print "here!"
-				self.alignment[received][interpretation] -= 1 * self.alignment[received][interpretation]
+				self.alignment.punish(received, interpretation, 1)
 				break
 
 			elif isinstance(r, Relation) and r.pos == 1 and r.type == 'before':
 				if (not [x for x in interaction if str(x[0])==str(r.ag)]):
 					if verbose:
 						print "here before"
-					self.alignment[received][interpretation]  -= 1 * self.alignment[received][interpretation]
+					self.alignment.punish(received, interpretation, 1)
 					break
 			
 			elif isinstance(r, Relation) and r.pos == 1 and (r.type == 'premise' or r.type== 'immAfter'):
 				if (interaction==[] or (interaction[-1][0]!=r.ag)):
 					if verbose:
 						print "here premise"
-					self.alignment[received][interpretation]  -= 1 * self.alignment[received][interpretation]
+					self.alignment.punish(received, interpretation, 1)
 					break
 				else:
 					if str(r.agr)==str(self.interloc) and str(r.b)==received and str(interaction[-1][0])==str(self.interloc):
@@ -559,13 +646,13 @@ class Reasoner(Simple):
 		for t in brokens_by_int:
 			prevAlg = self.alignment[t[0]][t[1]]
 			sumBr += self.alignment[t[0]][t[1]]
-			self.alignment[received][interpretation] -= self.alignment[received][interpretation] * prevAlg**2
+			self.alignment.punish(received, interpretation, prevAlg**2)
 
 			if verbose:
 				print "pan: {} = {} : - {}".format(received, interpretation,prevAlg*0.2)
 
 		if not brokens_by_int:
-			self.alignment[received][interpretation] -= self.alignment[received][interpretation]  * 0.1
+			self.alignment.punish(received, interpretation, 0.1)
 			if verbose:
 				print "norm: {} = {} : - {}".format(received, interpretation, str(0.3))			
 		return
@@ -585,8 +672,9 @@ class Student(Simple):
 
  		if verbose:
 	 		print "to_try: {}".format(to_try)
+		possible = possible_candidatesNM(protocol, interaction, to_try, self.id)
 		for utterance in to_try:
-			if is_possibleNM(protocol, interaction, utterance, bound, self.id):				
+			if utterance in possible:
 				return utterance
 
 		return 0
@@ -606,8 +694,9 @@ class StudentCoop(Simple):
 		to_try = premise_coop + premsrest
  		if verbose:
 	 		print "to_try: {}".format(to_try)
+		possible = possible_candidatesNM(protocol, interaction, to_try, self.id)
 		for utterance in to_try:
-			if is_possibleNM(protocol, interaction, utterance, bound, self.id):				
+			if utterance in possible:
 				return utterance
 		return 0
 
@@ -637,7 +726,11 @@ def create_alg_class(agenttype):
 ##### Monotonics
 class SimpleMon(Simple):
 
-	def is_possible_interp(protocol, interaction, interpretation, bound):
+	def candidate_brokens(self, protocol, interaction, possibilities):
+		# is_possible_interp does not use them
+		return {}
+
+	def is_possible_interp(self, protocol, interaction, interpretation, bound, broken=None):
 		return is_possible_mon(protocol, interaction, interpretation, bound,self.interloc)
 
 	def choose_utterance(self, protocol, interaction, bound):
@@ -651,6 +744,10 @@ class SimpleMon(Simple):
 
 class SimpleBound(Simple):
 
+	def candidate_brokens(self, protocol, interaction, possibilities):
+		# is_possible_interp does not use them
+		return {}
+
 	def choose_utterance(self, protocol, interaction, bound):
 		"""Choose a message to utter between the possible ones"""
 
@@ -661,7 +758,7 @@ class SimpleBound(Simple):
 		return None
 
 
-	def is_possible_interp(protocol, interaction, interpretation, bound):
+	def is_possible_interp(self, protocol, interaction, interpretation, bound, broken=None):
 		return is_possible_bound(protocol, interaction, interpretation, bound,self.interloc)
 
 
@@ -677,12 +774,12 @@ class SimpleMonPos(SimpleMon):
 			interaction2 = copy.copy(interaction)
 			interaction2.append((1-id, interpretation))
 			
-			broken = brokenM(protocol, interaction2, bound, name=str(id))
+			broken = set(brokenM(protocol, interaction2, bound, name=str(id)))
 			
 			respected = [r for r in broken_prev if not r in broken]
 			br = None
 			if respected:
-				self.alignment[received][interpretation] += 0.05 * self.alignment[received][interpretation]
+				self.alignment.reward(received, interpretation, 0.05)
 				if verbose:
 					print "monrew: {} {}".format(received, br)
 		return
@@ -705,7 +802,7 @@ class SimpleMonNeg(SimpleMon):
 				continue
 			for m in mappings_made.keys():
 
-				self.alignment[m][mappings_made[m]] -= 0.05 * self.alignment[m][mappings_made[m]]
+				self.alignment.punish(m, mappings_made[m], 0.05)
 				
 				if verbose:
 					print "pun {} {}".format(m, mappings_made[m])
@@ -713,10 +810,220 @@ class SimpleMonNeg(SimpleMon):
 		return
 
 
-def experimentAgents(outiter, initer, int, vocab, prot, agents, hetp=None, hetr=None, mons = 0, param=0.3, verbosity=0):
+class ProtocolStore(object):
+	""" The protocols of an experiment, read and translated once and then shared by every interaction.
+		Their rules and vocabulary are tuples: the protocols handed out must not be modified """
+
+	def __init__(self, alignment, corpus=None, path='json/'):
+		self.alignment = alignment
+		self.corpus = corpus
+		self.path = path
+		self.protocols = {}
+		self.requests = 0
+		self.load_time = 0.0
+
+	@staticmethod
+	def freeze(protocol):
+		protocol.rules = tuple(protocol.rules)
+		protocol.vocabulary = tuple(protocol.vocabulary)
+		return protocol
+
+	def get(self, name):
+		""" The protocol called name and its translation by the alignment """
+		self.requests += 1
+		if not name in self.protocols:
+			start_time = timeit.default_timer()
+			if self.corpus != None:
+				protocol0 = self.corpus.protocol(name)
+			else:
+				protocol0 = protocol_from_json(self.path+'jsonPR-'+name)
+			protocol1 = protocol_translator(protocol0, self.alignment)
+			self.protocols[name] = (self.freeze(protocol0), self.freeze(protocol1))
+			self.load_time += timeit.default_timer() - start_time
+		return self.protocols[name]
+
+	def saved(self):
+		""" Estimated time saved by not loading and translating again: the mean load time for every reuse """
+		if not self.protocols:
+			return 0.0
+		return (self.requests - len(self.protocols)) * self.load_time / len(self.protocols)
+
+	def __str__(self):
+		return "{} protocols loaded in {:.3f}s for {} interactions, {:.3f}s saved".format(len(self.protocols), self.load_time, self.requests, self.saved())
+
+
+def make_agents(ag, v0, v1, mons=0, param=0.3, prevAlg0=None, prevAlg1=None):
+	"""A new pair of agents of type ag, with vocabularies v0 and v1"""
+	if ag=='simple':	
+		a0 = Simple(0, v0, param, dist={})
+		a1 = Simple(1, v1,  param, dist={})
+	if ag=='reasoner':	
+		a0 = Reasoner(0, v0, dist={})
+		a1 = Reasoner(1, v1, dist={})
+	if ag=='student':	
+		a0 = Student(0, v0)
+		a1 = Student(1, v1)
+	if ag=='studentcoop':	
+		a0 = StudentCoop(0, v0)
+		a1 = StudentCoop(1, v1)			
+	if ag=='studentcoopr':	
+		a0 = StudentCoopR(0, v0)
+		a1 = StudentCoopR(1, v1)				
+	if ag=='studentr':	
+		a0 = StudentR(0, v0)
+		a1 = StudentR(1, v1)
+
+	elif ag=='simplebound':	
+		a0 = SimpleBound(0, v0, mons, param, dist={})
+		a1 = SimpleBound(1, v1, mons, param, dist={})	
+	
+	elif ag=='simpleAg':	
+		a0 = Simple(0, v0)
+		a1 = Agent(1, v1)
+	elif ag=='reasonerAg':	
+		a0 = Reasoner(0, v0)
+		a1 = Agent(1, v1)			
+	elif ag=='studentAg':	
+		a0 = Student(0, v0)
+		a1 = Agent(1, v1)
+	elif ag=='studentrAg':	
+		a0 = StudentR(0, v0)
+		a1 = Agent(1, v1)	
+	elif ag=='simplemon':	
+		a0 = SimpleMon(0, v0)
+		a1 = SimpleMon(1, v1)
+	elif ag=='simplemonpos':	
+		a0 = SimpleMonPos(0, v0)
+		a1 = SimpleMonPos(1, v1)
+	elif ag=='simplemonneg':	
+		a0 = SimpleMonNeg(0, v0)
+		a1 = SimpleMonNeg(1, v1)
+	elif ag=='Logical':
+		a0 = Logical(0, v0)
+		a1 = Logical(1, v1)
+
+	elif ag in ['simple_alg','reasoner_alg','student_alg','studentr_alg','studentcoop_alg','studentcoopr_alg']:
+		if ag=='simple_alg':
+			ClAlAg = create_alg_class(Simple)
+		elif ag=='reasoner_alg':
+			ClAlAg = create_alg_class(Reasoner)
+		elif ag=='student_alg':
+			ClAlAg = create_alg_class(Student)
+		elif ag=='studentr_alg':
+			ClAlAg = create_alg_class(StudentR)
+		elif ag=='studentcoop_alg':
+			ClAlAg = create_alg_class(StudentCoop)
+		elif ag=='studentcoopr_alg':
+			ClAlAg = create_alg_class(StudentCoopR)
+
+		a0 = ClAlAg(0, v0, prevAlg0)
+		a1 = ClAlAg(1, v1, prevAlg1)
+	return a0, a1
+
+# what the cells of the running experiment share: vocabularies, alignments, protocol store, budgets
+_experiment = {}
+
+def run_cell(cell):
+	""" Runs iteration i of outer iteration o for agent type ag: a new pair of agents goes through the protocols in order
+		until it converges. Returns ag, the f-score curves of both agents, the interaction in which they converged
+		(twice the number of protocols if they did not) and the expirations of its checks.
+		If the cell has a seed the random generator starts from it, so the cell gives the same result in any process
+	"""
+	ag, o, i, patterns, seed = cell
+	e = _experiment
+	inters = len(patterns)
+	alignment = e['alignment']
+	v0, v1 = e['v0'], e['v1']
+	if seed != None:
+		random.seed(seed)
+		# agents shuffle their vocabulary in place: a seeded cell must not see what the previous cells left
+		v0, v1 = list(v0), list(v1)
+
+	print "Agent {}".format(ag)
+	print "\n Iteration: {} : {}".format(o, i)
+
+	a0, a1 = make_agents(ag, v0, v1, e['mons'], e['param'], e['prevAlg0'], e['prevAlg1'])
+	cell_token = CancelToken(parent=e['token'])
+	expirations = {p : 0 for p in expiry_policies}
+
+	resultsTemp0 = []
+	resultsTemp1 = []
+	for j in range(inters):
+		pattern = patterns[j]
+		if verbose:
+			print ""
+			print ""
+			print "Interaction {}".format(j)
+		protocol0, protocol1 = e['store'].get(e['name']+str(j))
+		# protocol0 = protocol_from_json('json/jsonPR-'+str(o)+str(voc)+str(prot)+str(p))
+		if verbose:
+			print protocol0
+
+		if e['budgeted']:
+			a0, a1 = budgeted_interaction(a0, a1, protocol0, protocol1, pattern, e['interaction_budget'], cell_token, e['expiry_policy'], expirations)
+		else:
+			start_interaction(a0,a1,protocol0, protocol1, pattern)
+		
+		prect0,rect0 = precision_recall(a0.alignment, reverseAlg(alignment))
+		prect1,rect1 = precision_recall(a1.alignment, alignment)
+
+		# if 1:
+		if verbose:
+			print ""
+			print "Interaction {}".format(j)
 
+			if ag == "Logical":
+				print "possible a0: {}".format(a0.possible_alignments.estimate())
+				print "possible a1: {}".format(a1.possible_alignments.estimate())
+				
+			else:	
+				print "a0: p {} r {} ".format(prect0,rect0)
+				print "a1: p {} r {} ".format(prect1,rect1)
+			# print a1.alignment
+
+		resultsTemp0.append((prect0,rect0))
+		resultsTemp1.append((prect1,rect1))
+
+		if ag=='Logical':
+			cond = (a0.possible_alignments.count(2)==1 and a1.possible_alignments.count(2)==1)
+		elif ag== 'simpleAg' or ag== 'reasonerAg' or ag== 'studentAg' or ag== 'studentrAg':
+			cond = (prect0 ==1.0 and rect0 == 1.0)
+		else:
+			cond = (prect0 ==1.0 and rect0 == 1.0 and prect1 ==1.0 and rect1 == 1.0)
+
+		if cond:
+		# if prect0 ==1.0 and rect0 == 1.0 and prect1 ==1.0 and rect1 == 1.0 :
+		# if prect0 ==1.0 and rect0 == 1.0:
+			print j
+			for h in range(j+1, inters):
+				resultsTemp0.append((1.0,1.0))
+				resultsTemp1.append((1.0,1.0))
+			break	
+	
+	converged = j if cond else inters*2
+	curve0 = [fscore(t[0],t[1]) for t in resultsTemp0]
+	curve1 = [fscore(t[0],t[1]) for t in resultsTemp1]
+	return ag, curve0, curve1, converged, expirations, cell_token.expirations
+
+def init_cell_worker(verbosity):
+	""" Sets up a process of the pool. It inherits the experiment, but not the NuSMV processes
+		and the cache database of its parent, which it opens again for itself
+	"""
 	global verbose
 	verbose = verbosity
+	openprot.init_worker_process()
+
+def prepare_experiment(int, vocab, prot, hetp=None, hetr=None, mons=0, param=0.3, corpus=None, seed=None, interaction_budget=None, experiment_budget=None, expiry_policy='unsat'):
+	""" Sets up what the cells of an experiment share (see run_cell). With a seed, the heterogeneity
+		and the patterns are derived from it, so any process that prepares the same experiment runs the same cells
+	"""
+	if not expiry_policy in expiry_policies:
+		raise NameError('Unknown expiry policy: {}'.format(expiry_policy))
+
+	if isinstance(corpus, basestring):
+		corpus = PackedCorpus(corpus)
+	if seed != None:
+		random.seed(derive_seed(seed, 'heterogeneity'))
 
 	v0 = vocab
 	voc = len(vocab)
@@ -724,196 +1031,327 @@ def experimentAgents(outiter, initer, int, vocab, prot, agents, hetp=None, hetr=
 
 	v1 = translate1(v0)
 	alignment = {v0[k] : v1[k] for k in range(len(v0))}
+	store = ProtocolStore(alignment, corpus)
+	# the words get their ids before any cell runs, so that the ids (and the order of sets of rules) are the same in every process
+	for w in v0 + v1:
+		word_id(w)
 
+	budgeted = interaction_budget != None or experiment_budget != None
+
+	prevAlg0 = None
+	prevAlg1 = None
 	if not hetp==None:
 		alg = [(v, alignment[v],0.9) for v in v0]
 		het0 = generate_heterogeneity(alg, v0, v1, hetp,hetr)
 		het1 = generate_heterogeneity(alg, v0, v1, hetp,hetr)
 		prevAlg0 = {t[1] : {t[0]: t[2]} for t in het0}
 		prevAlg1 = {t[0] : {t[1]: t[2]} for t in het1}
-	results = []
-
-	protocols = [p for p in range(int)]
-
-	iterations = outiter * initer
-
-	# results for each agent is: curve for each agent, number of convergence, and time
-	results = {ag : ([], [], []) for ag in agents}
-	resultsfin = {}
-	resultsconv = {}
-	distri = {"h" : 0.2, "l": 0.2, "u": 0.2, "j": 0.2, "n": 0.2, "p": 0.2, "t": 0.1, "g": 0.1, "a":0.1,"e":0.1,"f":0.1,"d":0.1}
-	distri4 = {"o": 0.1, "s":0.3, "x":0.3, "z":0.3}
-	distri8 = {"h" : 0.3, "l": 0.3, "u": 0.3, "j": 0.3, "n": 0.3, "p": 0.3, "t": 0.2, "g": 0.2}
-	for o in range(outiter):
-		patterns = [] 
-		for h in range(int):
-			# protT = protocol_generator(vocab, prot, bound, 0.1, mons, "{}{}".format(voc,prot)+str(h))
-			# # protT = protocol_generator(vocab, prot, bound, 0.1, mons, "{}{}".format(voc,prot)+str(h), vocabulary_dist = distri)
-			# js = protT.to_json()
-	
-			pattern = [0 for i in range(bound/2)] + [1 for i in range(bound-(bound/2))]		
-			random.shuffle(pattern)
-			patterns.append(pattern)
 
-		for ag in agents:
-			
-			allTemp0 = []
-			allTemp1 = []
-			timeTemp = []
-			conv = []
-			success0 = []
-			success1 = []
-			# if het:
-
-			for i in range(initer):
-				print "Agent {}".format(ag)
-				print "\n Iteration: {} : {}".format(o, i)
-
-				if ag=='simple':	
-					a0 = Simple(0, v0, param, dist={})
-					a1 = Simple(1, v1,  param, dist={})
-				if ag=='reasoner':	
-					a0 = Reasoner(0, v0, dist={})
-					a1 = Reasoner(1, v1, dist={})
-				if ag=='student':	
-					a0 = Student(0, v0)
-					a1 = Student(1, v1)
-				if ag=='studentcoop':	
-					a0 = StudentCoop(0, v0)
-					a1 = StudentCoop(1, v1)			
-				if ag=='studentcoopr':	
-					a0 = StudentCoopR(0, v0)
-					a1 = StudentCoopR(1, v1)				
-				if ag=='studentr':	
-					a0 = StudentR(0, v0)
-					a1 = StudentR(1, v1)
-
-				elif ag=='simplebound':	
-					a0 = SimpleBound(0, v0, mons, param, dist={})
-					a1 = SimpleBound(1, v1, mons, param, dist={})	
-				
-				elif ag=='simpleAg':	
-					a0 = Simple(0, v0)
-					a1 = Agent(1, v1)
-				elif ag=='reasonerAg':	
-					a0 = Reasoner(0, v0)
-					a1 = Agent(1, v1)			
-				elif ag=='studentAg':	
-					a0 = Student(0, v0)
-					a1 = Agent(1, v1)
-				elif ag=='studentrAg':	
-					a0 = StudentR(0, v0)
-					a1 = Agent(1, v1)	
-				elif ag=='simplemon':	
-					a0 = SimpleMon(0, v0)
-					a1 = SimpleMon(1, v1)
-				elif ag=='simplemonpos':	
-					a0 = SimpleMonPos(0, v0)
-					a1 = SimpleMonPos(1, v1)
-				elif ag=='simplemonneg':	
-					a0 = SimpleMonNeg(0, v0)
-					a1 = SimpleMonNeg(1, v1)
-				elif ag=='Logical':
-					a0 = Logical(0, v0)
-					a1 = Logical(1, v1)
-
-				elif ag in ['simple_alg','reasoner_alg','student_alg','studentr_alg','studentcoop_alg','studentcoopr_alg']:
-					if ag=='simple_alg':
-						ClAlAg = create_alg_class(Simple)
-					elif ag=='reasoner_alg':
-						ClAlAg = create_alg_class(Reasoner)
-					elif ag=='student_alg':
-						ClAlAg = create_alg_class(Student)
-					elif ag=='studentr_alg':
-						ClAlAg = create_alg_class(StudentR)
-					elif ag=='studentcoop_alg':
-						ClAlAg = create_alg_class(StudentCoop)
-					elif ag=='studentcoopr_alg':
-						ClAlAg = create_alg_class(StudentCoopR)
-
-					a0 = ClAlAg(0, v0, prevAlg0)
-					a1 = ClAlAg(1, v1, prevAlg1)
-
-				resultsTemp0 = []
-				resultsTemp1 = []
-				for j in range(int):
-					pattern = patterns[j]
-					if verbose:
-						print ""
-						print ""
-						print "Interaction {}".format(j)
-					p = protocols[j]
-					protocol0 = protocol_from_json('json/jsonPR-'+str(voc)+str(prot)+str(p))
-					# protocol0 = protocol_from_json('json/jsonPR-'+str(o)+str(voc)+str(prot)+str(p))
-					if verbose:
-						print protocol0
-					protocol1 = protocol_translator(protocol0, alignment)
-			
-					start_time = timeit.default_timer()
-					start_interaction(a0,a1,protocol0, protocol1, pattern)
-					
-					prect0,rect0 = precision_recall(a0.alignment, reverseAlg(alignment))
-					prect1,rect1 = precision_recall(a1.alignment, alignment)
-
-					# if 1:
-					if verbose:
-						print ""
-						print "Interaction {}".format(j)
-
-						if ag == "Logical":
-							print "possible a0: {}".format(len(a0.possible_alignments))
-							print "possible a1: {}".format(len(a1.possible_alignments))
-							print "len possible a0: {}".format(len(a0.possible_alignments))
-							print "len possible a1: {}".format(len(a1.possible_alignments))
-							
-						else:	
-							print "a0: p {} r {} ".format(prect0,rect0)
-							print "a1: p {} r {} ".format(prect1,rect1)
-						# print a1.alignment
-
-					resultsTemp0.append((prect0,rect0))
-					resultsTemp1.append((prect1,rect1))
-
-					if ag=='Logical':
-						cond = (len(a0.possible_alignments)==1 and len(a1.possible_alignments)==1)
-					elif ag== 'simpleAg' or ag== 'reasonerAg' or ag== 'studentAg' or ag== 'studentrAg':
-						cond = (prect0 ==1.0 and rect0 == 1.0)
-					else:
-						cond = (prect0 ==1.0 and rect0 == 1.0 and prect1 ==1.0 and rect1 == 1.0)
-
-					if cond:
-					# if prect0 ==1.0 and rect0 == 1.0 and prect1 ==1.0 and rect1 == 1.0 :
-					# if prect0 ==1.0 and rect0 == 1.0:
-						results[ag][2].append(j)
-						print j
-						for h in range(j+1, int):
-							resultsTemp0.append((1.0,1.0))
-							resultsTemp1.append((1.0,1.0))
-						break	
-							
-				if not cond:
-					results[ag][2].append(int*2)
-				# results[ag][0].append([fscore(t[0],t[1]) for t in resultsTemp0])		
-				# results[ag][1].append([fscore(t[0],t[1]) for t in resultsTemp1])
-				results[ag][1].append([fscore(t[0],t[1]) for t in resultsTemp0])		
-				results[ag][1].append([fscore(t[0],t[1]) for t in resultsTemp1])
-
-	for ag in agents:
-		print "Now results"
-		print "Agent {}".format(ag)
-		# results0 = [(sum([t[i][0] for t in results[ag][0]])/iterations, sum([t[i][1] for t in results[ag][0]])/iterations) for i in range(int)]
-		# results1 = [(sum([t[i][0] for t in results[ag][1]])/iterations, sum([t[i][1] for t in results[ag][1]])/iterations) for i in range(int)]
-		convfin = sum(results[ag][2])/float(len(results[ag][2]))
-	
-		# print "convergence: {}".format(results[ag][2])
-		print "av convergence: {}".format(convfin)
-		# print "time: {}".format(time)
-		# resultsfin[ag] = (results0, results1)
-		resultsfin[ag] = results[ag][1]
-
-		resultsconv[ag] = results[ag][2]
+	_experiment.clear()
+	_experiment.update(v0=v0, v1=v1, alignment=alignment, prevAlg0=prevAlg0, prevAlg1=prevAlg1, mons=mons, param=param,
+		name=str(voc)+str(prot), inters=int, bound=bound, seed=seed, store=store, token=CancelToken(experiment_budget),
+		budgeted=budgeted, interaction_budget=interaction_budget, expiry_policy=expiry_policy)
+	return _experiment
+
+def experiment_patterns(o):
+	""" The turn patterns of outer iteration o of the prepared experiment, derived from its seed if it has one """
+	e = _experiment
+	bound = e['bound']
+	shuffler = random
+	if e['seed'] != None:
+		shuffler = random.Random(derive_seed(e['seed'], 'patterns', o))
+	patterns = [] 
+	for h in range(e['inters']):
+		# protT = protocol_generator(vocab, prot, bound, 0.1, mons, "{}{}".format(voc,prot)+str(h))
+		# # protT = protocol_generator(vocab, prot, bound, 0.1, mons, "{}{}".format(voc,prot)+str(h), vocabulary_dist = distri)
+		# js = protT.to_json()
+
+		pattern = [0 for i in range(bound/2)] + [1 for i in range(bound-(bound/2))]		
+		shuffler.shuffle(pattern)
+		patterns.append(pattern)
+	return patterns
+
+def experiment_cell(ag, o, i, patterns):
+	""" The cell for run_cell, with its seed derived from the seed of the prepared experiment """
+	seed = _experiment['seed']
+	if seed != None:
+		seed = derive_seed(seed, ag, o, i)
+	return ag, o, i, patterns, seed
+
+class ExperimentRun(object):
+	""" A run of the learning experiment, in three steps: planning it (the constructor, which takes up the checkpoint
+		to resume if there is one), executing its cells (execute) and collecting the results (collect). See experimentAgents
+		for the arguments. A checkpoint records how the run keeps its results (sink, aggregate) and its seed,
+		and only a run that keeps them the same way, with the same seed, resumes it
+	"""
+
+	def __init__(self, outiter, initer, int, vocab, prot, agents, hetp=None, hetr=None, mons=0, param=0.3, corpus=None, interaction_budget=None, experiment_budget=None, expiry_policy='unsat', seed=None, checkpoint=None, resume=False, sink=None, aggregate=False):
+		self.outiter = outiter
+		self.initer = initer
+		self.int = int
+		self.vocab = vocab
+		self.prot = prot
+		self.agents = agents
+		self.hetp = hetp
+		self.hetr = hetr
+		self.mons = mons
+		self.param = param
+		self.expiry_policy = expiry_policy
+		self.checkpoint = checkpoint
+		self.experiment = (outiter, initer, int, sorted(vocab), prot, list(agents), hetp, hetr, mons, param, interaction_budget, expiry_policy)
+		self.mode = {'sink' : sink != None, 'aggregate' : bool(aggregate)}
+
+		restored = None
+		if resume and checkpoint != None and os.path.exists(checkpoint):
+			restored = load_checkpoint(checkpoint)
+			if restored['experiment'] != self.experiment:
+				raise NameError('The checkpoint {} is of another experiment'.format(checkpoint))
+			if restored.get('mode') != self.mode:
+				raise NameError('The checkpoint {} is of a run with {}, not {}'.format(checkpoint, describe_mode(restored.get('mode')), describe_mode(self.mode)))
+			if seed != None and seed != restored['seed']:
+				raise NameError('The checkpoint {} is of a run with seed {}, not {}'.format(checkpoint, restored['seed'], seed))
+			seed = restored['seed']
+		self.seed = seed
+
+		self.e = prepare_experiment(int, vocab, prot, hetp, hetr, mons, param, corpus, seed, interaction_budget, experiment_budget, expiry_policy)
+		# the experiment is cleared once the cells have run
+		self.budgeted = self.e['budgeted']
+		self.store = self.e['store']
+
+		# the outcomes of the cells run so far, in their order, and what a checkpoint needs to go on after the last one
+		self.finished = []
+		self.patterns_of = {}
+		self.snapshot = None
+		if restored != None:
+			self.finished = restored['outcomes']
+			o, patterns = restored['patterns']
+			self.patterns_of[o] = patterns
+			self.e['v0'][:], self.e['v1'][:] = restored['vocabularies']
+			self.e['prevAlg0'], self.e['prevAlg1'] = restored['heterogeneity']
+			random.setstate(restored['random'])
+			print "Resuming from {}: {} cells done".format(checkpoint, len(self.finished))
+		self.skip = len(self.finished)
+		self.cells_per_outer = len(agents) * initer
+
+		if isinstance(sink, basestring):
+			sink = ResultSink(sink, int, agents)
+		self.sink = sink
+		if sink != None:
+			# the sink may have cells that finished after the checkpoint, which will run again
+			for ag in agents:
+				sink.truncate(ag, len([outcome for outcome in self.finished if outcome[0] == ag]))
+
+		self.stats = None
+		if aggregate:
+			if restored != None:
+				self.stats = restored['aggregates']
+			else:
+				self.stats = {ag : CurveStats(int) for ag in agents}
+
+		self.expirations = {p : 0 for p in expiry_policies}
+		self.expired_checks = 0
+		self.processes = None
+		# results for each agent is: curve for each agent, number of convergence, and time
+		self.results = {ag : ([], [], []) for ag in agents}
+		for outcome in self.finished:
+			self.merge(outcome)
+
+	#**#**#**#**#**#**#**#**#**# Executing #**#**#**#**#**#**#**#**#**#
+
+	def cells(self):
+		k = 0
+		for o in range(self.outiter):
+			if k + self.cells_per_outer <= self.skip:
+				k += self.cells_per_outer
+				continue
+			if not o in self.patterns_of:
+				self.patterns_of[o] = experiment_patterns(o)
+			for ag in self.agents:
+				for i in range(self.initer):
+					if k >= self.skip:
+						yield experiment_cell(ag, o, i, self.patterns_of[o])
+					k += 1
+
+	def merge(self, outcome):
+		ag, curve0, curve1, converged, cell_expirations, cell_checks = outcome
+		if self.sink != None:
+			if curve0 != None:
+				self.sink.append(ag, curve0, curve1, converged)
+		elif self.stats == None:
+			self.results[ag][1].append(curve0)
+			self.results[ag][1].append(curve1)
+		if self.stats != None and curve0 != None:
+			self.stats[ag].add(curve0)
+			self.stats[ag].add(curve1)
+		self.results[ag][2].append(converged)
+		for p in expiry_policies:
+			self.expirations[p] += cell_expirations[p]
+		self.expired_checks += cell_checks
+
+	def save(self):
+		if self.checkpoint != None and self.snapshot != None:
+			state, vocabularies = self.snapshot
+			last = (len(self.finished) - 1) / self.cells_per_outer
+			save_checkpoint(self.checkpoint, {'experiment' : self.experiment, 'mode' : self.mode, 'seed' : self.seed, 'outcomes' : self.finished,
+				'patterns' : (last, self.patterns_of[last]), 'vocabularies' : vocabularies, 'heterogeneity' : (self.e['prevAlg0'], self.e['prevAlg1']),
+				'random' : state, 'aggregates' : self.stats})
+
+	def execute(self, processes=None, checkpoint_every=60):
+		""" Runs the cells that are not done, in this process or in a pool of processes (only for runs with a seed),
+			saving the checkpoint every checkpoint_every seconds and when it stops
+		"""
+		if processes != None and self.seed == None:
+			raise NameError('Only runs with a seed can run in processes')
+		self.processes = processes
+		e = self.e
+		prev_on_expiry = openprot.on_expiry
+		if self.budgeted:
+			openprot.on_expiry = 'unsat' if self.expiry_policy == 'unsat' else 'raise'
+
+		pool = None
+		try:
+			if processes == None:
+				outcomes = itertools.imap(run_cell, self.cells())
+			else:
+				pool = Pool(processes, initializer=init_cell_worker, initargs=(verbose,))
+				# in the order of the cells, so the results are merged as if they had run one after the other
+				outcomes = pool.imap(run_cell, self.cells())
+			saved_at = timeit.default_timer()
+			for outcome in outcomes:
+				self.merge(outcome)
+				if self.checkpoint != None:
+					if self.sink != None or self.stats != None:
+						# the curves are in the sink, or in the aggregates
+						outcome = (outcome[0], None, None) + tuple(outcome[3:])
+					self.finished.append(outcome)
+					# run serially, the cells after this one go on from this state. The aggregates only change
+					# when a cell is merged, so they are saved as they are when the checkpoint is written
+					self.snapshot = (random.getstate(), (list(e['v0']), list(e['v1'])))
+					if timeit.default_timer() - saved_at >= checkpoint_every:
+						self.save()
+						saved_at = timeit.default_timer()
+			if pool != None:
+				pool.close()
+		except:
+			if pool != None:
+				pool.terminate()
+			raise
+		finally:
+			self.save()
+			if self.sink != None:
+				self.sink.close()
+			if pool != None:
+				pool.join()
+			_experiment.clear()
+			if self.budgeted:
+				openprot.on_expiry = prev_on_expiry
+
+	#**#**#**#**#**#**#**#**#**# Collecting #**#**#**#**#**#**#**#**#**#
+
+	def collect(self, catalog=None):
+		""" The results of the run, resultsfin and resultsconv, as experimentAgents returns them.
+			A run with a sink is recorded in catalog (a Catalog or its path) if there is one
+		"""
+		if catalog != None and self.sink == None:
+			raise NameError('Only runs with a sink can be catalogued')
+		resultsfin = {}
+		resultsconv = {}
+		for ag in self.agents:
+			print "Now results"
+			print "Agent {}".format(ag)
+			convfin = sum(self.results[ag][2])/float(len(self.results[ag][2]))
+			print "av convergence: {}".format(convfin)
+			resultsfin[ag] = self.results[ag][1]
+			resultsconv[ag] = self.results[ag][2]
+
+		if self.sink != None:
+			stored, storedconv = load_results(self.sink.path)
+			resultsfin = {ag : stored[ag] for ag in self.agents}
+			resultsconv = {ag : storedconv[ag] for ag in self.agents}
+			if catalog != None:
+				if isinstance(catalog, basestring):
+					catalog = Catalog(catalog)
+				catalog.record(os.path.basename(os.path.normpath(self.sink.path)), self.sink.path, self.vocab, self.prot, self.agents, self.param,
+					self.hetp, self.hetr, self.mons, self.seed, self.outiter, self.initer, self.int)
+		if self.stats != None:
+			resultsfin = self.stats
+
+		if self.processes == None:
+			print "Protocol store: {}".format(self.store)
+		else:
+			print "Cells run in {} processes, seed {}".format(self.processes, self.seed)
+		if self.budgeted:
+			print "Expired interactions: {} answered unsat, {} retried, {} skipped ({} expired checks)".format(self.expirations['unsat'], self.expirations['retry'], self.expirations['skip'], self.expired_checks)
+		if openprot.sat_cache != None:
+			print "Satisfiability cache: {}".format(openprot.sat_cache)
+
+		return resultsfin, resultsconv
+
+def describe_mode(mode):
+	if mode == None:
+		return 'no record of how it keeps its results'
+	return 'sink={}, aggregate={}'.format(mode['sink'], mode['aggregate'])
+
+def experimentAgents(outiter, initer, int, vocab, prot, agents, hetp=None, hetr=None, mons = 0, param=0.3, verbosity=0, corpus=None, interaction_budget=None, experiment_budget=None, expiry_policy='unsat', processes=None, seed=None, checkpoint=None, checkpoint_every=60, resume=False, sink=None, catalog=None, aggregate=False):
+	""" Runs the learning experiment (planning, executing and collecting an ExperimentRun). Protocols are read from json/,
+		or from a packed corpus (a PackedCorpus or its path).
+		The checks of an interaction can take interaction_budget seconds, and those of the whole experiment experiment_budget;
+		expiry_policy says what happens to an interaction that runs out of time (see budgeted_interaction).
+		With processes, the cells (agent type, outer iteration, iteration) run in a pool of that many processes.
+		With a seed (one is drawn if processes is given) each cell starts from a seed derived from it,
+		so the results do not depend on the number of processes.
+		With a checkpoint path, the finished cells and the state of the random generator are saved there every
+		checkpoint_every seconds and when the run stops; with resume, a run starts again where its checkpoint left it.
+		With a sink (a ResultSink or the path of a result store) the curves are appended to it as the cells finish instead
+		of being kept, and the results returned map its files. The run replaces the cells its agent types had in the sink.
+		A run with a sink can be recorded in a catalog (a Catalog or its path), under the name of the sink's directory.
+		With aggregate, the curves of each agent type are added to a CurveStats (mean, variance and quantiles at each
+		interaction) as the cells finish, and resultsfin maps each agent type to it instead of its curves
+	"""
+	global verbose
+	verbose = verbosity
 
-	return resultsfin, resultsconv
+	if catalog != None and sink == None:
+		raise NameError('Only runs with a sink can be catalogued')
+	resuming = resume and checkpoint != None and os.path.exists(checkpoint)
+	if processes != None and seed == None and not resuming:
+		seed = random.randrange(2**32)
+	run = ExperimentRun(outiter, initer, int, vocab, prot, agents, hetp, hetr, mons, param, corpus, interaction_budget, experiment_budget, expiry_policy,
+		seed, checkpoint, resume, sink, aggregate)
+	run.execute(processes, checkpoint_every)
+	return run.collect(catalog)
+
+def save_checkpoint(path, state):
+	""" Writes the state of an experiment to path, compressed, through a temporary file so that a run stopped while it writes keeps the previous one """
+	tmp = path + '.tmp'
+	f = gzip.open(tmp, 'wb')
+	pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+	f.close()
+	os.rename(tmp, path)
+
+def load_checkpoint(path):
+	f = gzip.open(path, 'rb')
+	state = pickle.load(f)
+	f.close()
+	return state
+
+def write_results(res, resconv, exp, voc, prot, path='results/'):
+	""" Writes the results of experimentAgents as the python files the plots read: {exp}_v{voc}p{prot}.py and {exp}_conv_v{voc}p{prot}.py """
+	name = '{}_v{}p{}.py'.format(exp,voc,prot)
+	nameconv = '{}_conv_v{}p{}.py'.format(exp,voc,prot)
+	resjson = open(path + name, 'w+')
+	resjsonconv = open(path + nameconv, 'w+')
+
+	for r in res.keys():
+		resjson.write('a'+exp+r+str(voc)+str(prot)+' =')
+		resjson.write(json.dumps(res[r]))
+		resjson.write('\n')
+
+		resjsonconv.write('a'+exp+'conv_'+r+str(voc)+str(prot)+' = ')
+		resjsonconv.write(json.dumps(resconv[r]))
+		resjsonconv.write('\n')
+	resjson.close()
+	resjsonconv.close()
 
 #-#-#-#-#-#-#-#-#-#-#-#-#-#- EXAMPLES #-#-#-#-#-#-#-#-#-#-#-#-
 
@@ -0,0 +1,91 @@
+import numpy as np
+
+# The statistics of a set of curves of the same length at each interaction, kept as the curves arrive instead of the curves:
+# their count, mean and sum of squared deviations (updated as Welford does, and merged as Chan et al. do), and a histogram
+# of fixed bins over [low, high] from which quantiles are read, exact to a bin. Two CurveStats with the same bins merge
+# into the statistics of both sets of curves, so those of runs on different processes or hosts can be added up.
+# Memory is length x (bins + 4) numbers, whatever the number of curves
+
+
+class CurveStats(object):
+	""" Mean, variance and quantiles at each interaction of the curves added to it """
+
+	def __init__(self, length, bins=100, low=0.0, high=1.0):
+		self.length = length
+		self.bins = bins
+		self.low = low
+		self.high = high
+		self.count = 0
+		self.mean = np.zeros(length)
+		self.m2 = np.zeros(length)
+		self.minimum = np.full(length, np.inf)
+		self.maximum = np.full(length, -np.inf)
+		self.histogram = np.zeros((length, bins), dtype=np.int64)
+
+	def bin(self, values):
+		"""The bin of each value; values out of [low, high] count in the first or last bin"""
+		b = np.floor((values - self.low) / (self.high - self.low) * self.bins)
+		return np.clip(b, 0, self.bins - 1).astype(int)
+
+	def add(self, curve):
+		x = np.asarray(curve, dtype=float)
+		if x.shape != (self.length,):
+			raise NameError('Curve of length {} in statistics of length {}'.format(len(x), self.length))
+		self.count += 1
+		delta = x - self.mean
+		self.mean += delta / self.count
+		self.m2 += delta * (x - self.mean)
+		np.minimum(self.minimum, x, out=self.minimum)
+		np.maximum(self.maximum, x, out=self.maximum)
+		self.histogram[np.arange(self.length), self.bin(x)] += 1
+
+	def merge(self, other):
+		"""Adds the curves of other, a CurveStats with the same length and bins"""
+		if (other.length, other.bins, other.low, other.high) != (self.length, self.bins, self.low, self.high):
+			raise NameError('Cannot merge statistics of length {} and {} bins over [{}, {}] into ones of length {} and {} bins over [{}, {}]'.format(
+				other.length, other.bins, other.low, other.high, self.length, self.bins, self.low, self.high))
+		if other.count == 0:
+			return self
+		count = self.count + other.count
+		delta = other.mean - self.mean
+		self.mean = self.mean + delta * (other.count / float(count))
+		self.m2 = self.m2 + other.m2 + delta * delta * (self.count * other.count / float(count))
+		self.count = count
+		np.minimum(self.minimum, other.minimum, out=self.minimum)
+		np.maximum(self.maximum, other.maximum, out=self.maximum)
+		self.histogram += other.histogram
+		return self
+
+	def variance(self):
+		"""The sample variance at each interaction"""
+		if self.count < 2:
+			return np.zeros(self.length)
+		return self.m2 / (self.count - 1)
+
+	def std(self):
+		return np.sqrt(self.variance())
+
+	def quantile(self, q):
+		""" The q quantile at each interaction, interpolated within its bin (so within a bin of the exact one).
+			0 and 1 are the exact minimum and maximum
+		"""
+		if self.count == 0:
+			raise NameError('No curves to take quantiles of')
+		if q <= 0:
+			return self.minimum.copy()
+		if q >= 1:
+			return self.maximum.copy()
+		cumulative = self.histogram.cumsum(axis=1)
+		target = q * self.count
+		k = (cumulative < target).sum(axis=1)
+		rows = np.arange(self.length)
+		before = cumulative[rows, k] - self.histogram[rows, k]
+		inside = (target - before) / self.histogram[rows, k].astype(float)
+		value = self.low + (k + inside) * (self.high - self.low) / self.bins
+		return np.clip(value, self.minimum, self.maximum)
+
+	def median(self):
+		return self.quantile(0.5)
+
+	def __repr__(self):
+		return 'CurveStats({} curves of length {})'.format(self.count, self.length)
@@ -0,0 +1,139 @@
+import numpy as np
+
+
+class AlignmentRow(object):
+	"""The row of a foreign word, seen as the dictionary from local words to values that agents used to keep"""
+	__slots__ = ('matrix', 'i')
+
+	def __init__(self, matrix, i):
+		self.matrix = matrix
+		self.i = i
+
+	def __getitem__(self, v):
+		return float(self.matrix.values[self.i, self.matrix.local[v]])
+
+	def __setitem__(self, v, x):
+		self.matrix.values[self.i, self.matrix.local[v]] = x
+
+	def get(self, v, default=None):
+		if v in self.matrix.local:
+			return self[v]
+		return default
+
+	def __contains__(self, v):
+		return v in self.matrix.local
+
+	def __iter__(self):
+		return iter(self.matrix.words)
+
+	def __len__(self):
+		return len(self.matrix.words)
+
+	def keys(self):
+		return list(self.matrix.words)
+
+	def values(self):
+		return self.matrix.values[self.i].tolist()
+
+	def items(self):
+		return zip(self.matrix.words, self.values())
+
+	def iteritems(self):
+		return iter(self.items())
+
+	def __repr__(self):
+		return repr(dict(self.items()))
+
+
+class AlignmentMatrix(object):
+	""" An alignment as a foreign x local matrix of floats, with maps between words and indices.
+		alignment[foreign] is the row of foreign, used like the dictionary {local : value}
+	"""
+
+	def __init__(self, local):
+		self.words = list(local)
+		self.local = {v : j for j, v in enumerate(self.words)}
+		self.foreign = []
+		self.rows = {}
+		self.values = np.zeros((0, len(self.words)))
+
+	def __contains__(self, f):
+		return f in self.rows
+
+	def __iter__(self):
+		return iter(self.foreign)
+
+	def __len__(self):
+		return len(self.foreign)
+
+	def keys(self):
+		return list(self.foreign)
+
+	def __getitem__(self, f):
+		return AlignmentRow(self, self.rows[f])
+
+	def __setitem__(self, f, row):
+		"""Sets the row of f from a dictionary, with 0 for the local words it does not mention"""
+		if not f in self.rows:
+			self.rows[f] = len(self.foreign)
+			self.foreign.append(f)
+			self.values = np.vstack([self.values, np.zeros(len(self.words))])
+		i = self.rows[f]
+		self.values[i] = 0
+		for v, x in row.items():
+			self.values[i, self.local[v]] = x
+
+	def row(self, f):
+		"""The values of f, as a view of the matrix"""
+		return self.values[self.rows[f]]
+
+	def column(self, v):
+		return self.values[:, self.local[v]]
+
+	def normalize(self):
+		"""Makes every row that does not sum 0 sum 1"""
+		sums = self.values.sum(axis=1)
+		nonzero = sums != 0
+		self.values[nonzero] /= sums[nonzero, np.newaxis]
+
+	def punish(self, f, v, rate):
+		"""Takes rate times its value from the value of (f, v)"""
+		i, j = self.rows[f], self.local[v]
+		self.values[i, j] -= rate * self.values[i, j]
+
+	def reward(self, f, v, rate):
+		i, j = self.rows[f], self.local[v]
+		self.values[i, j] += rate * self.values[i, j]
+
+	def argmax(self):
+		"""For each foreign word, the index of its best local word, or -1 if there is a tie"""
+		if not self.foreign:
+			return np.zeros(0, dtype=int)
+		best = self.values.argmax(axis=1)
+		ties = (self.values == self.values.max(axis=1)[:, np.newaxis]).sum(axis=1) > 1
+		best[ties] = -1
+		return best
+
+	def best(self, f):
+		"""The best local word for f, None if there is a tie"""
+		row = self.row(f)
+		best = row.max()
+		if (row == best).sum() > 1:
+			return None
+		return self.words[row.argmax()]
+
+	def best_map(self):
+		"""The best local word for each foreign word, None when there is a tie"""
+		return {f : (self.words[j] if j >= 0 else None) for f, j in zip(self.foreign, self.argmax())}
+
+	def ranking(self, f, order):
+		"""The local words in order, sorted by decreasing value of f. Words with equal values end in reverse order"""
+		idx = np.array([self.local[v] for v in order], dtype=int)
+		ranked = np.argsort(self.row(f)[idx], kind='mergesort')[::-1]
+		return [order[k] for k in ranked]
+
+	def to_dict(self):
+		return {f : dict(self[f].items()) for f in self.foreign}
+
+	def __repr__(self):
+		return repr(self.to_dict())
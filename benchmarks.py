@@ -0,0 +1,47 @@
+import random
+import string
+import sys, getopt
+import timeit
+import openprot
+from openprot import protocol_generator
+
+
+def bench_generation(vocabulary, size, count, backend, incremental, seed=0):
+	""" Protocols generated per second with the given satisfiability backend """
+	openprot.set_sat_backend(backend)
+	random.seed(seed)
+	start = timeit.default_timer()
+	for i in range(count):
+		protocol_generator(vocabulary, size, len(vocabulary), 0.1, 0, "bench{}".format(i), incremental=incremental)
+	return count / (timeit.default_timer() - start)
+
+
+def main(argv):
+	vocab = 10
+	prot = 12
+	count = 50
+	modes = [("native", False), ("native", True)]
+
+	try:
+		opts, args = getopt.getopt(argv,"v:p:n:s",["vocabulary=","protocol=","number=","nusmv"])
+	except getopt.GetoptError:
+		print 'benchmarks.py -v vocabulary -p protocol -n number [-s]'
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt in ("-v", "--vocabulary"):
+			vocab = int(arg)
+		if opt in ("-p", "--protocol"):
+			prot = int(arg)
+		if opt in ("-n", "--number"):
+			count = int(arg)
+		if opt in ("-s", "--nusmv"):
+			modes.insert(0, ("nusmv", False))
+
+	voc = list(string.lowercase[:vocab])
+	print "Generating {} protocols with {} rules over {} words".format(count, prot, vocab)
+	for backend, incremental in modes:
+		rate = bench_generation(voc, prot, count, backend, incremental)
+		print "{:>8} {:>12}: {:10.1f} protocols/s".format(backend, "incremental" if incremental else "per rule", rate)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
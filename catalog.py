@@ -0,0 +1,127 @@
+import os
+import time
+import sqlite3
+import subprocess
+import hashlib
+from resultstore import load_results
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+# what a run is described by, and what can be queried
+COLUMNS = ['name', 'agent', 'vocab', 'prot', 'bound', 'param', 'hetp', 'hetr', 'mons', 'seed',
+			'outiter', 'initer', 'inters', 'version', 'store', 'created']
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS runs (
+	id INTEGER PRIMARY KEY,
+	name TEXT, agent TEXT, vocab INTEGER, prot INTEGER, bound INTEGER, param REAL, hetp REAL, hetr REAL, mons INTEGER,
+	seed INTEGER, outiter INTEGER, initer INTEGER, inters INTEGER, version TEXT, store TEXT, created REAL)"""
+
+INDEXES = [('runs_sizes', ['vocab', 'prot', 'agent']),
+			('runs_heterogeneity', ['hetp', 'hetr', 'agent']),
+			('runs_name', ['name'])]
+
+
+def code_version():
+	""" The commit of the code, with a + if it has changes, or a hash of the python files if it is not a git checkout """
+	try:
+		commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=__location__, stderr=subprocess.STDOUT).strip()
+		changed = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=__location__, stderr=subprocess.STDOUT).strip()
+		return commit + ('+' if changed else '')
+	except (OSError, subprocess.CalledProcessError):
+		h = hashlib.sha1()
+		for f in sorted(os.listdir(__location__)):
+			if f.endswith('.py'):
+				h.update(open(os.path.join(__location__, f), 'rb').read())
+		return 'files-' + h.hexdigest()
+
+
+class Catalog(object):
+	""" An sqlite index of the runs of experiments: one row per agent type of each run, with its parameters
+		and the result store that has its curves
+	"""
+
+	def __init__(self, path='results/catalog.db'):
+		self.path = path
+		self.db = sqlite3.connect(path)
+		self.db.row_factory = sqlite3.Row
+		self.db.execute(SCHEMA)
+		for name, columns in INDEXES:
+			self.db.execute("CREATE INDEX IF NOT EXISTS {} ON runs ({})".format(name, ', '.join(columns)))
+		self.db.commit()
+
+	def record(self, name, store, vocab, prot, agents, param=0.3, hetp=None, hetr=None, mons=0, seed=None, outiter=None, initer=None, inters=None, bound=None, version=None):
+		""" Records a run whose results are in the result store in path store. vocab is the size of the vocabulary
+			(or the vocabulary). Returns the ids of its rows
+		"""
+		if not isinstance(vocab, (int, long)):
+			vocab = len(vocab)
+		if bound == None:
+			bound = vocab + 2
+		if version == None:
+			version = code_version()
+		store = os.path.abspath(store)
+		ids = []
+		for ag in agents:
+			row = {'name' : name, 'agent' : ag, 'vocab' : vocab, 'prot' : prot, 'bound' : bound, 'param' : param, 'hetp' : hetp, 'hetr' : hetr,
+					'mons' : mons, 'seed' : seed, 'outiter' : outiter, 'initer' : initer, 'inters' : inters, 'version' : version,
+					'store' : store, 'created' : time.time()}
+			cur = self.db.execute("INSERT INTO runs ({}) VALUES ({})".format(', '.join(COLUMNS), ', '.join('?' for c in COLUMNS)),
+				[row[c] for c in COLUMNS])
+			ids.append(cur.lastrowid)
+		self.db.commit()
+		return ids
+
+	def find(self, order='id', **query):
+		""" The rows of the runs with the given parameters, e.g. find(vocab=10, prot=8, agent='reasoner', hetp=0.2).
+			A list or tuple matches any of its values, None matches runs without the parameter
+		"""
+		conditions = []
+		values = []
+		for column, value in sorted(query.items()):
+			if not column in COLUMNS:
+				raise NameError('Unknown parameter: {}'.format(column))
+			if value == None:
+				conditions.append("{} IS NULL".format(column))
+			elif isinstance(value, (list, tuple)):
+				conditions.append("{} IN ({})".format(column, ', '.join('?' for v in value)))
+				values.extend(value)
+			elif isinstance(value, float):
+				# parameters such as 0.2 are not always stored as the same double. A range, unlike abs, can use the indices
+				conditions.append("{} BETWEEN ? AND ?".format(column))
+				values.extend([value - 1e-9, value + 1e-9])
+			else:
+				conditions.append("{} = ?".format(column))
+				values.append(value)
+		if not order in ['id'] + COLUMNS:
+			raise NameError('Unknown parameter: {}'.format(order))
+		sql = "SELECT * FROM runs"
+		if conditions:
+			sql += " WHERE " + " AND ".join(conditions)
+		sql += " ORDER BY " + order
+		return [dict(r) for r in self.db.execute(sql, values)]
+
+	def load(self, **query):
+		""" The rows of find(**query), each with its curves and convergence indices ('curves' and 'conv', mapped from its store) """
+		stores = {}
+		rows = self.find(**query)
+		for row in rows:
+			if not row['store'] in stores:
+				stores[row['store']] = load_results(row['store'])
+			resultsfin, resultsconv = stores[row['store']]
+			row['curves'] = resultsfin.get(row['agent'])
+			row['conv'] = resultsconv.get(row['agent'])
+		return rows
+
+	def forget(self, **query):
+		"""Removes the rows of find(**query) from the catalog (their stores stay). Returns how many"""
+		ids = [r['id'] for r in self.find(**query)]
+		self.db.executemany("DELETE FROM runs WHERE id = ?", [(i,) for i in ids])
+		self.db.commit()
+		return len(ids)
+
+	def __len__(self):
+		return self.db.execute("SELECT count(*) FROM runs").fetchone()[0]
+
+	def close(self):
+		self.db.close()
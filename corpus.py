@@ -0,0 +1,160 @@
+import os
+import random
+import shutil
+import tempfile
+import json
+import mmap
+import struct
+from multiprocessing import Pool
+import openprot
+from openprot import Protocol, Existential, Relation, protocol_generator, protocol_from_json, derive_seed, replace_file, __location__
+
+
+#**#**#**#**#**#**#**#**#**# Parallel Generation #**#**#**#**#**#**#**#**#**#
+
+def _init_worker(scratch, backend):
+	"""Gives each worker process its own NuSMV scratch directory, NuSMV processes and cache connection"""
+	openprot.scratch_dir = os.path.join(scratch, str(os.getpid()))
+	os.mkdir(openprot.scratch_dir)
+	openprot.init_worker_process()
+	openprot.set_sat_backend(backend)
+
+def _generate(job):
+	vocabulary, size, length, prop_pos, mons, name, seed, path = job
+	random.seed(seed)
+	protocol_generator(vocabulary, size, length, prop_pos, mons, name).to_json(path)
+	return name
+
+def generate_corpus(vocabulary, size, count, prefix, length=None, prop_pos=0.1, mons=0, processes=None, seed=None, path='json/'):
+	""" Generates count protocols named prefix0 ... prefix(count-1) in parallel, and writes them to path.
+		Protocol i is generated from a seed derived from seed and i, so the corpus does not depend on the number of processes
+	"""
+	if length == None:
+		length = len(vocabulary)
+	if seed == None:
+		seed = random.randrange(2**32)
+	jobs = [(vocabulary, size, length, prop_pos, mons, prefix+str(i), derive_seed(seed, i), path) for i in range(count)]
+
+	scratch = tempfile.mkdtemp(prefix='corpus', dir=os.path.join(__location__, 'nusmvSpec'))
+	pool = Pool(processes, initializer=_init_worker, initargs=(scratch, openprot.sat_backend))
+	try:
+		names = list(pool.imap_unordered(_generate, jobs))
+		pool.close()
+	except:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+		shutil.rmtree(scratch, ignore_errors=True)
+	return sorted(names, key=lambda n: int(n[len(prefix):]))
+
+
+#**#**#**#**#**#**#**#**#**# Packed Corpora #**#**#**#**#**#**#**#**#**#
+
+# A packed corpus is one file:
+#   header   magic, number of protocols, rules and vocabulary entries, length of the string table
+#   strings  JSON with the words and the protocol names
+#   index    per protocol: first rule, number of rules, first vocabulary entry, number of entries
+#   voc      word ids
+#   rules    per rule: type, a, b, positivity, agent, agentr (-1 for the b side of existentials)
+# It is memory-mapped, so processes reading the same corpus share its pages
+
+MAGIC = 'PRCORP01'
+HEADER = struct.Struct('<8sIIII')
+ENTRY = struct.Struct('<IIII')
+WORD = struct.Struct('<i')
+RULE = struct.Struct('<6i')
+TYPES = ['existential', 'correlation', 'response', 'before', 'premise', 'immAfter']
+
+
+def pack_corpus(protocols, path):
+	"""Writes the protocols to a packed corpus in path"""
+	words = {}
+	def word_id(w):
+		return words.setdefault(w, len(words))
+
+	index = []
+	voc = []
+	rules = []
+	for p in protocols:
+		index.append((len(rules), len(p.rules), len(voc), len(p.vocabulary)))
+		voc.extend(word_id(v) for v in p.vocabulary)
+		for r in p.rules:
+			if isinstance(r, Relation):
+				rules.append((TYPES.index(r.type), word_id(r.a), word_id(r.b), int(r.pos), int(r.ag), int(r.agr)))
+			else:
+				rules.append((0, word_id(r.a), -1, int(r.pos), int(r.ag), -1))
+
+	table = sorted(words, key=words.get)
+	strings = json.dumps({'words' : table, 'names' : [p.name for p in protocols]})
+	f = tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.abspath(path)), prefix='.corpus', delete=False)
+	f.write(HEADER.pack(MAGIC, len(index), len(rules), len(voc), len(strings)))
+	f.write(strings)
+	for e in index:
+		f.write(ENTRY.pack(*e))
+	for w in voc:
+		f.write(WORD.pack(w))
+	for r in rules:
+		f.write(RULE.pack(*r))
+	f.close()
+	# other workers and hosts map it
+	replace_file(f.name, path)
+
+
+class PackedCorpus(object):
+	""" Read-only access to a packed corpus. corpus[i] and corpus.protocol(name) decode one protocol in O(its size) """
+
+	def __init__(self, path):
+		self.path = path
+		f = open(path, 'rb')
+		self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		f.close()
+		magic, self.size, nrules, nvoc, nstrings = HEADER.unpack_from(self.data, 0)
+		if magic != MAGIC:
+			raise NameError('Not a packed corpus: {}'.format(path))
+		strings = json.loads(self.data[HEADER.size:HEADER.size + nstrings])
+		self.words = [str(w) for w in strings['words']]
+		self.names = [str(n) for n in strings['names']]
+		self.positions = dict((n, i) for i, n in enumerate(self.names))
+		self.index_at = HEADER.size + nstrings
+		self.voc_at = self.index_at + self.size * ENTRY.size
+		self.rules_at = self.voc_at + nvoc * WORD.size
+
+	def __len__(self):
+		return self.size
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += self.size
+		if i < 0 or i >= self.size:
+			raise IndexError(i)
+		rule_start, rule_count, voc_start, voc_count = ENTRY.unpack_from(self.data, self.index_at + i * ENTRY.size)
+		voc = [self.words[WORD.unpack_from(self.data, self.voc_at + (voc_start + k) * WORD.size)[0]] for k in range(voc_count)]
+		rules = []
+		for k in range(rule_count):
+			t, a, b, pos, ag, agr = RULE.unpack_from(self.data, self.rules_at + (rule_start + k) * RULE.size)
+			if t == 0:
+				rules.append(Existential(self.words[a], pos, ag))
+			else:
+				rules.append(Relation(self.words[a], self.words[b], TYPES[t], pos, ag, agr))
+		return Protocol(voc, rules, self.names[i])
+
+	def __contains__(self, name):
+		return name in self.positions
+
+	def protocol(self, name):
+		"""The protocol that protocol_from_json would read from jsonPR-name"""
+		return self[self.positions[name]]
+
+	def close(self):
+		self.data.close()
+
+
+def pack_json(names, path, json_path='json/'):
+	"""Packs the protocols json_path/jsonPR-name into a corpus in path"""
+	pack_corpus([protocol_from_json(json_path+'jsonPR-'+n) for n in names], path)
+
+def unpack_json(corpus, path='json/'):
+	"""Writes every protocol of a packed corpus as a JSON file in path"""
+	for i in range(len(corpus)):
+		corpus[i].to_json(path)
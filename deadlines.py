@@ -0,0 +1,68 @@
+import timeit
+
+
+class Expired(Exception):
+	"""A check ran out of time or was cancelled"""
+	pass
+
+
+class CancelToken(object):
+	""" Cancels the checks that share it, when cancel is called or once its budget (in seconds) is spent.
+		A token with a parent also expires with it
+	"""
+
+	# how often (in seconds) a waiting check looks at the token
+	poll = 0.1
+
+	def __init__(self, budget=None, parent=None):
+		self.deadline = None
+		if budget != None:
+			self.deadline = timeit.default_timer() + budget
+		self.parent = parent
+		self.cancelled = False
+		self.expirations = 0
+
+	def cancel(self):
+		self.cancelled = True
+
+	def remaining(self):
+		"""Seconds left, None if there is no deadline"""
+		left = None
+		if self.deadline != None:
+			left = max(self.deadline - timeit.default_timer(), 0)
+		if self.parent != None:
+			up = self.parent.remaining()
+			if up != None and (left == None or up < left):
+				left = up
+		return left
+
+	def expired(self):
+		if self.cancelled or (self.parent != None and self.parent.expired()):
+			return True
+		return self.remaining() == 0
+
+	def wait(self):
+		"""How long to block before looking at the token again"""
+		left = self.remaining()
+		if left == None:
+			return self.poll
+		return min(left, self.poll)
+
+	def check(self):
+		"""Raises Expired if the token expired"""
+		if self.expired():
+			self.expire()
+
+	def expire(self):
+		token = self
+		while token != None:
+			token.expirations += 1
+			token = token.parent
+		raise Expired()
+
+
+def token_for(timeout=None, cancel=None):
+	"""The token a check has to respect: cancel, further limited to timeout seconds"""
+	if timeout == None:
+		return cancel
+	return CancelToken(timeout, cancel)
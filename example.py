@@ -1,5 +1,5 @@
 from agents import experimentAgents
-from openprot import protocol_generator
+from corpus import generate_corpus
 import string
 import sys
 import random
@@ -21,12 +21,13 @@ def main(argv):
 	prot = 4
 	verbosity = 0
 	agents = ['simple', 'reasoner']
+	processes = None
 	
 	global verbose
 	verbose = 0
 
 	try:
-		opts, args = getopt.getopt(argv,"v:p:b:",["vocabulary=","protocol=","verbosity="])
+		opts, args = getopt.getopt(argv,"v:p:b:j:",["vocabulary=","protocol=","verbosity=","processes="])
 	except getopt.GetoptError:
 		print '-v verbosity'
 		sys.exit(2)
@@ -41,6 +42,8 @@ def main(argv):
 				vocab = int(arg)
 			if opt in ("-p", "--protocol"):
 				prot = int(arg)
+			if opt in ("-j", "--processes"):
+				processes = int(arg)
 		print "Starting example"
 
 	voc = []
@@ -55,22 +58,20 @@ def main(argv):
 
 	print "Generating Protocols..."
 
-	for i in range(inters):
-		protT = protocol_generator(voc, prot, vocab, 0.1, 0, "{}{}{}".format(vocab,prot,str(i)))
-		js = protT.to_json()
+	generate_corpus(voc, prot, inters, "{}{}".format(vocab,prot))
 
 	print "Created {} protocols with {} rules each".format(inters, prot)
 
 	print "\n Now starting interactions."
 
-	resfin, resultsconv =  experimentAgents(1,reps,inters,voc,prot,agents, verbosity= verbose)
+	resfin, resultsconv =  experimentAgents(1,reps,inters,voc,prot,agents, verbosity= verbose, processes=processes, aggregate=True)
 
 	tline = [str(x) for x in range(inters)]
 	lines = ['b-','r-','y-','g-','b--','r--','y--','g--','b*-','r*-','y*-','g*-']
 	li = 0
 	for ag in agents:
-		# mean = [np.mean(np.array([ex[i] 			for ex in resfin[ag]])) for i in range(len(resfin[ag][0]))]
-		mean = [sum([ex[i] for ex in resfin[ag]])/float(len(resfin[ag])) for i in range(len(resfin[ag][0]))]
+		# the mean at each interaction of the curves of ag, aggregated as they were run
+		mean = resfin[ag].mean
 
 		ag1 = plt.plot(tline,mean, lines[li], label=ag)
 		li += 1
@@ -0,0 +1,222 @@
+import random
+import itertools
+import math
+
+
+class HypothesisSpace(object):
+	""" The alignments a Logical agent still considers possible: bijections alg between n local and n foreign words,
+		alg[j] being the foreign index of local word j (the tuples of itertools.permutations).
+		Kept as a domain of foreign indices per local word plus pairwise nogoods, instead of the list of all n! tuples
+	"""
+
+	# up to how many alignments (as bounded by bound) sample enumerates to choose exactly uniformly
+	exact = 1000
+	# up to how many words it is faster to filter all the permutations than to search
+	small = 6
+
+	def __init__(self, n):
+		self.n = n
+		self.domains = [set(range(n)) for j in range(n)]
+		self.nogoods = {}
+		self.changed()
+
+	def changed(self):
+		self.counted = {}
+		# all the possible alignments, once they have been listed
+		self.listed = None
+
+	def exclude(self, j, k):
+		"""Discards the alignments that map local j to foreign k"""
+		if k in self.domains[j]:
+			self.domains[j].discard(k)
+			self.changed()
+
+	def exclude_pair(self, j1, k1, j2, k2):
+		"""Discards the alignments that map local j1 to foreign k1 and local j2 to foreign k2"""
+		if (j1, k1) == (j2, k2):
+			return self.exclude(j1, k1)
+		if j1 == j2 or k1 == k2:
+			# no bijection does both
+			return
+		if (j2, k2) in self.nogoods.get((j1, k1), ()):
+			return
+		self.nogoods.setdefault((j1, k1), set()).add((j2, k2))
+		self.nogoods.setdefault((j2, k2), set()).add((j1, k1))
+		self.changed()
+
+	def allowed(self, j, k, alg):
+		"""Whether j can go to k given the partial alignment alg (None for the unassigned positions)"""
+		if not k in self.domains[j]:
+			return False
+		for (j2, k2) in self.nogoods.get((j, k), ()):
+			if alg[j2] == k2:
+				return False
+		return True
+
+	def matches(self, alg):
+		"""Whether the (complete) alignment alg is still possible"""
+		return all(self.allowed(j, alg[j], alg) for j in range(self.n))
+
+	def completable(self, alg):
+		""" Whether the free positions of alg can be matched to the unused foreign indices, each respecting its domain
+			and the nogoods with the assigned positions (a necessary condition for alg to be extended)
+		"""
+		used = set(k for k in alg if k != None)
+		free = [j for j in range(self.n) if alg[j] == None]
+		options = [[k for k in self.domains[j] if not k in used and self.allowed(j, k, alg)] for j in free]
+		owner = {}
+
+		def augment(i, seen):
+			for k in options[i]:
+				if not k in seen:
+					seen.add(k)
+					if not k in owner or augment(owner[k], seen):
+						owner[k] = i
+						return True
+			return False
+
+		for i in sorted(range(len(free)), key=lambda i : len(options[i])):
+			if not augment(i, set()):
+				return False
+		return True
+
+	def solutions(self):
+		"""The possible alignments, in the order of itertools.permutations"""
+		if self.n <= self.small:
+			for alg in itertools.permutations(range(self.n), self.n):
+				if self.matches(alg):
+					yield alg
+			return
+
+		alg = [None] * self.n
+		if not self.completable(alg):
+			return
+
+		def extend(j):
+			if j == self.n:
+				yield tuple(alg)
+				return
+			for k in sorted(self.domains[j]):
+				if not k in alg and self.allowed(j, k, alg):
+					alg[j] = k
+					if self.completable(alg):
+						for s in extend(j+1):
+							yield s
+					alg[j] = None
+
+		for s in extend(0):
+			yield s
+
+	def take(self, limit):
+		"""The first limit possible alignments. Remembers them if they are all"""
+		if self.listed != None:
+			return self.listed[:limit]
+		sols = list(itertools.islice(self.solutions(), limit))
+		if len(sols) < limit:
+			self.listed = sols
+		return sols
+
+	def count(self, limit=None):
+		"""How many alignments are possible, counting no further than limit"""
+		if self.listed != None:
+			return min(len(self.listed), limit or len(self.listed))
+		if not limit in self.counted:
+			c = 0
+			for s in self.solutions():
+				c += 1
+				if c == limit:
+					break
+			self.counted[limit] = c
+			if c != limit:
+				self.counted[None] = c
+		return self.counted[limit]
+
+	def first(self):
+		"""The first possible alignment (as in the list of permutations), None if there is none"""
+		for s in self.solutions():
+			return s
+		return None
+
+	def estimate(self, probes=50):
+		"""Estimated number of possible alignments (Knuth's estimator over random descents)"""
+		total = 0.0
+		for p in range(probes):
+			alg = [None] * self.n
+			weight = 1.0
+			for j in range(self.n):
+				options = [k for k in self.domains[j] if not k in alg and self.allowed(j, k, alg)]
+				if not options:
+					weight = 0.0
+					break
+				weight *= len(options)
+				alg[j] = random.choice(options)
+			if weight and not self.matches(alg):
+				weight = 0.0
+			total += weight
+		return total / probes
+
+	def bound(self):
+		"""An upper bound on the number of possible alignments from the sizes of the domains (Bregman's bound on the permanent)"""
+		b = 1.0
+		for d in self.domains:
+			if not d:
+				return 0
+			b *= math.factorial(len(d)) ** (1.0 / len(d))
+		return b
+
+	def random_alignment(self):
+		""" A possible alignment found by a depth-first search that tries the foreign words in random order, None if there is none.
+			Not uniform: the alignments the search reaches through fewer options are more likely
+		"""
+		alg = [None] * self.n
+		if not self.completable(alg):
+			return None
+
+		def extend(j):
+			if j == self.n:
+				return True
+			options = sorted(k for k in self.domains[j] if not k in alg and self.allowed(j, k, alg))
+			random.shuffle(options)
+			for k in options:
+				alg[j] = k
+				if self.completable(alg) and extend(j+1):
+					return True
+				alg[j] = None
+			return False
+
+		if extend(0):
+			return tuple(alg)
+		return None
+
+	def sample(self, steps=None):
+		""" A possible alignment chosen at random, None if there is none.
+			When bound allows at most exact alignments they are listed, and one is chosen uniformly.
+			Otherwise it is the end of a walk of steps (10 n^2 by default) that starts from random_alignment and swaps the images
+			of two words, undoing the swaps that leave no possible alignment. The walk keeps the uniform distribution, but it only
+			reaches the alignments connected to its start by such swaps (with nogoods, not always all of them) and may not run
+			long enough to forget where it started: the choice is biased towards the alignments close to random_alignment's
+		"""
+		if self.bound() <= self.exact:
+			sols = self.take(self.exact + 1)
+			if not sols:
+				return None
+			return random.choice(sols)
+
+		alg = self.random_alignment()
+		if alg == None:
+			return None
+		alg = list(alg)
+		if steps == None:
+			steps = 10 * self.n * self.n
+		if self.n < 2:
+			# no two words to swap
+			steps = 0
+		for s in range(steps):
+			j1, j2 = random.sample(range(self.n), 2)
+			alg[j1], alg[j2] = alg[j2], alg[j1]
+			if not (self.allowed(j1, alg[j1], alg) and self.allowed(j2, alg[j2], alg)):
+				alg[j1], alg[j2] = alg[j2], alg[j1]
+		return tuple(alg)
+
+	def __repr__(self):
+		return "HypothesisSpace({} words, {} nogoods)".format(self.n, sum(len(v) for v in self.nogoods.values()) / 2)
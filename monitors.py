@@ -0,0 +1,473 @@
+import itertools
+import threading
+import numpy as np
+
+
+#**#**#**#**#**#**#**#**#**# Words and Messages #**#**#**#**#**#**#**#**#**#
+
+# rules have a compact key (type, a, b, pos, ag, agr) of ints (see openprot.Rule), with the index of
+# their type in rule_types and the interned ids of their words
+rule_types = ['existential', 'correlation', 'response', 'before', 'premise', 'immAfter']
+
+word_ids = {}
+words = []
+words_lock = threading.Lock()
+
+def word_id(word):
+	""" The integer id of a word, interned the first time it is seen. Ids are only valid in this process """
+	i = word_ids.get(word)
+	if i == None:
+		with words_lock:
+			if not word in word_ids:
+				if isinstance(word, str):
+					word = intern(word)
+				word_ids[word] = len(words)
+				words.append(word)
+			i = word_ids[word]
+	return i
+
+def word_of(i):
+	return words[i]
+
+
+#**#**#**#**#**#**#**#**#**# Rule Monitors #**#**#**#**#**#**#**#**#**#
+
+# A monitor follows one rule over an interaction, one message at a time.
+# Its state is a small int, and DEAD once the rule can no longer be satisfied.
+# The semantics are the ones of the LTLSPEC emitted by rule2nusmv, evaluated on the
+# traces built by interaction2nusmv: begin, the messages, and end forever.
+
+DEAD = -1
+
+
+def message(agent, word):
+	"""The message agent says word, as an int: the word's id and the agent in its lowest bit"""
+	return 2 * word_id(word) + int(agent)
+
+def message_agent(m):
+	return m & 1
+
+def message_word_id(m):
+	return m >> 1
+
+def rule_messages(rule):
+	"""The messages a and b of a rule, read from its key (b is None for existentials)"""
+	t, a, b, pos, ag, agr = rule.key
+	if t == 0:
+		return 2 * a + ag, None
+	return 2 * a + ag, 2 * b + agr
+
+
+def message_index(rules, role):
+	"""Where each message appears as a or b (role): message -> (type, positivity) -> positions in rules"""
+	index = {}
+	for i, r in enumerate(rules):
+		t, pos = r.key[0], r.key[3]
+		if t == 0 and role == 'b':
+			continue
+		m = rule_messages(r)[role == 'b']
+		index.setdefault(m, {}).setdefault((rule_types[t], pos), []).append(i)
+	return index
+
+
+class Monitor(object):
+	"""Runtime monitor for a rule"""
+
+	def __init__(self, rule):
+		self.rule = rule
+		self.kind = rule_types[rule.key[0]]
+		self.pos = rule.key[3]
+		self.a, self.b = rule_messages(rule)
+		self.start = 0
+		self.step = getattr(self, '_{}{}'.format(self.kind, self.pos))
+
+	def messages(self):
+		if self.b != None:
+			return [self.a, self.b]
+		return [self.a]
+
+	def accepts(self, state):
+		"""Whether the rule holds if the interaction finishes in this state"""
+		if state == DEAD:
+			return False
+		if self.pos:
+			if self.kind == 'existential':
+				return state == 1
+			if self.kind == 'correlation':
+				return state != 1
+			if self.kind in ('response', 'immAfter'):
+				return state == 0
+		return True
+
+	def _existential1(self, state, m):
+		if m == self.a:
+			return 1
+		return state
+
+	def _existential0(self, state, m):
+		if m == self.a:
+			return DEAD
+		return state
+
+	def _correlation1(self, state, m):
+		if m == self.a:
+			state |= 1
+		if m == self.b:
+			state |= 2
+		return state
+
+	def _correlation0(self, state, m):
+		state = self._correlation1(state, m)
+		if state == 3:
+			return DEAD
+		return state
+
+	def _response1(self, state, m):
+		if m == self.a:
+			state = 1
+		if m == self.b:
+			state = 0
+		return state
+
+	def _response0(self, state, m):
+		if m == self.a:
+			state = 1
+		if m == self.b and state:
+			return DEAD
+		return state
+
+	# G (F b -> ! a) is the same property as G (a -> ! F b)
+	_before0 = _response0
+
+	def _before1(self, state, m):
+		if m == self.a:
+			state = 1
+		if m == self.b and not state:
+			return DEAD
+		return state
+
+	def _premise1(self, state, m):
+		if m == self.b and not state:
+			return DEAD
+		return int(m == self.a)
+
+	def _premise0(self, state, m):
+		if m == self.b and state:
+			return DEAD
+		return int(m == self.a)
+
+	def _immAfter1(self, state, m):
+		if state and m != self.b:
+			return DEAD
+		return int(m == self.a)
+
+	def _immAfter0(self, state, m):
+		if state and m == self.b:
+			return DEAD
+		return int(m == self.a)
+
+
+def advance(monitors, state, m):
+	"""Advances a vector of monitor states by one message. None if some rule dies"""
+	new = []
+	for mon, s in itertools.izip(monitors, state):
+		s = mon.step(s, m)
+		if s == DEAD:
+			return None
+		new.append(s)
+	return tuple(new)
+
+
+def accepting(monitors, state):
+	for mon, s in itertools.izip(monitors, state):
+		if not mon.accepts(s):
+			return False
+	return True
+
+
+def alphabet(monitors, actions):
+	"""The messages worth trying: the ones the rules mention, plus one that they do not"""
+	mentioned = set(m for mon in monitors for m in mon.messages())
+	letters = sorted(mentioned & actions)
+	others = actions - mentioned
+	if others:
+		letters.append(min(others))
+	return letters
+
+
+#**#**#**#**#**#**#**#**#**# Native Satisfiability #**#**#**#**#**#**#**#**#**#
+
+def native_sat(rules, vocabulary, bound, interaction=[], mode="partial"):
+	""" Decides the check_sat question in process, without calling NuSMV.
+		Explores the product of the rule monitors breadth first, continuing the interaction
+		with at most bound messages in total (partial), any finite number (nobound) or none (complete)
+	"""
+	actions = set(message(ag, v) for v in vocabulary for ag in [0,1])
+	monitors = [Monitor(r) for r in rules]
+	trace = [message(ag, w) for (ag, w) in interaction]
+
+	# NuSMV rejects models that mention undeclared messages
+	if not set(trace) <= actions or [m for mon in monitors for m in mon.messages() if not m in actions]:
+		return None
+	# and reports nothing when there is no LTLSPEC to check
+	if not monitors and mode != "nobound":
+		return False
+
+	state = tuple(mon.start for mon in monitors)
+	for m in trace:
+		state = advance(monitors, state, m)
+		if state is None:
+			return False
+
+	if mode == "complete":
+		return accepting(monitors, state)
+	if mode == "nobound":
+		depth = None
+	else:
+		depth = max(bound - len(trace), 0)
+
+	letters = alphabet(monitors, actions)
+	frontier = [state]
+	seen = set(frontier)
+	while frontier:
+		for s in frontier:
+			if accepting(monitors, s):
+				return True
+		if depth is not None:
+			if depth == 0:
+				return False
+			depth -= 1
+		new = []
+		for s in frontier:
+			for m in letters:
+				ns = advance(monitors, s, m)
+				if ns is not None and not ns in seen:
+					seen.add(ns)
+					new.append(ns)
+		frontier = new
+	return False
+
+
+def native_violations(rules, vocabulary, interaction):
+	""" The get_violations question in process: indices of the rules that the finished interaction breaks """
+	actions = set(message(ag, v) for v in vocabulary for ag in [0,1])
+	monitors = [Monitor(r) for r in rules]
+	trace = [message(ag, w) for (ag, w) in interaction]
+
+	if not set(trace) <= actions or [m for mon in monitors for m in mon.messages() if not m in actions]:
+		return None
+
+	res = []
+	for i, mon in enumerate(monitors):
+		s = mon.start
+		for m in trace:
+			s = mon.step(s, m)
+			if s == DEAD:
+				break
+		if s == DEAD or not mon.accepts(s):
+			res.append(i)
+	return res
+
+
+#**#**#**#**#**#**#**#**#**# Interaction Monitors #**#**#**#**#**#**#**#**#**#
+
+class TraceMonitor(Monitor):
+	"""Runtime monitor with the semantics of Rule.satisfied on finished interactions"""
+
+	def accepts(self, state):
+		if self.pos and self.kind == 'correlation':
+			return state in (0, 3)
+		return Monitor.accepts(self, state)
+
+	def _before1(self, state, m):
+		if m == self.b and not state:
+			return DEAD
+		if m == self.a:
+			return 1
+		return state
+
+	def _before0(self, state, m):
+		if m == self.b and state:
+			return DEAD
+		if m == self.a:
+			return 1
+		return state
+
+
+class InteractionMonitor(object):
+	""" The state of every rule along an interaction, advanced one message at a time.
+		Answers which rules are broken, now or after one more message, in O(rules)
+	"""
+
+	def __init__(self, rules):
+		self.rules = rules
+		self.monitors = [TraceMonitor(r) for r in rules]
+		self.state = [mon.start for mon in self.monitors]
+		self.interaction = []
+		# rules that do not hold now, and rules that each message can change
+		self.unhappy = set(i for i, mon in enumerate(self.monitors) if not mon.accepts(self.state[i]))
+		self.watch = {}
+		for role in ['a', 'b']:
+			for m, buckets in message_index(rules, role).items():
+				for positions in buckets.values():
+					self.watch.setdefault(m, set()).update(positions)
+
+	def append(self, agent, word):
+		m = message(agent, word)
+		for i, mon in enumerate(self.monitors):
+			if self.state[i] != DEAD:
+				self.state[i] = mon.step(self.state[i], m)
+				if mon.accepts(self.state[i]):
+					self.unhappy.discard(i)
+				else:
+					self.unhappy.add(i)
+		self.interaction.append((agent, word))
+
+	def extend(self, interaction):
+		for (agent, word) in interaction:
+			self.append(agent, word)
+
+	def follows(self, interaction):
+		"""Whether interaction continues the monitored one"""
+		n = len(self.interaction)
+		return n <= len(interaction) and interaction[:n] == self.interaction
+
+	def broken(self):
+		"""Rules that the interaction does not satisfy"""
+		return [self.rules[i] for i in sorted(self.unhappy)]
+
+	def would_break(self, agent, word):
+		"""Rules that the interaction would not satisfy after agent says word.
+		Only the rules about the message, or not holding now, can change their verdict"""
+		m = message(agent, word)
+		res = []
+		for i in sorted(self.unhappy.union(self.watch.get(m, ()))):
+			mon = self.monitors[i]
+			s = self.state[i]
+			if s != DEAD:
+				s = mon.step(s, m)
+			if not mon.accepts(s):
+				res.append(self.rules[i])
+		return res
+
+	def violations(self, agent, words):
+		""" Which rules would be broken if agent said each of the words next, in one vectorized pass.
+			Returns a len(words) x len(rules) boolean matrix, row i being would_break(agent, words[i])
+		"""
+		agent = int(agent)
+		ids = dict((word_id(w), i) for i, w in enumerate(words))
+		n = len(self.monitors)
+		a = np.array([ids.get(message_word_id(mon.a), -1) if message_agent(mon.a) == agent else -1 for mon in self.monitors], dtype=int)
+		b = np.array([ids.get(message_word_id(mon.b), -1) if mon.b != None and message_agent(mon.b) == agent else -1 for mon in self.monitors], dtype=int)
+		kind = np.array([KINDS[(mon.kind, mon.pos)] for mon in self.monitors], dtype=int)
+		state = np.array(self.state, dtype=int)
+
+		w = np.arange(len(words))[:, None]
+		is_a = (w == a[None, :])
+		is_b = (w == b[None, :])
+		s = np.broadcast_to(state[None, :], (len(words), n))
+		corr = s | is_a | (2 * is_b)
+		cases = {
+			KINDS[('existential', 1)] : (s != 1) & ~is_a,
+			KINDS[('existential', 0)] : is_a,
+			KINDS[('correlation', 1)] : (corr != 0) & (corr != 3),
+			KINDS[('correlation', 0)] : corr == 3,
+			KINDS[('response', 1)] : ~is_b & (is_a | (s == 1)),
+			KINDS[('response', 0)] : is_b & (is_a | (s == 1)),
+			KINDS[('before', 1)] : is_b & (s == 0),
+			KINDS[('before', 0)] : is_b & (s == 1),
+			KINDS[('premise', 1)] : is_b & (s == 0),
+			KINDS[('premise', 0)] : is_b & (s == 1),
+			KINDS[('immAfter', 1)] : is_a | ((s == 1) & ~is_b),
+			KINDS[('immAfter', 0)] : is_b & (s == 1),
+		}
+		res = (s == DEAD)
+		for k, broken in cases.items():
+			res = res | ((kind == k)[None, :] & broken)
+		return res
+
+
+KINDS = dict(((t, p), 2*i + p) for i, t in enumerate(['existential', 'correlation', 'response', 'before', 'premise', 'immAfter']) for p in [0, 1])
+
+
+#**#**#**#**#**#**#**#**#**# Incremental Satisfiability #**#**#**#**#**#**#**#**#**#
+
+class IncrementalSat(object):
+	""" Satisfiability of a growing set of rules, as protocol_generator needs it (partial mode, no interaction).
+		Keeps an interaction that satisfies the accepted rules and the transitions explored in their product,
+		so that a candidate is first tried on the witness and otherwise only adds its own monitor to the search
+	"""
+
+	def __init__(self, vocabulary, bound):
+		self.actions = set(message(ag, v) for v in vocabulary for ag in [0,1])
+		self.bound = bound
+		self.rules = []
+		self.monitors = []
+		self.witness = []
+		self.succ = {}
+		self.last = None
+		self.checks = 0
+		self.witness_hits = 0
+
+	def _next(self, state, m):
+		nxt = self.succ.setdefault(state, {})
+		if not m in nxt:
+			nxt[m] = advance(self.monitors, state, m)
+		return nxt[m]
+
+	def check(self, rule):
+		"""Whether the accepted rules and rule can hold together, like check_sat on all of them"""
+		self.checks += 1
+		mon = Monitor(rule)
+		if [m for m in mon.messages() if not m in self.actions]:
+			return None
+
+		s = mon.start
+		for m in self.witness:
+			s = mon.step(s, m)
+			if s == DEAD:
+				break
+		if mon.accepts(s):
+			self.witness_hits += 1
+			self.last = (rule, mon, self.witness)
+			return True
+
+		letters = alphabet(self.monitors + [mon], self.actions)
+		start = (tuple(m.start for m in self.monitors), mon.start)
+		parent = {start : None}
+		frontier = [start]
+		for depth in range(self.bound + 1):
+			for pair in frontier:
+				if mon.accepts(pair[1]) and accepting(self.monitors, pair[0]):
+					witness = []
+					while parent[pair] != None:
+						pair, m = parent[pair]
+						witness.append(m)
+					witness.reverse()
+					self.last = (rule, mon, witness)
+					return True
+			if depth == self.bound:
+				break
+			new = []
+			for pair in frontier:
+				for m in letters:
+					cs = mon.step(pair[1], m)
+					if cs == DEAD:
+						continue
+					ns = self._next(pair[0], m)
+					if ns != None and not (ns, cs) in parent:
+						parent[(ns, cs)] = (pair, m)
+						new.append((ns, cs))
+			frontier = new
+		return False
+
+	def add(self, rule):
+		"""Accepts a rule that check found possible"""
+		if self.last == None or self.last[0] is not rule:
+			if not self.check(rule):
+				raise NameError('Adding an impossible rule: {}'.format(rule))
+		rule, mon, self.witness = self.last
+		self.rules.append(rule)
+		self.monitors.append(mon)
+		self.succ = {}
+		self.last = None
@@ -0,0 +1,186 @@
+import os
+import re
+import pty
+import select
+import subprocess
+import threading
+import Queue
+import atexit
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+NUSMV = os.path.join(__location__, 'NuSMV')
+OPTIONS = ['-coi', '-df', '-dynamic', '-dcx']
+# where the workers write their models, unless they are given another directory (see openprot.scratch_dir)
+SCRATCH = os.path.join(__location__, 'nusmvSpec')
+# the lines with which NuSMV reports an error (the specs and their counterexamples may say error or violation anywhere)
+ERRORS = re.compile(r'^\s*(\*\*\* ERROR|file .*: line \d+:)')
+
+
+class WorkerDied(Exception):
+	pass
+
+
+class NuSMVWorker(object):
+	"""A long-lived NuSMV process driven in interactive mode"""
+
+	def __init__(self, wid, scratch=SCRATCH):
+		self.wid = wid
+		self.proc = None
+		self.out = None
+		self.buffer = ""
+		self.checks = 0
+		self.loaded = False
+		self.restarts = -1
+		self.model = os.path.join(scratch, 'worker{}-{}.smv'.format(os.getpid(), wid))
+
+	def alive(self):
+		return self.proc != None and self.proc.poll() == None
+
+	def start(self):
+		"""(Re)starts the NuSMV process"""
+		self.stop()
+		# NuSMV only flushes its output line by line on a terminal
+		master, slave = pty.openpty()
+		self.proc = subprocess.Popen([NUSMV, '-int'] + OPTIONS, stdin=subprocess.PIPE, stdout=slave, stderr=slave, cwd=__location__, close_fds=True)
+		os.close(slave)
+		self.out = master
+		self.buffer = ""
+		self.loaded = False
+		self.restarts += 1
+
+	def stop(self):
+		if self.proc != None:
+			try:
+				self.proc.stdin.write("quit\n")
+				self.proc.stdin.close()
+			except (IOError, OSError):
+				pass
+			if self.proc.poll() == None:
+				self.proc.kill()
+			self.proc.wait()
+			self.proc = None
+		if self.out != None:
+			os.close(self.out)
+			self.out = None
+
+	def command(self, commands, cancel=None):
+		"""Sends the commands and returns what NuSMV printed until it ran all of them.
+			If the cancel token expires first the process is stopped and Expired raised
+		"""
+		self.checks += 1
+		sentinel = "__done_{}__".format(self.checks)
+		try:
+			self.proc.stdin.write("\n".join(commands + ["echo " + sentinel]) + "\n")
+			self.proc.stdin.flush()
+		except (IOError, OSError):
+			raise WorkerDied()
+
+		lines = []
+		while True:
+			while not "\n" in self.buffer:
+				if cancel != None:
+					if cancel.expired():
+						self.stop()
+						cancel.expire()
+					if not select.select([self.out], [], [], cancel.wait())[0]:
+						continue
+				else:
+					select.select([self.out], [], [])
+				try:
+					chunk = os.read(self.out, 65536)
+				except OSError:
+					chunk = ""
+				if not chunk:
+					raise WorkerDied()
+				self.buffer += chunk.replace("\r", "")
+			line, self.buffer = self.buffer.split("\n", 1)
+			if line.rstrip().endswith(sentinel):
+				return "\n".join(lines)
+			lines.append(line)
+
+	def check(self, module, cancel=None):
+		"""Runs the reset/read/check cycle on a model. Returns (err, output) like call_nusmv"""
+		if not self.alive():
+			self.start()
+		f = open(self.model, 'w')
+		f.write(module)
+		f.close()
+		commands = ["read_model -i {}".format(self.model), "flatten_hierarchy", "encode_variables", "build_model", "check_ltlspec"]
+		if self.loaded:
+			commands.insert(0, "reset")
+		nr = self.command(commands, cancel)
+		self.loaded = True
+		err = int(any(ERRORS.match(line) for line in nr.split("\n")))
+		return err, nr
+
+
+class NuSMVPool(object):
+	"""A pool of NuSMV workers that can be shared between threads. They write their models in scratch"""
+
+	def __init__(self, size=2, scratch=SCRATCH):
+		self.size = size
+		self.scratch = scratch
+		self.workers = [NuSMVWorker(i, scratch) for i in range(size)]
+		self.idle = Queue.Queue()
+		for w in self.workers:
+			self.idle.put(w)
+
+	def check(self, module, cancel=None):
+		"""Checks a model in the first idle worker, restarting it if it died"""
+		worker = self.idle.get()
+		try:
+			try:
+				return worker.check(module, cancel)
+			except WorkerDied:
+				worker.start()
+				return worker.check(module, cancel)
+		except WorkerDied:
+			worker.stop()
+			return 1, ""
+		finally:
+			self.idle.put(worker)
+
+	def restarts(self):
+		return sum(max(w.restarts, 0) for w in self.workers)
+
+	def close(self):
+		for w in self.workers:
+			w.stop()
+			if os.path.exists(w.model):
+				os.remove(w.model)
+
+
+_lock = threading.Lock()
+_pool = None
+
+def get_pool():
+	return _pool
+
+def set_pool(size, scratch=SCRATCH):
+	""" Starts a pool of size NuSMV workers writing their models in scratch, or stops the current one if size is 0 """
+	global _pool
+	with _lock:
+		if _pool != None:
+			_pool.close()
+			_pool = None
+		if size:
+			_pool = NuSMVPool(size, scratch)
+	return _pool
+
+def reset_pool(scratch=SCRATCH):
+	""" In a forked process: leaves the NuSMV workers inherited from the parent to it, and starts a pool of the same size
+		writing its models in scratch
+	"""
+	global _pool, _lock
+	_lock = threading.Lock()
+	size = 0
+	if _pool != None:
+		size = _pool.size
+	_pool = None
+	return set_pool(size, scratch)
+
+@atexit.register
+def _close():
+	set_pool(0)
@@ -10,6 +10,15 @@ import subprocess
 import collections
 import timeit
 import math
+import tempfile
+import hashlib
+import select
+import weakref
+from monitors import native_sat, native_violations, InteractionMonitor, IncrementalSat, message, message_index, rule_types, word_id, word_of, words
+import nusmvpool
+from deadlines import Expired, CancelToken, token_for
+from satcache import SatCache
+from alignments import AlignmentMatrix
 
 __location__ = os.path.realpath(
     os.path.join(os.getcwd(), os.path.dirname(__file__)))
@@ -24,26 +33,102 @@ class Protocol(object):
 		self.vocabulary = vocabulary
 		self.rules = rules
 		self.name = name
+		self.build_index()
 
 	def __str__(self):
 		return "Language: "+ self.vocabulary.__str__()+"\n Rules:  "+ self.rules.__str__()
 	def __repr__(self):
 		return "Language: "+ self.vocabulary.__repr__()+"\n Rules:  "+ self.rules.__repr__()
 
+	def build_index(self):
+		"""Indexes the rules by the (agent, word) pairs they have as a or b, and by type and positivity"""
+		self.index_a = message_index(self.rules, 'a')
+		self.index_b = message_index(self.rules, 'b')
+
+	def indexed(self, role, agent, word, types=None, pos=None):
+		"""Rules where (agent, word) is role ('a' or 'b'), in protocol order"""
+		if role == 'a':
+			buckets = self.index_a.get(message(agent, word), {})
+		else:
+			buckets = self.index_b.get(message(agent, word), {})
+		positions = []
+		for (t, p) in buckets.keys():
+			if (types == None or t in types) and (pos == None or p == pos):
+				positions.extend(buckets[(t, p)])
+		return [self.rules[i] for i in sorted(positions)]
+
+	def monitor_for(self, interaction):
+		"""Monitor of the non-monotonic rules, advanced to the end of the interaction.
+		Reused as long as the interactions asked about keep extending the same one"""
+		monitor = protocol_monitors.get(self)
+		if monitor == None or not monitor.follows(interaction):
+			monitor = InteractionMonitor([r for r in self.rules if not isMonotone(r)])
+			protocol_monitors[self] = monitor
+		monitor.extend(interaction[len(monitor.interaction):])
+		return monitor
+
 	def to_json(self, path = 'json/'):
-		f = open(path+'jsonPR-'+self.name, 'w+')		
+		"""Writes the protocol to path/jsonPR-name. Readers see the old file or the complete new one"""
+		f = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path+'jsonPR-') or '.', prefix='.jsonPR-', delete=False)
 		f.write(json.dumps(self, cls=MyJSONEncoder))
 		f.close()
+		replace_file(f.name, path+'jsonPR-'+self.name)
+
+class Rule(object):
+	""" Rules are immutable values. key is their compact form: a tuple of ints (type, a, b, pos, ag, agr)
+		with interned word ids, -1 for the fields an existential does not have. Equal rules have equal keys
+	"""
+	__slots__ = ('pos', 'a', 'ag', 'key', 'hash')
+
+	def __init__(self, positivity, a, agent):
+		self._set('pos', int(positivity))
+		self._set('a', intern(a) if isinstance(a, str) else a)
+		self._set('ag', int(agent))
+
+	def _set(self, field, value):
+		object.__setattr__(self, field, value)
 
-class Rule:
-	def __init__(self, positivity):
-		self.pos = positivity
+	def _set_key(self, key):
+		self._set('key', key)
+		self._set('hash', hash(key))
+
+	def __setattr__(self, field, value):
+		raise AttributeError("rules are immutable")
+
+	def __eq__(self, rule):
+		return isinstance(rule, Rule) and self.key == rule.key
+
+	def __ne__(self, rule):
+		return not self == rule
+
+	def __hash__(self):
+		return self.hash
+
+	def __reduce__(self):
+		return (self.__class__, self.args())
+
+	def is_equal(self, rule):
+		return self == rule
+
+def rule_from_key(key):
+	""" The rule with compact form key """
+	t, a, b, pos, ag, agr = key
+	if t == 0:
+		return Existential(word_of(a), pos, ag)
+	return Relation(word_of(a), word_of(b), rule_types[t], pos, ag, agr)
 
 class Existential(Rule):
+	__slots__ = ()
+
 	def __init__(self, term, positivity, agent):
-		Rule.__init__(self,positivity)
-		self.a = term
-		self.ag = agent
+		Rule.__init__(self, positivity, term, agent)
+		self._set_key((0, word_id(self.a), -1, self.pos, self.ag, -1))
+
+	def args(self):
+		return (self.a, self.pos, self.ag)
+
+	def to_dict(self):
+		return {'pos' : self.pos, 'a' : self.a, 'ag' : self.ag}
 
 	def satisfied(self, interaction):
 		if self.pos==0:
@@ -62,11 +147,6 @@ class Existential(Rule):
 	def inverse(self):
 		return Existential(self.a, 1-self.pos, self.ag)
 
-	def is_equal(self, rule):
-		# print self 
-		# print rule
-		return isinstance(rule,Existential) and self.a==rule.a and self.pos==rule.pos and str(self.ag)==str(rule.ag)
-
 
 	def __str__(self):
 		return "Existential('{}',{},{})".format(self.a, self.pos, self.ag)
@@ -76,14 +156,20 @@ class Existential(Rule):
 
 
 class Relation(Rule):
+	__slots__ = ('b', 'type', 'agr')
 
 	def __init__(self, a, b, type, positivity, agent,  agentr):
-		Rule.__init__(self,positivity)
-		self.a = a
-		self.b = b	
-		self.type = type
-		self.ag = agent
-		self.agr = agentr
+		Rule.__init__(self, positivity, a, agent)
+		self._set('b', intern(b) if isinstance(b, str) else b)
+		self._set('type', intern(type))
+		self._set('agr', int(agentr))
+		self._set_key((rule_types.index(self.type), word_id(self.a), word_id(self.b), self.pos, self.ag, self.agr))
+
+	def args(self):
+		return (self.a, self.b, self.type, self.pos, self.ag, self.agr)
+
+	def to_dict(self):
+		return {'pos' : self.pos, 'a' : self.a, 'b' : self.b, 'type' : self.type, 'ag' : self.ag, 'agr' : self.agr}
 
 	def inverse(self):
 		return Relation(self.a, self.b, self.type, 1-self.pos, self.ag,  self.agr)
@@ -97,33 +183,24 @@ class Relation(Rule):
 				return ((not (self.ag, self.a) in interaction) and (not (self.agr, self.b) in interaction)) or ((self.ag, self.a) in interaction and (self.agr, self.b) in interaction)
 		
 		elif self.type=='before':
-			if self.pos==1:
-				for i in range(len(interaction)):
-					if interaction[i]== (self.agr, self.b):
-						if not (self.ag, self.a) in interaction[:i]:
-							return False
-				return True			
-		
-			else: 
-				for i in range(len(interaction)):
-					if interaction[i] == (self.agr, self.b):
-						if (self.ag, self.a) in interaction[:i]:
-							return False
-				return True
+			# whether a was said before the current message
+			said_a = False
+			for m in interaction:
+				if m == (self.agr, self.b) and said_a != (self.pos==1):
+					return False
+				if m == (self.ag, self.a):
+					said_a = True
+			return True
 
 		elif self.type=='response':
-			if self.pos==1:
-				for i in range(len(interaction)):
-					if interaction[i] == (self.ag, self.a):
-						if not (self.agr, self.b) in interaction[i:]:
-							return False
-				return True			
-			else: 
-				for i in range(len(interaction)):
-					if interaction[i] == (self.ag, self.a):
-						if (self.agr, self.b) in interaction[i:]:
-							return False
-				return True
+			# whether b is said from the current message on
+			said_b = False
+			for m in reversed(interaction):
+				if m == (self.agr, self.b):
+					said_b = True
+				if m == (self.ag, self.a) and said_b != (self.pos==1):
+					return False
+			return True
 
 		if self.type=='premise':
 			if self.pos==1:
@@ -161,16 +238,6 @@ class Relation(Rule):
 			print "Incomplete alignment"
 			return
 
-	def is_equal(self, rule):
-		# print "isinstance {}".format(isinstance(rule, Relation))
-		# print "a: {},{}, ? {}".format(self.a, rule.a, self.a == rule.a)
-		# print "b: {},{}, ? {}".format(str(self.b), str(rule.b), str(self.b) == str(rule.b))
-		# print "type: {},{}, ? {}".format(self.type, rule.type, self.type == rule.type)
-		# print "ag: {},{}, ? {}".format(self.ag, rule.ag, str(self.ag) == str(rule.ag))
-		# print "agr: {},{}, ? {}".format(self.agr, rule.agr, str(self.agr) == str(rule.agr))
-		# print rule
-		return isinstance(rule, Relation) and self.type==self.type and self.a==rule.a and self.b==rule.b and self.pos==rule.pos and str(self.ag)==str(rule.ag) and str(self.agr)==str(rule.agr)
-
 	def __str__(self):
 		return "Relation('{}','{}','{}',{},{},{})".format(self.a, self.b, self.type, self.pos, self.ag, self.agr)
 
@@ -181,8 +248,12 @@ class Relation(Rule):
 
 #**#**#**#**#**#**#**#**#**# Generators #**#**#**#**#**#**#**#**#**#
 
-def protocol_generator(vocabulary, size, length, prop_pos, mons, name, vocabulary_dist = {}, dist_neg = {}):
-	""" Generates a random protocol with given size and proportion of positive rules """
+def protocol_generator(vocabulary, size, length, prop_pos, mons, name, vocabulary_dist = {}, dist_neg = {}, incremental=None):
+	""" Generates a random protocol with given size and proportion of positive rules.
+		If incremental (by default, with the native backend) candidates are checked against the rules accepted so far
+	"""
+	if incremental == None:
+		incremental = (sat_backend == "native")
 
 	size_pos = int(math.ceil(prop_pos * size))
 	size_oth = size - size_pos
@@ -202,40 +273,41 @@ def protocol_generator(vocabulary, size, length, prop_pos, mons, name, vocabular
 
 	while failed:
 		rules_pos = []
+		solver = None
+		if incremental:
+			solver = IncrementalSat(vocabulary, length)
 		if mons:
-			choices_pos = generate_pos_mons(vocex, int(len(vocabulary)/8) + 1)
+			choices_pos = RuleSampler(space_pos_mons(vocex))
 		else:
-			choices_pos = generate_pos(vocex, int(len(vocabulary)/8) + 1)
+			choices_pos = RuleSampler(space_pos(vocex))
 		size_pos = min(len(choices_pos),size_pos)
 		size_oth = size - size_pos
 		if mons:
-			choices_oth = generate_oth_mons(vocex, int(len(vocabulary)/8) + 1)
+			choices_oth = RuleSampler(space_oth_mons(vocex))
 		else:
-			choices_oth = generate_oth(vocex, int(len(vocabulary)/8) + 1)
+			choices_oth = RuleSampler(space_oth(vocex))
 		for i in range(size_pos):
 			found = False
 			while not found:
-				if not choices_pos:
+				c = choices_pos.draw()
+				if c == None:
 					break
-				c = random.choice(choices_pos)
-				if is_possible_rule(rules_pos, vocabulary, length, c):
+				if is_possible_rule(rules_pos, vocabulary, length, c, solver):
 				# if not c.inverse() in rules_pos:
 					rules_pos.append(c)
 					found = True
-				choices_pos = [r for r in choices_pos if not r ==c]
 
 		rules = rules_pos
 		for i in range(size_oth):
 			found = False
 			while not found:
-				if not choices_oth:
+				c = choices_oth.draw()
+				if c == None:
 					break
-				c = random.choice(choices_oth)
 				# if not c.inverse() in rules_pos:
-				if is_possible_rule(rules, vocabulary, length, c):
+				if is_possible_rule(rules, vocabulary, length, c, solver):
 					rules.append(c)
 					found = True
-				choices_oth = [r for r in choices_oth if not r ==c]
 
 
 		if len(rules)==size:
@@ -252,7 +324,13 @@ def protocol_generator(vocabulary, size, length, prop_pos, mons, name, vocabular
 				
 	return Protocol(vocabulary, rules, name)
 
-def is_possible_rule(rules, vocabulary, length, rule):
+def is_possible_rule(rules, vocabulary, length, rule, solver=None):
+	"""Whether rule can be added to rules. A solver holding rules checks it incrementally, and keeps it if possible"""
+	if solver != None:
+		if solver.check(rule):
+			solver.add(rule)
+			return True
+		return False
 	new_rules = copy.copy(rules)
 	new_rules.append(rule)
 	return check_sat(new_rules, vocabulary, length, name=str(random.choice(range(10))))
@@ -263,43 +341,112 @@ def generate_pattern_bound(protocol, bound):
 	pattern = [random.choice([0,1]) for i in range(bound)]
 	return pattern
 
+class RuleSpace(object):
+	""" A space of candidate rules: a union of products of small lists, never materialized.
+		Rules are built only when they are indexed, in the order of the equivalent list comprehensions
+	"""
+	def __init__(self):
+		self.blocks = []
+		self.size = 0
+
+	def add(self, make, *dims):
+		"""Adds the rules make(x1,...,xn) for x1 in dims[0] ... for xn in dims[n-1]"""
+		size = 1
+		for d in dims:
+			size *= len(d)
+		self.blocks.append((make, dims, size))
+		self.size += size
+
+	def __len__(self):
+		return self.size
+
+	def __getitem__(self, i):
+		if i < 0 or i >= self.size:
+			raise IndexError(i)
+		for make, dims, size in self.blocks:
+			if i < size:
+				values = []
+				for d in reversed(dims):
+					i, r = divmod(i, len(d))
+					values.append(d[r])
+				values.reverse()
+				return make(*values)
+			i -= size
+
+	def __iter__(self):
+		for i in xrange(self.size):
+			yield self[i]
+
+
+class RuleSampler(object):
+	"""Draws the rules of a RuleSpace uniformly at random without replacement (sparse Fisher-Yates)"""
+	def __init__(self, space):
+		self.space = space
+		self.left = len(space)
+		self.moved = {}
+
+	def __len__(self):
+		return self.left
+
+	def draw(self):
+		"""A new rule, or None if all have been drawn"""
+		if not self.left:
+			return None
+		k = random.randrange(self.left)
+		self.left -= 1
+		i = self.moved.get(k, k)
+		self.moved[k] = self.moved.pop(self.left, self.left)
+		return self.space[i]
+
+
+def distinct_pairs(vocabulary):
+	return [(b, a) for b in vocabulary for a in vocabulary if a!=b]
+
+def space_pos_mons(vocabulary):
+	space = RuleSpace()
+	space.add(lambda v, ag: Existential(v,1,ag), vocabulary, [0,1])
+	return space
+
+def space_oth_mons(vocabulary):
+	space = RuleSpace()
+	pairs = distinct_pairs(vocabulary)
+	types = ("correlation","response","before")
+	types2 = ("immAfter", "premise")
+	space.add(lambda v, ag: Existential(v,0,ag), vocabulary, [0,1])
+	space.add(lambda t, (b, a), ag, agr: Relation(a,b,t,1,ag, agr), types, pairs, [0,1], [0,1])
+	space.add(lambda t, (b, a), ag, agr: Relation(a,b,t,0,ag, agr), types, pairs, [0,1], [0,1])
+	space.add(lambda t, (b, a), pos: Relation(a,b,t,pos,1,0), types2, pairs, [0,1])
+	space.add(lambda t, (b, a), pos: Relation(a,b,t,pos,0,1), types2, pairs, [0,1])
+	return space
+
+def space_pos(vocabulary):
+	return RuleSpace()
+
+def space_oth(vocabulary):
+	space = RuleSpace()
+	types = ["correlation","response"]
+	space.add(lambda v, ag: Existential(v,0,ag), vocabulary, [0,1])
+	space.add(lambda t, b, a, ag, agr: Relation(a,b,t,0,ag, agr), types, vocabulary, vocabulary, [0,1], [0,1])
+	space.add(lambda b, ag, agr, a, pos: Relation(a,b,'premise',pos,ag,agr), vocabulary, [0,1], [0,1], vocabulary, [0,1])
+	space.add(lambda b, ag, agr, a, pos: Relation(a,b,'immAfter',pos,ag,agr), vocabulary, [0,1], [0,1], vocabulary, [0,1])
+	space.add(lambda b, a, ag, agr, pos: Relation(a,b,'before',pos,ag,agr), vocabulary, vocabulary, [0,1], [0,1], [0,1])
+	return space
+
 def generate_pos_mons(vocabulary, boundex):
 	"""Generates positive rules"""
-	ex = [Existential(v,1,ag) for v in vocabulary for ag in [0,1]]
-	return ex
+	return list(space_pos_mons(vocabulary))
 
 def generate_oth_mons(vocabulary, boundex):
 	"""Generates all other rules"""
-	ex = [Existential(v,0,ag) for v in vocabulary for ag in [0,1]]
-	types = ("correlation","response","before")
-	rel0 = [Relation(a,b,t,0,ag, agr)  for t in types for b in vocabulary for a in vocabulary if a!=b for ag in [0,1] for agr in [0,1]]
-	rel1 = [Relation(a,b,t,1,ag, agr) for t in types for b in vocabulary for a in vocabulary if a!=b for ag in [0,1] for agr in [0,1]]
-	types2 = ("immAfter", "premise")
-	rel2a = []
-	rel2b = []
-	rel2a = [Relation(a,b,t,pos,1,0) for t in types2 for b in vocabulary for a in vocabulary if a!=b for pos in [0,1]]
-	rel2b = [Relation(a,b,t,pos,0,1) for t in types2 for b in vocabulary for a in vocabulary if a!=b for pos in [0,1]]
-	return ex+rel1+rel0+rel2a+rel2b # Ex will be underrepresented, maybe add another one
+	return list(space_oth_mons(vocabulary)) # Ex will be underrepresented, maybe add another one
 
 def generate_pos(vocabulary, boundex):
 	"""Generates positive rules"""
-	# ex = [Existential(v,1,ag) for v in vocabulary for ag in [0,1]]
-	return []
+	return list(space_pos(vocabulary))
 
 def generate_oth(vocabulary, boundex):
 	"""Generates all other rules"""
-	ex = [Existential(v,0,ag) for v in vocabulary for ag in [0,1]]
-	types = ["correlation","response"]
-	rel0 = [Relation(a,b,t,0,ag, agr)  for t in types for b in vocabulary for a in vocabulary for ag in [0,1] for agr in [0,1]]
-	
-	types2 = ["premise","immAfter"]
-	rel2a = [Relation(a,b,'premise',pos,ag,agr) for b in vocabulary for ag in [0,1] for agr in [0,1] for a in vocabulary for pos in [0,1]]
-	rel3 = [Relation(a,b,'before',pos,ag,agr) for b in vocabulary for a in vocabulary for ag in [0,1] for agr in [0,1] for pos in [0,1]]
-	rel4a = [Relation(a,b,'immAfter',pos,ag,agr) for b in vocabulary for ag in [0,1] for agr in [0,1] for a in vocabulary for pos in [0,1]]
-	rel4b = []
-	rel2b = []
-	rel2 = rel2a+rel2b+rel4a+rel4b+rel3
-	return ex+rel0+rel2 # Ex will be underrepresented, maybe add another one
+	return list(space_oth(vocabulary)) # Ex will be underrepresented, maybe add another one
 
 #**#**#**#**#**#**#**#**#**# Translators Python-NuSMV #**#**#**#**#**#**#**#**#**#
 
@@ -394,72 +541,108 @@ def interaction2nusmv(interaction, vocabulary, bound, mode = "complete"):
 
 
 def protocol2nusmv_spec(rules):
-	ltlrules = ("LTLSPEC "+rule2nusmv(r) for r in rules)
+	""" One LTLSPEC per rule, named r and the index of the rule """
+	ltlrules = ("LTLSPEC NAME r{} := {}".format(i, rule2nusmv(r)) for i, r in enumerate(rules))
 	return "\n".join(ltlrules)
 
-def nusmv2rule(ltlspec):
-	############## RELATIONS
-	m = re.search('(?<!G ) F say = (?P<a>.*?) ->  F (?!\!)say = (?P<b>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'correlation',1,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('F say = (?P<a>.*?) -> !\( F say = (?P<b>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'correlation',0,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('G \(say = (?P<a>.*?) ->  F (?!\!)say = (?P<b>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'response',1,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('G \(say = (?P<a>.*?) -> \!\( F say = (?P<b>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'response',0,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('\(say != (?P<b>.*?) U say = (?P<a>.*?)\)', ltlspec)
-
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'before',1,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('G \( F say = (?P<b>.*?) -> \!\(say = (?P<a>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'before',0,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('G \( X say = (?P<b>.*?) -> (?!\!)say = (?P<a>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'premise',1,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('G \( X say = (?P<b>.*?) -> \!\(say = (?P<a>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'premise',0,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('G \(say = (?P<a>.*?) ->  X (?!\!)say = (?P<b>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'immAfter',1,m.group('a')[-1], m.group('b')[-1]))
-	m = re.search('G \(say = (?P<a>.*?) ->  X \!\(say = (?P<b>.*?)\)', ltlspec)
-	if m:
-		return(Relation(m.group('a')[:-1], m.group('b')[:-1],'immAfter',0,m.group('a')[-1], m.group('b')[-1]))
-	
-	############ EXISTENTIALS
-	m = re.search('F say = (?P<a>.*?)$', ltlspec)
-	if m:
-		return(Existential(m.group('a')[:-2],1,m.group('a')[-2]))
-	m = re.search('G say != (?P<a>.*?)$', ltlspec)
-	if m: 
-		return(Existential(m.group('a')[:-2],0,m.group('a')[-2]))
-
-	raise NameError('Todo mal con: {}'.format(ltlspec))
+# the answer NuSMV gives for a specification. By default (prop_print_method formula) it prints the formula, and the
+# answers come in the order of the specifications; printing names it shows the one protocol2nusmv_spec gave, r<i>
+SPEC_RESULT = re.compile(r'^-- specification (?P<spec>.*?)\s+is (?P<value>true|false)\s*$', re.M)
+SPEC_NAME = re.compile(r'^\s*(NAME\s+r(\d+)\b|\(?r(\d+)\)?(\s+IN \w+)?\s*$)')
 
+def nusmv2violations(output, n):
+	""" Indices of the false specifications in the output of checking the n of protocol2nusmv_spec: by their names
+		if NuSMV printed them, by their order if it printed the formulas. None if some of them has no answer
+	"""
+	answers = [(SPEC_NAME.match(m.group('spec')), m.group('value')) for m in SPEC_RESULT.finditer(output)]
+	if all(name != None for name, value in answers):
+		answers = dict((int(name.group(2) or name.group(3)), value) for name, value in answers)
+	elif all(name == None for name, value in answers):
+		answers = dict(enumerate(value for name, value in answers))
+	else:
+		return None
+	if sorted(answers) != range(n):
+		return None
+	return [i for i in range(n) if answers[i] == 'false']
 
 
 #**#**#**#**#**#**#**#**#**# NuSMV Interface #**#**#**#**#**#**#**#**#**#
 
-def call_nusmv(module, nam=""):
-	""" Calls NuSMV to check the specification in the string module"""
-	rnd = random.choice(range(20))
-	# print name+nam
-	f = open(os.path.join(__location__, 'nusmvSpec/nusmvSpec{}.smv'.format(str(rnd)+nam)), 'w+')
-	r = open(os.path.join(__location__, 'nusmvSpec/results{}.txt'.format(str(rnd)+nam)), 'w+')
-	f.write(module)
-	f.close()
-
-	# print "nam: {}".format(nam)
+def use_nusmv_pool(size=2):
+	""" Sends the NuSMV checks to size long-lived interactive NuSMV processes, which write their models in scratch_dir.
+		0 goes back to one process per check"""
+	return nusmvpool.set_pool(size, scratch_dir)
 
-	# err = os.system("./NuSMV -coi {} >> {}".format(f.name,r.name))
-	err = os.system("./NuSMV -coi -df -dynamic -dcx {} > {}".format(f.name, r.name))
-
-	nr = r.read()
+def nusmv_lines(proc, cancel=None):
+	"""The lines NuSMV prints. Kills it and raises Expired if the cancel token expires first"""
+	if cancel == None:
+		for line in iter(proc.stdout.readline, ''):
+			yield line
+		return
+	out = proc.stdout.fileno()
+	buf = ""
+	while True:
+		while not "\n" in buf:
+			if cancel.expired():
+				proc.kill()
+				cancel.expire()
+			if not select.select([out], [], [], cancel.wait())[0]:
+				continue
+			chunk = os.read(out, 65536)
+			if not chunk:
+				if buf:
+					yield buf
+				return
+			buf += chunk
+		line, buf = buf.split("\n", 1)
+		yield line + "\n"
+
+def call_nusmv(module, nam="", cancel=None):
+	""" Calls NuSMV to check the specification in the string module.
+		The model goes through stdin (or a scratch file if nusmv_input is "file") and the output is read as it comes:
+		NuSMV is stopped as soon as every LTLSPEC has its answer, or when the cancel token expires
+	"""
+	pool = nusmvpool.get_pool()
+	if pool:
+		return pool.check(module, cancel)
+
+	specs = module.count("LTLSPEC")
+	model = None
+	if nusmv_input == "file":
+		fd, model = tempfile.mkstemp(suffix='.smv', prefix='nusmvSpec{}-'.format(nam), dir=scratch_dir)
+		os.write(fd, module)
+		os.close(fd)
+		proc = subprocess.Popen([nusmvpool.NUSMV] + nusmvpool.OPTIONS + [model], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=__location__)
+	else:
+		proc = subprocess.Popen([nusmvpool.NUSMV] + nusmvpool.OPTIONS, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=__location__)
+		try:
+			proc.stdin.write(module)
+			proc.stdin.close()
+		except (IOError, OSError):
+			pass
+
+	lines = []
+	answers = 0
+	finished = False
+	try:
+		for line in nusmv_lines(proc, cancel):
+			lines.append(line)
+			if line.startswith("-- specification") and (" is true" in line or " is false" in line):
+				answers += 1
+				if answers == specs:
+					break
+		finished = True
+	finally:
+		if (answers == specs and specs or not finished) and proc.poll() == None:
+			proc.kill()
+		proc.stdout.close()
+		err = proc.wait()
+		if model:
+			os.remove(model)
+
+	if answers == specs and specs:
+		err = 0
+	nr = "".join(lines)
 
 	# print module
 	# print nr
@@ -467,7 +650,6 @@ def call_nusmv(module, nam=""):
 		print module
 		print "err"
 
-	r.close()
 	return err, nr
 
 
@@ -481,21 +663,79 @@ def check_modelNM(protocol, interaction):
 			return True 
 
 def get_violationsNM(protocol, interaction):
-	viol = []
-	for r in protocol.rules:
-		if not isMonotone(r):
-			if not r.satisfied(interaction):
-				viol.append(r)
-	return viol
+	return protocol.monitor_for(interaction).broken()
+
+def set_sat_backend(backend):
+	""" Selects how check_sat decides satisfiability: "nusmv" or "native" """
+	global sat_backend
+	if not backend in sat_backends:
+		raise NameError('Unknown backend: {}'.format(backend))
+	sat_backend = backend
+
+def use_sat_cache(maxsize=100000, path=None, sync=100):
+	""" Memoizes check_sat answers, in memory and in the sqlite file path if given, committed every sync answers.
+		maxsize 0 disables the cache"""
+	global sat_cache
+	if sat_cache != None:
+		sat_cache.close()
+	sat_cache = None
+	if maxsize:
+		sat_cache = SatCache(maxsize, path, sync)
+	return sat_cache
+
+def init_worker_process():
+	""" Sets up a process forked from one that checks satisfiability: it starts NuSMV processes of its own, in its scratch_dir,
+		and opens the cache database again, instead of sharing the pipes and the connection of its parent
+	"""
+	global sat_cache
+	nusmvpool.reset_pool(scratch_dir)
+	cache = sat_cache
+	if cache != None and cache.path:
+		sat_cache = None
+		use_sat_cache(cache.maxsize, cache.path, sync=1)
+
+def check_token(timeout, cancel):
+	"""The token for one check: the given one or the global one, limited to timeout or check_timeout seconds"""
+	if timeout == None:
+		timeout = check_timeout
+	if cancel == None:
+		cancel = cancel_token
+	return token_for(timeout, cancel)
+
+def check_sat(rules, vocabulary, bound, interaction=[], name="", mode="partial", backend=None, timeout=None, cancel=None):
+	""" Whether the rules can be satisfied continuing the interaction.
+		The check gives up after timeout seconds or when the cancel token expires: it raises Expired, or answers False if on_expiry is "unsat"
+	"""
+	cancel = check_token(timeout, cancel)
+	try:
+		if sat_cache != None:
+			key = sat_cache.key(rules, vocabulary, bound, interaction, mode)
+			res = sat_cache.get(key)
+			if res == None:
+				res = decide_sat(rules, vocabulary, bound, interaction, name, mode, backend, cancel)
+				sat_cache.put(key, res)
+			return res
+		return decide_sat(rules, vocabulary, bound, interaction, name, mode, backend, cancel)
+	except Expired:
+		if on_expiry == "unsat":
+			return False
+		raise
+
+def decide_sat(rules, vocabulary, bound, interaction=[], name="", mode="partial", backend=None, cancel=None):
+	if cancel != None:
+		cancel.check()
+	if backend == None:
+		backend = sat_backend
+	if backend == "native":
+		return native_sat(rules, vocabulary, bound, interaction, mode)
 
-def check_sat(rules, vocabulary, bound, interaction=[], name="", mode="partial"):
 	ltlspec = protocol2nusmv_sat(rules,mode)
 	aux = [['{}0'.format(v),'{}1'.format(v)] for v in vocabulary]
 	possible_actions = [item for sublist in aux for item in sublist]
 	model = interaction2nusmv(interaction, vocabulary, bound, mode) + '\n'
 
 	# print "check sat: {}".format(name)
-	err, nr = call_nusmv(model + ltlspec, nam=name)
+	err, nr = call_nusmv(model + ltlspec, nam=name, cancel=cancel)
 
 	if not err:	
 		return " is false" in nr
@@ -513,10 +753,29 @@ def possible_messages(protocol, interaction, bound, agent):
 	return res
 
 def possible_messagesNM(protocol, interaction, bound, agent):
-	res = []
-	for v in protocol.vocabulary:
-		if is_possibleNM(protocol, interaction, v, bound, agent):
-			res.append(v)
+	allowed = possible_candidatesNM(protocol, interaction, protocol.vocabulary, agent)
+	return [v for v in protocol.vocabulary if v in allowed]
+
+def violations_candidatesNM(protocol, interaction, candidates, agent):
+	""" Which non-monotonic rules each candidate word would break if agent said it after interaction.
+		Returns the distinct words, the rules, and a words x rules boolean matrix
+	"""
+	monitor = protocol.monitor_for(interaction)
+	words = list(collections.OrderedDict.fromkeys(candidates))
+	return words, monitor.rules, monitor.violations(agent, words)
+
+def possible_candidatesNM(protocol, interaction, candidates, agent):
+	"""The set of candidate words that agent can say after interaction"""
+	words, rules, broken = violations_candidatesNM(protocol, interaction, candidates, agent)
+	ok = ~broken.any(axis=1)
+	return set(w for i, w in enumerate(words) if ok[i])
+
+def broken_candidatesNM(protocol, interaction, candidates, agent):
+	"""brokenNonM for every candidate word at once: a dictionary from words to the rules they break"""
+	words, rules, broken = violations_candidatesNM(protocol, interaction, candidates, agent)
+	res = {}
+	for i, w in enumerate(words):
+		res[w] = [rules[j] for j in broken[i].nonzero()[0] if not (isinstance(rules[j], Relation) and rules[j].type=='immAfter' and rules[j].pos==1 and rules[j].b != w)]
 	return res
 
 def is_possible_bound(protocol, interaction, message, bound, agent):
@@ -525,12 +784,8 @@ def is_possible_bound(protocol, interaction, message, bound, agent):
 	return check_sat(protocol.rules, protocol.vocabulary, bound, inter, name=str(agent))
 
 def is_possibleNM(protocol, interaction, message, bound, agent):
-	inter = copy.copy(interaction)
-	inter.append((agent, message))
 	# l = len(interaction)
-	viols = get_violationsNM(protocol, inter)
-	# print viols
-	return get_violationsNM(protocol, inter) == []
+	return protocol.monitor_for(interaction).would_break(agent, message) == []
 	# return check_modelNM(protocol, inter)
 	# return check_sat(protocol.rules, protocol.vocabulary,  min(int(l+math.ceil((bound-l)/2)),int(l+2)), inter)
 
@@ -539,23 +794,48 @@ def is_possible_mon(protocol, interaction, message, bound, agent):
 	inter.append((agent, message))
 	return check_sat(protocol.rules, protocol.vocabulary,  bound, inter, name=str(agent), mode="nobound")
 
-def get_violations(rules, vocabulary, interaction, bound, name=''):
+def get_violations(rules, vocabulary, interaction, bound, name='', backend=None, timeout=None, cancel=None):
+	""" Indices of the rules broken by the finished interaction. Raises NameError if they cannot be checked.
+		Gives up like check_sat: raises Expired, or returns None if on_expiry is "unsat"
+	"""
+	cancel = check_token(timeout, cancel)
+	try:
+		return find_violations(rules, vocabulary, interaction, bound, name, backend, cancel)
+	except Expired:
+		if on_expiry == "unsat":
+			return None
+		raise
+
+def find_violations(rules, vocabulary, interaction, bound, name='', backend=None, cancel=None):
+	if cancel != None:
+		cancel.check()
+	if backend == None:
+		backend = sat_backend
+	if backend == "native":
+		broken = native_violations(rules, vocabulary, interaction)
+		if broken == None:
+			raise NameError('The interaction or the rules have messages out of the vocabulary')
+		return broken
+
 	# print "bound : {}".format(bound)
 	ltlspec = protocol2nusmv_spec(rules)
 
 	model = interaction2nusmv(interaction, vocabulary, bound)
 	# print "get_violations: {}".format(name)
-	err, nr = call_nusmv("{}\n{}".format(model,ltlspec),nam=name)
+	err, nr = call_nusmv("{}\n{}".format(model,ltlspec),nam=name, cancel=cancel)
+	broken = None
 	if not err:
-		res = re.findall('-- specification (.*?) is false', nr)
-		# print res
-		return res
+		broken = nusmv2violations(nr, len(rules))
+	if broken == None:
+		raise NameError('NuSMV gave no answer for the {} rules of {}'.format(len(rules), name or 'the protocol'))
+	return broken
 
 def brokenNonM(protocol, interaction, bound, message=None,agent=None, name=''):
-	inter = copy.copy(interaction)	
+	monitor = protocol.monitor_for(interaction)
 	if message:
-		inter.append((agent,message))
-	broken = get_violationsNM(protocol, inter)
+		broken = monitor.would_break(agent, message)
+	else:
+		broken = monitor.broken()
 
 	if message:
 		broken = [r for r in broken if not (isinstance(r, Relation) and r.type=='immAfter' and r.pos==1 and r.b != message)]
@@ -570,14 +850,18 @@ def brokenM(protocol, interaction, bound, message=None, agent=None, name=''):
 		inter.append((agent,message))
 
 	broken = get_violations(protocol.rules, protocol.vocabulary, inter, len(inter), name=name)
-	if not broken: 
+	if broken == None:
+		# the check expired and on_expiry is "unsat": no violation is found
 		return []
-	else:
-		res = [nusmv2rule(r) for r in broken if isMonotone(nusmv2rule(r))]
-		return res
+	rules = [protocol.rules[i] for i in broken]
+	return [r for r in rules if isMonotone(r)]
 
 #**#**#**#**#**#**#**#**#**# Other Operations with Protocols #**#**#**#**#**#**#**#**#**#
 
+def derive_seed(*parts):
+	"""A 32 bit seed determined by the parts, the same in every process"""
+	return int(hashlib.sha1(repr(parts)).hexdigest()[:8], 16)
+
 def reverseAlg(alignment):
 	return {alignment[k] : k for k in alignment.keys()}
 
@@ -592,39 +876,29 @@ def protocol_translator(protocol, alignment):
 	return Protocol(newvoc, newrules, "name"+"-1")
 
 
+relation_types = ['correlation', 'response', 'before', 'premise', 'immAfter']
+
 def is_premise(protocol, message, ag, agr):
-	rules = protocol.rules
-	for r in rules: 
-		if isinstance(r, Relation) and (not isMonotone(r)) and ((r.a == message and r.ag == ag and r.agr == agr and not (r.type in ['before','premise'] and r.pos==1)) or  (type=='correlation' and r.b == message and r.ag == agr and r.agr == ag)):
-		# if isinstance(r, Relation) and (not isMonotone(r)) and r.a == message and r.ag == ag and r.agr == agr:
+	for r in protocol.indexed('a', ag, message, relation_types):
+		if (not isMonotone(r)) and int(r.agr) == int(agr) and not (r.type in ['before','premise'] and r.pos==1):
 			return True
 	return False
 
 def is_premise_con(protocol, message, ag, agr):
-	rules = protocol.rules
-	for r in rules: 
-		if isinstance(r, Relation) and r.type in ['before','premise'] and r.pos==1 and r.a == message and r.ag == ag:
-			return True
-	return False
+	return protocol.indexed('a', ag, message, ['before','premise'], 1) != []
 
 def is_premise_mon(protocol, message, ag, agr):
-	rules = protocol.rules
-	for r in rules: 
-		if isinstance(r, Relation) and r.a == message and r.ag == ag:
-			return True
-	return False
+	return protocol.indexed('a', ag, message, relation_types) != []
 
 def is_conseq(protocol, message,ag, agr, interaction):
-	rules = protocol.rules
-	for r in rules: 
-		if isinstance(r, Relation) and (not isMonotone(r)) and r.b == message and r.agr == agr and r.ag == ag:
+	for r in protocol.indexed('b', agr, message, relation_types):
+		if (not isMonotone(r)) and int(r.ag) == int(ag):
 			return True
 	return False
 
 def is_conseq_b(protocol, message, agr):
-	rules = protocol.rules
-	for r in rules: 
-		if isinstance(r, Relation) and not isMonotone(r) and r.b == message and r.agr == agr:
+	for r in protocol.indexed('b', agr, message, relation_types):
+		if not isMonotone(r):
 			return True
 	return False
 
@@ -689,7 +963,10 @@ def precision_recall(alignment,  reference):
 	if not alignment: 
 		return 0,0
 	else:
-		max_alg = {k : myMax(alignment[k]) for k in alignment.keys()}
+		if isinstance(alignment, AlignmentMatrix):
+			max_alg = alignment.best_map()
+		else:
+			max_alg = {k : myMax(alignment[k]) for k in alignment.keys()}
 		correct = sum(1 for k in alignment.keys() if max_alg[k] == reference[k])
 		return (float(correct)/float(len(alignment.keys())), float(correct)/float(len(reference.keys())))
 
@@ -710,16 +987,24 @@ def get_pragmatic_multialignment(alignment):
 
 #**#**#**#**#**#**#**#**#**# JSON #**#**#**#**#**#**#**#**#**#
 
+def json_fields(o):
+	if isinstance(o, Protocol):
+		return {'vocabulary' : o.vocabulary, 'rules' : o.rules, 'name' : o.name}
+	if isinstance(o, Rule):
+		return o.to_dict()
+	return o.__dict__
+
 class MyJSONEncoder(json.JSONEncoder):
 	"""Prints JSON versions of a protocol"""
 	def default(self, o):
-		return o.__dict__
+		return json_fields(o)
 
 
 class MyJSONEncoderF(json.JSONEncoder):
 	"""Prints JSON versions of a protocol"""
 	def default(self, o):
-		return {str(k): o.__dict__[k] for k in o.__dict__.keys()}  
+		fields = json_fields(o)
+		return {str(k): fields[k] for k in fields.keys()}  
 
 
 def rule_from_json(json_object):
@@ -737,11 +1022,48 @@ def protocol_from_json(doc):
 	prot = json.JSONDecoder(object_hook = rule_from_json).decode(json_object)
 	return prot
 
+def replace_file(tmp, path):
+	""" Renames the temporary file tmp to path, with the permissions open() would have given it
+		(temporary files can only be read by their owner, and the files of a corpus are read by every worker)
+	"""
+	umask = os.umask(0)
+	os.umask(umask)
+	os.chmod(tmp, 0o666 & ~umask)
+	os.rename(tmp, path)
+
 #**#**#**#**#**#**#**#**#**# Global Variables #**#**#**#**#**#**#**#**#**#
 
 global name
 name = "ae"+str(random.choice(range(20)))
 
+sat_backends = ["nusmv", "native"]
+global sat_backend
+sat_backend = "nusmv"
+
+global sat_cache
+sat_cache = None
+
+# the monitor of the last interaction asked about for each protocol (see monitor_for). It is kept out of the
+# protocols, which are shared by every interaction of an experiment, and goes away with them
+protocol_monitors = weakref.WeakKeyDictionary()
+
+# checks give up after check_timeout seconds (None waits for the answer) or when cancel_token expires.
+# on_expiry is "raise" (raise Expired) or "unsat" (answer as if the rules could not be satisfied)
+global check_timeout
+check_timeout = None
+global cancel_token
+cancel_token = None
+global on_expiry
+on_expiry = "raise"
+
+# how call_nusmv gives the model to NuSMV: "pipe" (stdin) or "file" (a temporary file in scratch_dir)
+global nusmv_input
+nusmv_input = "pipe"
+
+# where call_nusmv writes its models and results. Processes that run in parallel use their own scratch_dir
+global scratch_dir
+scratch_dir = os.path.join(__location__, 'nusmvSpec')
+
 
 #**#**#**#**#**#**#**#**#**# Some Testing #**#**#**#**#**#**#**#**#**#
 
@@ -0,0 +1,231 @@
+import os
+import re
+import ast
+import sys, getopt
+import numpy as np
+from catalog import Catalog
+
+__location__ = os.path.realpath(
+    os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+# The figures of the paper, as specs that render() draws. A figure has lines, each a (label, style, sources) triple.
+# A source is either the name of a curve of precision/recall pairs written in plotsAAMAS.py, or a dictionary of
+# parameters that selects runs in the catalog (e.g. {'vocab' : 10, 'prot' : 8, 'agent' : 'reasoner'}), whose result
+# stores have f-score curves. A line is the mean of the curves of its sources; with band, also its confidence band.
+# Optional keys: length (interactions drawn, the length of the shortest curve if not given), axis, xlabel, ylabel, title
+FIGURES = {
+	'violations' : {'length' : 300, 'ylabel' : 'Precision', 'title' : 'Vocabulary 10',
+		'lines' : [('Viol', 'r*', ['off1081b']),
+					('Release', 'b-', ['off1080b']),
+					('Basic', 'g--', ['off108cb'])]},
+	'bounds' : {'length' : 200,
+		'lines' : [('Bound 12', 'g--', ['commoff1612']),
+					('Bound 14', 'y--', ['commoff1614']),
+					('Bound 16', 'b--', ['commoff1616'])]},
+	'reasoning' : {'length' : 200,
+		'lines' : [('simple', 'b--', ['a1012_2a', 'a1012_2b']),
+					('smart 6', 'r-', ['a1012_4a', 'a1012_4b'])]},
+	'agents' : {'length' : 200,
+		'lines' : [('Agent 2', 'r--', ['as3_2a', 'as3_2b']),
+					('Agent 3', 'g--', ['as3_3a', 'as3_3b']),
+					('Agent 6', 'y--', ['as3_6a', 'as3_6b']),
+					('Agent 35', 'b--', ['as3_35a', 'as3_35b'])]},
+	'monotonic' : {'length' : 100,
+		'lines' : [('No Monotonic Rules', 'r--', ['ag814nma']),
+					('Monotonic rules', 'g-*', ['ag814ma'])]},
+	'heterogeneity' : {'length' : 200,
+		'lines' : [('simp 0.2', 'y--', ['alg101002_2a', 'alg101002_2b']),
+					('reas 0.2', 'y-', ['alg101002_4a', 'alg101002_4b']),
+					('simp 0.5', 'g--', ['alg101005_2a', 'alg101005_2b']),
+					('reas 0.5', 'g-', ['alg101005_4a', 'alg101005_4b']),
+					('simp 0.8', 'r--', ['alg101008_2a', 'alg101008_2b']),
+					('reas 0.8', 'r-', ['alg101008_4a', 'alg101008_4b'])]},
+}
+
+
+#**#**#**#**#**#**#**#**#**# Curves #**#**#**#**#**#**#**#**#**#
+
+class Literals(object):
+	""" The curves written as python literals (name = [[p, r], ...], one per line) in a file such as plotsAAMAS.py.
+		The file is not run: each curve is parsed the first time it is asked for, as an n x 2 array
+	"""
+
+	assignment = re.compile(r'^(\w+)\s*=\s*\[\[')
+
+	def __init__(self, path=os.path.join(__location__, 'plotsAAMAS.py')):
+		self.path = path
+		self.offsets = None
+		self.curves = {}
+
+	def index(self):
+		"""Where each curve starts in the file. A curve assigned twice is the last one, as when the file runs"""
+		self.offsets = {}
+		f = open(self.path, 'rb')
+		offset = 0
+		for line in f:
+			m = self.assignment.match(line)
+			if m:
+				self.offsets[m.group(1)] = offset
+			offset += len(line)
+		f.close()
+
+	def __contains__(self, name):
+		if self.offsets == None:
+			self.index()
+		return name in self.offsets
+
+	def __getitem__(self, name):
+		if not name in self.curves:
+			if not name in self:
+				raise NameError('No curve {} in {}'.format(name, self.path))
+			f = open(self.path, 'rb')
+			f.seek(self.offsets[name])
+			line = f.readline()
+			f.close()
+			self.curves[name] = np.array(ast.literal_eval(line.split('=', 1)[1].strip()), dtype=float)
+		return self.curves[name]
+
+
+def fscore(pairs):
+	"""The f-score of each precision/recall pair of an n x 2 array (or of a stack of them), as the old fscore(seq)"""
+	pairs = np.asarray(pairs, dtype=float)
+	p = pairs[..., 0]
+	r = pairs[..., 1]
+	return 2 * (p * r) / (p + r + 0.01)
+
+def mean_band(curves, z=1.96):
+	""" The mean of a curves x interactions array and the bounds of its confidence band (z standard errors),
+		from the sums of the curves and of their squares
+	"""
+	curves = np.asarray(curves, dtype=float)
+	n = curves.shape[0]
+	mean = curves.sum(axis=0) / n
+	if n < 2:
+		return mean, mean, mean
+	var = np.maximum(np.einsum('ij,ij->j', curves, curves) / n - mean * mean, 0) * n / (n - 1)
+	half = z * np.sqrt(var / n)
+	return mean, mean - half, mean + half
+
+def conv08(curves, threshold=0.8):
+	"""The first interaction in which each curve passes threshold, or its length if it never does"""
+	above = np.asarray(curves) > threshold
+	return np.where(above.any(axis=-1), above.argmax(axis=-1), above.shape[-1])
+
+
+#**#**#**#**#**#**#**#**#**# Figures #**#**#**#**#**#**#**#**#**#
+
+class Figures(object):
+	""" Computes the lines of the figures of a spec such as FIGURES, from the literals and the catalog """
+
+	def __init__(self, figures=FIGURES, literals=None, catalog=None):
+		self.figures = figures
+		self.literals = literals if literals != None else Literals()
+		if isinstance(catalog, basestring):
+			catalog = Catalog(catalog)
+		self.catalog = catalog
+
+	def curves(self, source):
+		"""The f-score curves of a source, as a curves x interactions array"""
+		if isinstance(source, dict):
+			if self.catalog == None:
+				raise NameError('No catalog to find {}'.format(source))
+			rows = [r for r in self.catalog.load(**source) if r['curves'] is not None and len(r['curves'])]
+			if not rows:
+				raise NameError('No runs with {}'.format(source))
+			length = min(r['curves'].shape[1] for r in rows)
+			return np.concatenate([r['curves'][:, :length] for r in rows])
+		return fscore(self.literals[source])[np.newaxis, :]
+
+	def lines(self, name, z=1.96):
+		""" The lines of figure name: for each one its label, style, mean and confidence band, all cut to the length of the figure """
+		if not name in self.figures:
+			raise NameError('Unknown figure: {}'.format(name))
+		spec = self.figures[name]
+		lines = []
+		for label, style, sources in spec['lines']:
+			curves = [self.curves(s) for s in sources]
+			length = min([c.shape[1] for c in curves] + [spec.get('length', sys.maxint)])
+			mean, low, high = mean_band(np.concatenate([c[:, :length] for c in curves]), z)
+			lines.append((label, style, mean, low, high))
+		length = min([len(l[2]) for l in lines])
+		return [(label, style, mean[:length], low[:length], high[:length]) for label, style, mean, low, high in lines]
+
+	def render(self, name, output=None, band=None):
+		""" Draws figure name and saves it as output/name.pdf, or shows it if there is no output """
+		import matplotlib
+		if output != None:
+			matplotlib.use('Agg')
+		import matplotlib.pyplot as plt
+		import seaborn as sns
+
+		spec = self.figures[name]
+		if band == None:
+			band = spec.get('band', False)
+		lines = self.lines(name)
+		length = len(lines[0][2])
+		x = np.arange(length)
+
+		fig = plt.figure()
+		sns.set_style("white")
+		for label, style, mean, low, high in lines:
+			ag1, = plt.plot(x, mean, style, label=label)
+			if band:
+				plt.fill_between(x, low, high, color=ag1.get_color(), alpha=0.2, linewidth=0)
+		plt.axis(spec.get('axis', [1, length, 0.0, 1.0]))
+		plt.legend(loc = 'best', fontsize=18)
+		plt.xticks(fontsize=16)
+		plt.yticks(fontsize=16)
+		plt.xlabel(spec.get('xlabel', 'Interactions'), fontsize=19)
+		plt.ylabel(spec.get('ylabel', 'F-Score'), fontsize=19)
+		if 'title' in spec:
+			plt.suptitle(spec['title'], fontsize=22)
+		fig.subplots_adjust(bottom=0.15)
+		if output == None:
+			plt.show()
+		else:
+			if not os.path.isdir(output):
+				os.makedirs(output)
+			fig.savefig(os.path.join(output, name + '.pdf'))
+		plt.close(fig)
+		return lines
+
+
+def main(argv):
+	names = []
+	output = 'figures/'
+	catalog = None
+	literals = None
+	band = None
+	show = False
+
+	try:
+		opts, args = getopt.getopt(argv,"f:o:c:l:bsa",["figure=","output=","catalog=","literals=","band","show","all"])
+	except getopt.GetoptError:
+		print 'plots.py [-f figure | -a] [-o output | -s] [-c catalog] [-l literals] [-b]'
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt in ("-f", "--figure"):
+			names.append(arg)
+		if opt in ("-a", "--all"):
+			names = sorted(FIGURES)
+		if opt in ("-o", "--output"):
+			output = arg
+		if opt in ("-s", "--show"):
+			show = True
+		if opt in ("-c", "--catalog"):
+			catalog = arg
+		if opt in ("-l", "--literals"):
+			literals = Literals(arg)
+		if opt in ("-b", "--band"):
+			band = True
+
+	if not names:
+		print 'Figures: {}'.format(', '.join(sorted(FIGURES)))
+		return
+	figures = Figures(FIGURES, literals, catalog)
+	for name in names:
+		lines = figures.render(name, None if show else output, band)
+		print '{}: converged (0.8) at {}'.format(name, ', '.join('{} {}'.format(l[0], conv08(l[2])) for l in lines))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,106 @@
+import os
+import json
+import numpy as np
+
+# A result store is a directory:
+#   meta.json    the length of the curves and the agent types
+#   AGENT.curves the f-score curves of agent type AGENT, as rows of little-endian float64 (two per cell, one per agent)
+#   AGENT.conv   the interaction in which each cell converged, as little-endian int32
+# Cells are appended as they finish, so a run keeps none of its curves in memory, and the files are read by memory mapping.
+# A row cut short by a crash is ignored when reading
+
+CURVE = np.dtype('<f8')
+CONV = np.dtype('<i4')
+
+
+class ResultSink(object):
+	""" Appends the outcome of each cell of an experiment to a result store in path, created if it does not exist """
+
+	def __init__(self, path, length=None, agents=()):
+		self.path = path
+		meta = os.path.join(path, 'meta.json')
+		if os.path.exists(meta):
+			f = open(meta)
+			self.meta = json.load(f)
+			f.close()
+			if length != None and length != self.meta['length']:
+				raise NameError('The store {} has curves of length {}, not {}'.format(path, self.meta['length'], length))
+		else:
+			if length == None:
+				raise NameError('No result store in {}'.format(path))
+			if not os.path.isdir(path):
+				os.makedirs(path)
+			self.meta = {'length' : length, 'agents' : []}
+		self.length = self.meta['length']
+		self.files = {}
+		for ag in agents:
+			self.add_agent(ag)
+
+	def add_agent(self, ag):
+		if not ag in self.meta['agents']:
+			self.meta['agents'].append(ag)
+			self.write_meta()
+		self.truncate(ag, self.cells(ag))
+
+	def write_meta(self):
+		tmp = os.path.join(self.path, '.meta.json')
+		f = open(tmp, 'w')
+		json.dump(self.meta, f)
+		f.close()
+		os.rename(tmp, os.path.join(self.path, 'meta.json'))
+
+	def file(self, ag, kind):
+		return os.path.join(self.path, '{}.{}'.format(ag, kind))
+
+	def cells(self, ag):
+		"""How many cells of ag the store has in full"""
+		size = lambda kind : os.path.getsize(self.file(ag, kind)) if os.path.exists(self.file(ag, kind)) else 0
+		return min(size('curves') / (2 * self.length * CURVE.itemsize), size('conv') / CONV.itemsize)
+
+	def truncate(self, ag, cells):
+		""" Keeps the first cells cells of ag, dropping what was appended after them.
+			Raises NameError if it has fewer: the files are never extended with made up cells
+		"""
+		self.close(ag)
+		if self.cells(ag) < cells:
+			raise NameError('The store {} has {} cells of {}, not {}'.format(self.path, self.cells(ag), ag, cells))
+		for kind, size in [('curves', cells * 2 * self.length * CURVE.itemsize), ('conv', cells * CONV.itemsize)]:
+			f = open(self.file(ag, kind), 'ab')
+			f.truncate(size)
+			f.close()
+
+	def append(self, ag, curve0, curve1, converged):
+		if not ag in self.files:
+			self.add_agent(ag)
+			self.files[ag] = (open(self.file(ag, 'curves'), 'ab'), open(self.file(ag, 'conv'), 'ab'))
+		curves, conv = self.files[ag]
+		if len(curve0) != self.length or len(curve1) != self.length:
+			raise NameError('Curves of length {} in a store of length {}'.format(len(curve0), self.length))
+		curves.write(np.array([curve0, curve1], dtype=CURVE).tostring())
+		conv.write(np.array([converged], dtype=CONV).tostring())
+		# what is written survives the process
+		curves.flush()
+		conv.flush()
+
+	def close(self, ag=None):
+		for a in ([ag] if ag != None else list(self.files)):
+			if a in self.files:
+				for f in self.files.pop(a):
+					f.close()
+
+
+def load_results(path):
+	""" The results in the store in path, like those of experimentAgents: resultsfin maps each agent type to a
+		(cells x 2) x length array of curves, resultsconv to an array of convergence indices. The arrays map the files, they are not read
+	"""
+	sink = ResultSink(path)
+	resultsfin = {}
+	resultsconv = {}
+	for ag in sink.meta['agents']:
+		cells = sink.cells(ag)
+		resultsfin[ag] = np.zeros((0, sink.length), dtype=CURVE)
+		resultsconv[ag] = np.zeros(0, dtype=CONV)
+		if cells:
+			resultsfin[ag] = np.memmap(sink.file(ag, 'curves'), dtype=CURVE, mode='r', shape=(2 * cells, sink.length))
+			resultsconv[ag] = np.memmap(sink.file(ag, 'conv'), dtype=CONV, mode='r', shape=(cells,))
+	return resultsfin, resultsconv
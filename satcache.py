@@ -0,0 +1,90 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import atexit
+from monitors import word_of
+
+
+class SatCache(object):
+	""" Memo of satisfiability answers, keyed on a canonical hash of the query.
+		Keeps the most recent maxsize answers in memory and, if a path is given, every answer in a sqlite file
+	"""
+
+	def __init__(self, maxsize=100000, path=None, sync=100):
+		self.maxsize = maxsize
+		self.path = path
+		self.memory = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.disk_hits = 0
+		self.misses = 0
+		self.sync = sync
+		self.pending = 0
+		self.db = None
+		if path:
+			self.db = sqlite3.connect(path, check_same_thread=False)
+			self.db.execute("CREATE TABLE IF NOT EXISTS sat (key TEXT PRIMARY KEY, result INTEGER)")
+			self.db.commit()
+			atexit.register(self.close)
+
+	@staticmethod
+	def key(rules, vocabulary, bound, interaction, mode):
+		""" Canonical hash of a query: the order of the rules and of the vocabulary does not matter.
+			Rules are told apart by their keys, written with their words instead of word ids so that the hash is the same in every process
+		"""
+		keys = set(r.key for r in rules)
+		rules = sorted([t, word_of(a), word_of(b) if b >= 0 else None, pos, ag, agr] for (t, a, b, pos, ag, agr) in keys)
+		query = [rules, sorted(set(vocabulary)), bound, [(str(ag), w) for (ag, w) in interaction], mode]
+		return hashlib.sha1(json.dumps(query)).hexdigest()
+
+	def get(self, key):
+		with self.lock:
+			if key in self.memory:
+				res = self.memory.pop(key)
+				self.memory[key] = res
+				self.hits += 1
+				return res
+			if self.db:
+				row = self.db.execute("SELECT result FROM sat WHERE key = ?", (key,)).fetchone()
+				if row:
+					res = bool(row[0])
+					self._remember(key, res)
+					self.disk_hits += 1
+					return res
+			self.misses += 1
+			return None
+
+	def put(self, key, res):
+		if res == None:
+			return
+		with self.lock:
+			self._remember(key, res)
+			if self.db:
+				self.db.execute("INSERT OR REPLACE INTO sat VALUES (?, ?)", (key, int(res)))
+				self.pending += 1
+				if self.pending >= self.sync:
+					self.db.commit()
+					self.pending = 0
+
+	def _remember(self, key, res):
+		self.memory[key] = res
+		while len(self.memory) > self.maxsize:
+			self.memory.popitem(last=False)
+
+	def stats(self):
+		queries = self.hits + self.disk_hits + self.misses
+		return {'queries' : queries, 'memory hits' : self.hits, 'disk hits' : self.disk_hits, 'misses' : self.misses,
+				'hit rate' : (self.hits + self.disk_hits) / float(max(queries, 1))}
+
+	def __str__(self):
+		s = self.stats()
+		return "{} queries, {} memory hits, {} disk hits, {} misses ({:.1%} answered without checking)".format(s['queries'], s['memory hits'], s['disk hits'], s['misses'], s['hit rate'])
+
+	def close(self):
+		with self.lock:
+			if self.db:
+				self.db.commit()
+				self.db.close()
+				self.db = None
@@ -0,0 +1,468 @@
+import os
+import time
+import random
+import shutil
+import tempfile
+import itertools
+import unittest
+import numpy as np
+import openprot
+from openprot import Protocol, Existential, Relation, InteractionMonitor, IncrementalSat, RuleSampler, native_sat, native_violations, nusmv2violations, brokenM, brokenNonM, isMonotone
+from openprot import space_pos_mons, space_oth_mons, space_oth, protocol_from_json
+from hypotheses import HypothesisSpace
+from aggregates import CurveStats
+from resultstore import ResultSink, load_results
+from corpus import pack_corpus, unpack_json, PackedCorpus
+from workqueue import WorkQueue
+
+
+#**#**#**#**#**#**#**#**#**# Satisfiability #**#**#**#**#**#**#**#**#**#
+
+# The reference reads the LTLSPEC of each rule (see rule2nusmv) on the trace NuSMV builds for an interaction:
+# begin, the messages, and end forever. Positions past the end of the list are its last one
+
+def holds(rule, trace):
+	n = len(trace)
+	a = (rule.ag, rule.a)
+	def F(m, i):
+		return m in trace[i:]
+	def X(i):
+		return trace[min(i + 1, n - 1)]
+	if isinstance(rule, Existential):
+		return F(a, 0) == bool(rule.pos)
+	b = (rule.agr, rule.b)
+	if rule.type == 'correlation':
+		return not F(a, 0) or F(b, 0) == bool(rule.pos)
+	if rule.type == 'response':
+		return all(m != a or F(b, i) == bool(rule.pos) for i, m in enumerate(trace))
+	if rule.type == 'before':
+		if rule.pos:
+			# ((say != b) U (say = a)) | G (say != b)
+			return not b in trace or (a in trace and trace.index(a) <= trace.index(b))
+		return all(m != a or not F(b, i) for i, m in enumerate(trace))
+	if rule.type == 'premise':
+		return all(X(i) != b or (m == a) == bool(rule.pos) for i, m in enumerate(trace))
+	if rule.type == 'immAfter':
+		return all(m != a or (X(i) == b) == bool(rule.pos) for i, m in enumerate(trace))
+
+def enumerated_sat(rules, vocabulary, bound, interaction, mode):
+	""" check_sat by trying every continuation of the interaction: none (complete), up to bound messages
+		in total (partial), or up to bound more (nobound, where bound stands for any finite number)
+	"""
+	# NuSMV reports nothing when there is no LTLSPEC to check
+	if not rules and mode != 'nobound':
+		return False
+	actions = [(ag, v) for v in vocabulary for ag in [0,1]]
+	if mode == 'complete':
+		depth = 0
+	elif mode == 'partial':
+		depth = max(bound - len(interaction), 0)
+	else:
+		depth = bound
+	for length in range(depth + 1):
+		for continuation in itertools.product(actions, repeat=length):
+			trace = ['begin'] + list(interaction) + list(continuation) + ['end']
+			if all(holds(r, trace) for r in rules):
+				return True
+	return False
+
+def random_rule(vocabulary):
+	if random.random() < 0.3:
+		return Existential(random.choice(vocabulary), random.randint(0,1), random.randint(0,1))
+	# relations of a word with itself too, as space_oth has them
+	a, b = random.choice(vocabulary), random.choice(vocabulary)
+	return Relation(a, b, random.choice(['correlation', 'response', 'before', 'premise', 'immAfter']), random.randint(0,1), random.randint(0,1), random.randint(0,1))
+
+
+class NativeSatTest(unittest.TestCase):
+	vocabulary = ['a', 'b', 'c']
+
+	def queries(self, count):
+		random.seed(7)
+		for k in range(count):
+			rules = [random_rule(self.vocabulary) for i in range(random.randint(0,3))]
+			interaction = [(random.randint(0,1), random.choice(self.vocabulary)) for i in range(random.randint(0,3))]
+			yield rules, interaction
+
+	def test_partial(self):
+		for rules, interaction in self.queries(300):
+			bound = random.randint(0,4)
+			self.assertEqual(native_sat(rules, self.vocabulary, bound, interaction, 'partial'),
+				enumerated_sat(rules, self.vocabulary, bound, interaction, 'partial'), (rules, interaction, bound))
+
+	def test_complete(self):
+		for rules, interaction in self.queries(300):
+			self.assertEqual(native_sat(rules, self.vocabulary, 0, interaction, 'complete'),
+				enumerated_sat(rules, self.vocabulary, 0, interaction, 'complete'), (rules, interaction))
+
+	def test_nobound(self):
+		# with at most 3 rules over these words, 4 more messages are enough when any are
+		for rules, interaction in self.queries(100):
+			self.assertEqual(native_sat(rules, self.vocabulary, 0, interaction, 'nobound'),
+				enumerated_sat(rules, self.vocabulary, 4, interaction, 'nobound'), (rules, interaction))
+
+	def test_violations(self):
+		for rules, interaction in self.queries(300):
+			trace = ['begin'] + interaction + ['end']
+			self.assertEqual(native_violations(rules, self.vocabulary, interaction),
+				[i for i, r in enumerate(rules) if not holds(r, trace)], (rules, interaction))
+
+	def test_undeclared(self):
+		self.assertEqual(native_sat([Existential('z', 1, 0)], self.vocabulary, 3), None)
+		self.assertEqual(native_sat([], self.vocabulary, 3, [(0, 'z')]), None)
+
+
+class IncrementalSatTest(unittest.TestCase):
+
+	def test_against_native_sat(self):
+		vocabulary = ['a', 'b', 'c']
+		random.seed(5)
+		hits = 0
+		for k in range(60):
+			bound = random.randint(2,6)
+			solver = IncrementalSat(vocabulary, bound)
+			rules = []
+			for c in range(12):
+				rule = random_rule(vocabulary)
+				possible = native_sat(rules + [rule], vocabulary, bound)
+				self.assertEqual(solver.check(rule), possible, (rules, rule, bound))
+				if possible:
+					solver.add(rule)
+					rules.append(rule)
+			hits += solver.witness_hits
+		# most checks are answered by the witness of the rules accepted so far
+		self.assertTrue(hits > 0)
+
+
+#**#**#**#**#**#**#**#**#**# Rule Spaces #**#**#**#**#**#**#**#**#**#
+
+# The candidate rules as generate_pos_mons, generate_oth_mons and generate_oth listed them
+
+def listed_pos_mons(vocabulary):
+	return [Existential(v,1,ag) for v in vocabulary for ag in [0,1]]
+
+def listed_oth_mons(vocabulary):
+	ex = [Existential(v,0,ag) for v in vocabulary for ag in [0,1]]
+	types = ("correlation","response","before")
+	rel0 = [Relation(a,b,t,0,ag, agr)  for t in types for b in vocabulary for a in vocabulary if a!=b for ag in [0,1] for agr in [0,1]]
+	rel1 = [Relation(a,b,t,1,ag, agr) for t in types for b in vocabulary for a in vocabulary if a!=b for ag in [0,1] for agr in [0,1]]
+	types2 = ("immAfter", "premise")
+	rel2a = [Relation(a,b,t,pos,1,0) for t in types2 for b in vocabulary for a in vocabulary if a!=b for pos in [0,1]]
+	rel2b = [Relation(a,b,t,pos,0,1) for t in types2 for b in vocabulary for a in vocabulary if a!=b for pos in [0,1]]
+	return ex+rel1+rel0+rel2a+rel2b
+
+def listed_oth(vocabulary):
+	ex = [Existential(v,0,ag) for v in vocabulary for ag in [0,1]]
+	types = ["correlation","response"]
+	rel0 = [Relation(a,b,t,0,ag, agr)  for t in types for b in vocabulary for a in vocabulary for ag in [0,1] for agr in [0,1]]
+	rel2a = [Relation(a,b,'premise',pos,ag,agr) for b in vocabulary for ag in [0,1] for agr in [0,1] for a in vocabulary for pos in [0,1]]
+	rel3 = [Relation(a,b,'before',pos,ag,agr) for b in vocabulary for a in vocabulary for ag in [0,1] for agr in [0,1] for pos in [0,1]]
+	rel4a = [Relation(a,b,'immAfter',pos,ag,agr) for b in vocabulary for ag in [0,1] for agr in [0,1] for a in vocabulary for pos in [0,1]]
+	return ex+rel0+rel2a+rel4a+rel3
+
+
+class RuleSpaceTest(unittest.TestCase):
+	# with a word repeated, as protocol_generator builds the vocabulary from vocabulary_dist
+	vocabularies = [['a'], ['a', 'b', 'c'], ['a', 'b', 'a']]
+
+	def test_order(self):
+		for vocabulary in self.vocabularies:
+			for space, listed in [(space_pos_mons, listed_pos_mons), (space_oth_mons, listed_oth_mons), (space_oth, listed_oth)]:
+				rules = listed(vocabulary)
+				self.assertEqual(len(space(vocabulary)), len(rules))
+				self.assertEqual(list(space(vocabulary)), rules)
+				self.assertEqual([space(vocabulary)[i] for i in range(len(rules) - 1, -1, -1)], rules[::-1])
+
+	def test_sampler(self):
+		random.seed(2)
+		for vocabulary in self.vocabularies:
+			rules = listed_oth(vocabulary)
+			sampler = RuleSampler(space_oth(vocabulary))
+			drawn = [sampler.draw() for i in range(len(rules))]
+			self.assertEqual(len(sampler), 0)
+			self.assertEqual(sampler.draw(), None)
+			# every candidate once, as many times as it is listed
+			self.assertEqual(sorted(drawn, key=repr), sorted(rules, key=repr))
+		# and each one first as often as any other
+		first = [RuleSampler(space_pos_mons(['a', 'b'])).draw() for i in range(4000)]
+		counts = [first.count(r) for r in listed_pos_mons(['a', 'b'])]
+		self.assertTrue(min(counts) > 850 and max(counts) < 1150, counts)
+
+
+#**#**#**#**#**#**#**#**#**# Interaction Monitors #**#**#**#**#**#**#**#**#**#
+
+# The monitors against Rule.satisfied on the whole interaction, which is how the agents found broken rules before them
+
+def satisfied_brokenNonM(protocol, interaction, message=None, agent=None):
+	inter = list(interaction)
+	if message:
+		inter.append((agent, message))
+	broken = [r for r in protocol.rules if not isMonotone(r) and not r.satisfied(inter)]
+	if message:
+		broken = [r for r in broken if not (isinstance(r, Relation) and r.type=='immAfter' and r.pos==1 and r.b != message)]
+	return broken
+
+
+class InteractionMonitorTest(unittest.TestCase):
+	vocabulary = ['a', 'b', 'c']
+
+	def cases(self, count):
+		random.seed(11)
+		for k in range(count):
+			rules = [random_rule(self.vocabulary) for i in range(random.randint(1,8))]
+			interaction = [(random.randint(0,1), random.choice(self.vocabulary)) for i in range(random.randint(0,5))]
+			yield rules, interaction
+
+	def test_broken(self):
+		for rules, interaction in self.cases(500):
+			monitor = InteractionMonitor(rules)
+			for n in range(len(interaction) + 1):
+				self.assertEqual(monitor.broken(), [r for r in rules if not r.satisfied(interaction[:n])], (rules, interaction[:n]))
+				if n < len(interaction):
+					monitor.append(*interaction[n])
+
+	def test_would_break(self):
+		for rules, interaction in self.cases(500):
+			monitor = InteractionMonitor(rules)
+			monitor.extend(interaction)
+			for agent in [0,1]:
+				masks = monitor.violations(agent, self.vocabulary)
+				for i, word in enumerate(self.vocabulary):
+					broken = [r for r in rules if not r.satisfied(interaction + [(agent, word)])]
+					self.assertEqual(monitor.would_break(agent, word), broken, (rules, interaction, agent, word))
+					self.assertEqual(masks[i].tolist(), [r in broken for r in rules], (rules, interaction, agent, word))
+
+	def test_brokenNonM(self):
+		for rules, interaction in self.cases(300):
+			protocol = Protocol(self.vocabulary, rules, 'p')
+			# the prefixes of an interaction reuse the monitor of the protocol, another interaction starts a new one
+			for inter in [interaction[:n] for n in range(len(interaction) + 1)] + [[(1, 'c')]]:
+				for message in [None] + self.vocabulary:
+					agent = random.randint(0,1)
+					self.assertEqual(brokenNonM(protocol, inter, 6, message, agent), satisfied_brokenNonM(protocol, inter, message, agent), (rules, inter, message, agent))
+
+
+# What NuSMV 2.6 prints checking protocol2nusmv_spec of NUSMV_RULES with the options of nusmvpool (no counterexamples).
+# It prints the formulas, not the names, in the order of the specifications
+NUSMV_OUTPUT = """*** This is NuSMV 2.6.0 (compiled on Wed Oct 14 15:37:51 2015)
+*** Enabled addons are: compass
+*** For more information on NuSMV see <http://nusmv.fbk.eu>
+*** or email to <nusmv-users@list.fbk.eu>.
+*** Please report bugs to <Please report bugs to <nusmv-users@fbk.eu>>
+
+*** Copyright (c) 2010-2014, Fondazione Bruno Kessler
+
+*** This version of NuSMV is linked to the CUDD library version 2.4.1
+*** Copyright (c) 1995-2004, Regents of the University of Colorado
+
+*** This version of NuSMV is linked to the MiniSat SAT solver.
+*** See http://minisat.se/MiniSat.html
+*** Copyright (c) 2003-2006, Niklas Een, Niklas Sorensson
+*** Copyright (c) 2007-2010, Niklas Sorensson
+
+-- specification  F say = h0  is false
+-- specification ( F say = h0 ->  F say = l1)  is false
+-- specification  G (say = l1 -> !( F say = j0))  is false
+-- specification (say != j0 U say = h0 | G say != j0)  is true
+"""
+NUSMV_RULES = [Existential('h', 1, 0), Relation('h', 'l', 'correlation', 1, 0, 1), Relation('l', 'j', 'response', 0, 1, 0), Relation('h', 'j', 'before', 1, 0, 0)]
+
+
+class NuSMVOutputTest(unittest.TestCase):
+
+	def setUp(self):
+		self.call_nusmv = openprot.call_nusmv
+		self.backend = openprot.sat_backend
+		openprot.set_sat_backend('nusmv')
+
+	def tearDown(self):
+		openprot.call_nusmv = self.call_nusmv
+		openprot.set_sat_backend(self.backend)
+
+	def test_formulas(self):
+		self.assertEqual(nusmv2violations(NUSMV_OUTPUT, 4), [0, 1, 2])
+
+	def test_names(self):
+		named = "-- specification r3  is true\n-- specification r1  is false\n-- specification r0 IN main is false\n-- specification (r2)  is true\n"
+		self.assertEqual(nusmv2violations(named, 4), [0, 1])
+
+	def test_missing(self):
+		self.assertEqual(nusmv2violations(NUSMV_OUTPUT, 5), None)
+		self.assertEqual(nusmv2violations(NUSMV_OUTPUT + "-- specification r4  is true\n", 5), None)
+
+	def test_brokenM(self):
+		protocol = Protocol(['h', 'l', 'j'], NUSMV_RULES, 'p')
+		openprot.call_nusmv = lambda module, nam="", cancel=None: (0, NUSMV_OUTPUT)
+		self.assertEqual(brokenM(protocol, [(1, 'l')], 4), NUSMV_RULES[:2])
+		# an output without the answers is not taken for no violations
+		openprot.call_nusmv = lambda module, nam="", cancel=None: (0, NUSMV_OUTPUT.split("-- ")[0])
+		self.assertRaises(NameError, brokenM, protocol, [(1, 'l')], 4)
+
+
+#**#**#**#**#**#**#**#**#**# Hypotheses #**#**#**#**#**#**#**#**#**#
+
+class HypothesisSpaceTest(unittest.TestCase):
+
+	def spaces(self, count):
+		""" Random spaces, with the permutations they allow """
+		random.seed(3)
+		for k in range(count):
+			n = random.randint(1,6)
+			space = HypothesisSpace(n)
+			single = []
+			pairs = []
+			for c in range(random.randint(0,12)):
+				if random.random() < 0.4:
+					j, k = random.randrange(n), random.randrange(n)
+					space.exclude(j, k)
+					single.append((j, k))
+				else:
+					pair = tuple(random.randrange(n) for i in range(4))
+					space.exclude_pair(*pair)
+					pairs.append(pair)
+			allowed = [p for p in itertools.permutations(range(n)) if not any(p[j] == k for j, k in single)
+				and not any(p[j1] == k1 and p[j2] == k2 for j1, k1, j2, k2 in pairs)]
+			yield space, allowed
+
+	def test_enumeration(self):
+		for space, allowed in self.spaces(300):
+			self.assertEqual(list(space.solutions()), allowed)
+			self.assertEqual(space.count(), len(allowed))
+			self.assertEqual(space.count(2), min(2, len(allowed)))
+			self.assertEqual(space.first(), allowed[0] if allowed else None)
+
+	def test_bound(self):
+		for space, allowed in self.spaces(300):
+			self.assertTrue(space.bound() >= len(allowed) - 1e-9)
+
+	def test_sample(self):
+		for space, allowed in self.spaces(300):
+			self.assertEqual(space.sample() in allowed, bool(allowed))
+			self.assertEqual(space.random_alignment() in allowed, bool(allowed))
+		# and by the walk, whatever the size of the space
+		exact = HypothesisSpace.exact
+		HypothesisSpace.exact = 0
+		try:
+			for space, allowed in self.spaces(300):
+				self.assertEqual(space.sample() in allowed, bool(allowed))
+		finally:
+			HypothesisSpace.exact = exact
+
+
+#**#**#**#**#**#**#**#**#**# Aggregates #**#**#**#**#**#**#**#**#**#
+
+class CurveStatsTest(unittest.TestCase):
+
+	def test_against_numpy(self):
+		curves = np.random.RandomState(5).rand(301, 40)
+		stats = CurveStats(40)
+		other = CurveStats(40)
+		for curve in curves[:120]:
+			stats.add(curve)
+		for curve in curves[120:]:
+			other.add(curve)
+		stats.merge(other)
+		self.assertEqual(stats.count, 301)
+		self.assertTrue(np.allclose(stats.mean, curves.mean(axis=0)))
+		self.assertTrue(np.allclose(stats.variance(), curves.var(axis=0, ddof=1)))
+		# quantiles are exact to a bin
+		for q in [0, 0.1, 0.5, 0.9, 1]:
+			self.assertTrue(np.abs(stats.quantile(q) - np.percentile(curves, 100 * q, axis=0)).max() <= 1.0 / stats.bins + 1e-12, q)
+
+	def test_merge_empty(self):
+		stats = CurveStats(3)
+		stats.add([0.1, 0.2, 0.3])
+		stats.merge(CurveStats(3))
+		self.assertEqual(stats.count, 1)
+		self.assertTrue(np.allclose(stats.median(), [0.1, 0.2, 0.3]))
+		self.assertRaises(NameError, stats.merge, CurveStats(4))
+
+
+#**#**#**#**#**#**#**#**#**# Result Stores #**#**#**#**#**#**#**#**#**#
+
+class ResultSinkTest(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test_truncate(self):
+		sink = ResultSink(os.path.join(self.path, 'store'), 4, ['simple'])
+		for k in range(3):
+			sink.append('simple', [k] * 4, [k + 0.5] * 4, k)
+		sink.truncate('simple', 2)
+		# only shrinks
+		self.assertRaises(NameError, sink.truncate, 'simple', 5)
+		sink.close()
+		resultsfin, resultsconv = load_results(sink.path)
+		self.assertEqual(resultsfin['simple'].tolist(), [[0] * 4, [0.5] * 4, [1] * 4, [1.5] * 4])
+		self.assertEqual(resultsconv['simple'].tolist(), [0, 1])
+
+
+#**#**#**#**#**#**#**#**#**# Corpora and Queues #**#**#**#**#**#**#**#**#**#
+
+class PackedCorpusTest(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test_round_trip(self):
+		random.seed(9)
+		vocabulary = ['h', 'l', 'u', 'j']
+		protocols = [Protocol(vocabulary, [random_rule(vocabulary) for i in range(random.randint(0,10))], 'p{}'.format(k)) for k in range(20)]
+		pack_corpus(protocols, os.path.join(self.path, 'c.bin'))
+		corpus = PackedCorpus(os.path.join(self.path, 'c.bin'))
+		self.assertEqual(len(corpus), len(protocols))
+		for i, p in enumerate(protocols):
+			for q in [corpus[i], corpus[i - len(protocols)], corpus.protocol(p.name)]:
+				self.assertEqual((q.name, q.vocabulary, q.rules), (p.name, p.vocabulary, p.rules))
+		self.assertTrue('p3' in corpus and not 'p20' in corpus)
+		self.assertRaises(IndexError, corpus.__getitem__, len(protocols))
+		# and the JSON files of the protocols
+		os.mkdir(os.path.join(self.path, 'json'))
+		unpack_json(corpus, os.path.join(self.path, 'json/'))
+		for p in protocols:
+			q = protocol_from_json(os.path.join(self.path, 'json', 'jsonPR-' + p.name))
+			self.assertEqual((q.name, q.vocabulary, q.rules), (p.name, p.vocabulary, p.rules))
+		corpus.close()
+
+
+class WorkQueueTest(unittest.TestCase):
+
+	def setUp(self):
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def test_claims(self):
+		queue = WorkQueue(self.path, lease=60)
+		self.assertEqual(queue.submit('e', 1, 2, 30, ['h', 'l'], 4, ['simple'], seed=1), 2)
+		cell, claim = queue.claim('w1')
+		other, other_claim = queue.claim('w2')
+		self.assertEqual(sorted([cell, other]), ['e-simple-0-0.json', 'e-simple-0-1.json'])
+		self.assertEqual(queue.claim('w3'), None)
+		# submitting again queues nothing that is claimed
+		self.assertEqual(queue.submit('e', 1, 2, 30, ['h', 'l'], 4, ['simple']), 0)
+		# a claim within its lease stays
+		self.assertEqual(queue.reclaim(), 0)
+		# w1 stopped touching its claim: it goes back to pending, and another worker claims it
+		old = time.time() - 61
+		os.utime(queue.dir('claimed', claim), (old, old))
+		self.assertEqual(queue.reclaim(), 1)
+		self.assertEqual(queue.status(), {'pending' : 1, 'claimed' : 1, 'done' : 0})
+		self.assertEqual(queue.claim('w3'), (cell, cell + '@w3'))
+		# a stale claim of a cell that is done is dropped
+		queue.write('done', other, {})
+		os.utime(queue.dir('claimed', other_claim), (old, old))
+		self.assertEqual(queue.reclaim(), 0)
+		self.assertEqual(queue.status(), {'pending' : 0, 'claimed' : 1, 'done' : 1})
+
+
+if __name__ == "__main__":
+	unittest.main()
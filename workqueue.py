@@ -0,0 +1,317 @@
+import os
+import sys, getopt
+import json
+import time
+import random
+import socket
+import threading
+from multiprocessing import Process
+import openprot
+import agents
+from resultstore import ResultSink, load_results
+from catalog import Catalog
+from aggregates import CurveStats
+from agents import prepare_experiment, experiment_patterns, experiment_cell, run_cell, write_results, init_cell_worker, expiry_policies
+
+# A queue is a directory on storage that every worker sees:
+#   experiments/NAME.json     the parameters of experiment NAME, with its seed
+#   pending/CELL.json         cells nobody runs, CELL being NAME-agent-outer-iteration
+#   claimed/CELL.json@WORKER  cells being run: a worker claims a cell by renaming it from pending,
+#                             and touches the claim while it runs it
+#   done/CELL.json            the outcomes of run_cell
+# Renames are atomic, so two workers never claim the same cell. A claim not touched for lease seconds
+# (its worker crashed, or its host is gone) is renamed back to pending by the next worker that looks.
+# Every cell has its own seed, so a cell that ends up run twice gives the same outcome both times
+
+
+class Lease(threading.Thread):
+	""" Touches a claim every lease/3 seconds until it is stopped, or the claim is taken back """
+
+	def __init__(self, path, lease):
+		super(Lease, self).__init__()
+		self.daemon = True
+		self.path = path
+		self.lease = lease
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.wait(self.lease / 3.0):
+			try:
+				os.utime(self.path, None)
+			except OSError:
+				return
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
+
+
+class WorkQueue(object):
+	""" The cells of experiments, sharded in a directory for any number of workers on any number of hosts.
+		The workers' clocks must agree within a small part of the lease
+	"""
+
+	def __init__(self, path, lease=600):
+		self.path = path
+		self.lease = lease
+		for d in ['experiments', 'pending', 'claimed', 'done']:
+			if not os.path.isdir(self.dir(d)):
+				try:
+					os.makedirs(self.dir(d))
+				except OSError:
+					# another worker made it
+					pass
+		# the claims do not touch the random generator of the experiments
+		self.random = random.Random()
+		self.prepared = None
+
+	def dir(self, d, name=''):
+		return os.path.join(self.path, d, name)
+
+	def listing(self, d):
+		return sorted(f for f in os.listdir(self.dir(d)) if not f.startswith('.'))
+
+	def write(self, d, name, data):
+		"""Writes data as json in d/name, through a temporary file so that nobody reads it half written"""
+		tmp = self.dir(d, '.{}.{}.{}'.format(name, socket.gethostname(), os.getpid()))
+		f = open(tmp, 'w')
+		json.dump(data, f)
+		f.close()
+		os.rename(tmp, self.dir(d, name))
+
+	def read(self, d, name):
+		f = open(self.dir(d, name))
+		data = json.load(f)
+		f.close()
+		return data
+
+	@staticmethod
+	def cell_name(name, ag, o, i):
+		return '{}-{}-{}-{}.json'.format(name, ag, o, i)
+
+	def cells(self, spec):
+		"""The cells of an experiment, in the order experimentAgents runs them"""
+		return [(ag, o, i) for o in range(spec['outiter']) for ag in spec['agents'] for i in range(spec['initer'])]
+
+	#**#**#**#**#**#**#**#**#**# Submitting #**#**#**#**#**#**#**#**#**#
+
+	def submit(self, name, outiter, initer, int, vocab, prot, agents, hetp=None, hetr=None, mons=0, param=0.3, corpus=None, seed=None, interaction_budget=None, expiry_policy='unsat'):
+		""" Queues the cells of an experiment, with the arguments of experimentAgents. The corpus, if any, is a path
+			every worker can read. Submitting an experiment again queues the cells that are not done. Returns how many were queued
+		"""
+		if '-' in name:
+			raise NameError('Experiment names cannot contain -: {}'.format(name))
+		if not expiry_policy in expiry_policies:
+			raise NameError('Unknown expiry policy: {}'.format(expiry_policy))
+		if os.path.exists(self.dir('experiments', name + '.json')):
+			spec = self.read('experiments', name + '.json')
+		else:
+			if seed == None:
+				seed = random.randrange(2**32)
+			spec = {'name' : name, 'outiter' : outiter, 'initer' : initer, 'int' : int, 'vocab' : vocab, 'prot' : prot,
+					'agents' : agents, 'hetp' : hetp, 'hetr' : hetr, 'mons' : mons, 'param' : param, 'corpus' : corpus,
+					'seed' : seed, 'interaction_budget' : interaction_budget, 'expiry_policy' : expiry_policy}
+			self.write('experiments', name + '.json', spec)
+
+		claimed = set(c.split('@')[0] for c in self.listing('claimed'))
+		queued = 0
+		for ag, o, i in self.cells(spec):
+			cell = self.cell_name(name, ag, o, i)
+			if cell in claimed or os.path.exists(self.dir('done', cell)) or os.path.exists(self.dir('pending', cell)):
+				continue
+			self.write('pending', cell, {'experiment' : name, 'ag' : ag, 'o' : o, 'i' : i})
+			queued += 1
+		return queued
+
+	#**#**#**#**#**#**#**#**#**# Working #**#**#**#**#**#**#**#**#**#
+
+	def claim(self, worker):
+		"""Claims a pending cell for worker. Returns the cell and its claim, or None if there is none left"""
+		pending = self.listing('pending')
+		self.random.shuffle(pending)
+		for cell in pending:
+			claim = '{}@{}'.format(cell, worker)
+			try:
+				os.rename(self.dir('pending', cell), self.dir('claimed', claim))
+				# the lease counts from now, not from when the cell was queued
+				os.utime(self.dir('claimed', claim), None)
+			except OSError:
+				# somebody claimed it first, or took it back before it was touched
+				continue
+			return cell, claim
+		return None
+
+	def reclaim(self):
+		"""Gives back to pending the claims that were not touched for lease seconds. Returns how many"""
+		reclaimed = 0
+		now = time.time()
+		for claim in self.listing('claimed'):
+			try:
+				if now - os.stat(self.dir('claimed', claim)).st_mtime <= self.lease:
+					continue
+				cell = claim.split('@')[0]
+				if os.path.exists(self.dir('done', cell)):
+					os.remove(self.dir('claimed', claim))
+				else:
+					os.rename(self.dir('claimed', claim), self.dir('pending', cell))
+					reclaimed += 1
+			except OSError:
+				# its worker finished it, or another one reclaimed it
+				continue
+		return reclaimed
+
+	def prepare(self, name):
+		"""Prepares experiment name in this process, unless it is the one prepared already"""
+		if self.prepared != name:
+			spec = self.read('experiments', name + '.json')
+			prepare_experiment(spec['int'], [str(v) for v in spec['vocab']], spec['prot'], spec['hetp'], spec['hetr'], spec['mons'], spec['param'],
+				spec['corpus'], spec['seed'], spec['interaction_budget'], None, spec['expiry_policy'])
+			openprot.on_expiry = 'unsat' if spec['expiry_policy'] == 'unsat' else 'raise'
+			self.prepared = name
+			self.patterns = {}
+
+	def run(self, cell, claim):
+		"""Runs a claimed cell, writes its outcome to done and releases the claim"""
+		data = self.read('claimed', claim)
+		self.prepare(data['experiment'])
+		o = data['o']
+		if not o in self.patterns:
+			self.patterns[o] = experiment_patterns(o)
+
+		lease = Lease(self.dir('claimed', claim), self.lease)
+		lease.start()
+		try:
+			ag, curve0, curve1, converged, expirations, checks = run_cell(experiment_cell(str(data['ag']), o, data['i'], self.patterns[o]))
+		finally:
+			lease.stop()
+		self.write('done', cell, {'ag' : ag, 'curve0' : curve0, 'curve1' : curve1, 'converged' : converged,
+			'expirations' : expirations, 'checks' : checks, 'worker' : claim.split('@')[1]})
+		try:
+			os.remove(self.dir('claimed', claim))
+		except OSError:
+			pass
+
+	def work(self, worker=None, poll=5):
+		""" Runs cells until every queued cell is done, reclaiming those of crashed workers. Returns how many it ran """
+		if worker == None:
+			worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+		agents.verbose = 0
+		ran = 0
+		while True:
+			claimed = self.claim(worker)
+			if claimed != None:
+				self.run(*claimed)
+				ran += 1
+				continue
+			self.reclaim()
+			if not self.listing('pending') and not self.listing('claimed'):
+				return ran
+			time.sleep(poll)
+
+	def status(self):
+		return {d : len(self.listing(d)) for d in ['pending', 'claimed', 'done']}
+
+	#**#**#**#**#**#**#**#**#**# Reducing #**#**#**#**#**#**#**#**#**#
+
+	def reduce(self, name, path='results/', sink=None, catalog=None, aggregate=False):
+		""" Merges the outcomes of experiment name into the results of experimentAgents, in the order it would run the cells.
+			Writes them to path as write_results does or, given sink, appends them to that result store as they are read
+			and records the run in catalog (a Catalog or its path) if there is one. With aggregate and no sink, nothing is
+			written and resultsfin maps each agent type to the CurveStats of its curves. Returns resultsfin and resultsconv
+		"""
+		spec = self.read('experiments', name + '.json')
+		cells = self.cells(spec)
+		missing = [c for c in cells if not os.path.exists(self.dir('done', self.cell_name(name, *c)))]
+		if missing:
+			raise NameError('{} of the {} cells of {} are not done'.format(len(missing), len(cells), name))
+
+		if sink != None:
+			store = ResultSink(sink, spec['int'], spec['agents'])
+			for ag in spec['agents']:
+				store.truncate(ag, 0)
+			for c in cells:
+				outcome = self.read('done', self.cell_name(name, *c))
+				store.append(c[0], outcome['curve0'], outcome['curve1'], outcome['converged'])
+			store.close()
+			if catalog != None:
+				if isinstance(catalog, basestring):
+					catalog = Catalog(catalog)
+				catalog.record(name, sink, spec['vocab'], spec['prot'], spec['agents'], spec['param'], spec['hetp'], spec['hetr'], spec['mons'],
+					spec['seed'], spec['outiter'], spec['initer'], spec['int'])
+			return load_results(sink)
+
+		results = {ag : (CurveStats(spec['int']) if aggregate else [], []) for ag in spec['agents']}
+		for c in cells:
+			outcome = self.read('done', self.cell_name(name, *c))
+			if aggregate:
+				results[c[0]][0].add(outcome['curve0'])
+				results[c[0]][0].add(outcome['curve1'])
+			else:
+				results[c[0]][0].append(outcome['curve0'])
+				results[c[0]][0].append(outcome['curve1'])
+			results[c[0]][1].append(outcome['converged'])
+		resultsfin = {ag : results[ag][0] for ag in spec['agents']}
+		resultsconv = {ag : results[ag][1] for ag in spec['agents']}
+		if aggregate:
+			return resultsfin, resultsconv
+		if path != None:
+			write_results(resultsfin, resultsconv, name, len(spec['vocab']), spec['prot'], path)
+		return resultsfin, resultsconv
+
+
+def _local_worker(path, lease, poll):
+	init_cell_worker(0)
+	WorkQueue(path, lease).work(poll=poll)
+
+def run_local(path, workers, lease=600, poll=1):
+	"""Works on the queue in path with workers processes on this host, until every cell is done"""
+	processes = [Process(target=_local_worker, args=(path, lease, poll)) for w in range(workers)]
+	for p in processes:
+		p.start()
+	for p in processes:
+		p.join()
+
+
+def main(argv):
+	path = 'queue/'
+	workers = None
+	lease = 600
+	reduce = None
+	output = 'results/'
+	sink = None
+	catalog = None
+
+	try:
+		opts, args = getopt.getopt(argv,"q:w:l:r:o:b:c:s",["queue=","workers=","lease=","reduce=","output=","store=","catalog=","status"])
+	except getopt.GetoptError:
+		print 'workqueue.py -q queue [-w workers] [-l lease] [-r experiment [-o output | -b store [-c catalog]]] [-s]'
+		sys.exit(2)
+	for opt, arg in opts:
+		if opt in ("-q", "--queue"):
+			path = arg
+		if opt in ("-w", "--workers"):
+			workers = int(arg)
+		if opt in ("-l", "--lease"):
+			lease = int(arg)
+		if opt in ("-r", "--reduce"):
+			reduce = arg
+		if opt in ("-o", "--output"):
+			output = arg
+		if opt in ("-b", "--store"):
+			sink = arg
+		if opt in ("-c", "--catalog"):
+			catalog = arg
+		if opt in ("-s", "--status"):
+			print WorkQueue(path, lease).status()
+			return
+
+	if reduce != None:
+		WorkQueue(path, lease).reduce(reduce, output, sink, catalog)
+		print "Results of {} written to {}".format(reduce, sink or output)
+	elif workers != None:
+		run_local(path, workers, lease)
+	else:
+		print "Ran {} cells".format(WorkQueue(path, lease).work())
+
+if __name__ == "__main__":
+   main(sys.argv[1:])